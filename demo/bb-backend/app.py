@@ -1,11 +1,24 @@
+import hmac
 import os
-from flask import Flask, request, jsonify
+import sys
+import time
+from flask import Flask, request, jsonify, Response
 from pymongo import MongoClient
 from bson.json_util import dumps
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 from flask_cors import CORS, cross_origin
 
+# The vector store and embedding helpers are shared with the offline scripts.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+from vector_store import EMBEDDING_FIELDS, HASH_FIELDS, get_vector_store
+from model_registry import GIST_MODEL_NAME, get_model, encode_many
+from filter_index import filters_key, parse_filters
+from lexical_index import SEARCH_MODES, LexicalIndex, lexical_search
+from query_cache import QueryCache, normalize_criteria
+from metrics import MetricsRegistry, profiler_from_env
+
+startup_started = time.perf_counter()
+
 app = Flask(__name__)
 CORS(app, support_credentials=True)
 load_dotenv()
@@ -13,9 +26,54 @@ load_dotenv()
 # MongoDB Configuration from environment variables
 MONGODB_URI = os.getenv('MONGODB_URI')
 
-# Connect to MongoDB
+# Vector search configuration. VECTOR_BACKEND is 'mongo' (Atlas $vectorSearch) or one of the in-process
+# indexes 'flat', 'ivf', 'hnsw'. The in-process indexes are built from VECTOR_FILE when it exists, otherwise
+# from the gist_embeddings in MongoDB (and then written to VECTOR_FILE for the next start). 'mmap' serves
+# the embedding store directory VECTOR_FILE, shared zero-copy between all worker processes.
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'mongo')
+VECTOR_FILE = os.getenv('VECTOR_FILE')
+VECTOR_PARAMS = {
+    'mongo': {'num_candidates': int(os.getenv('NUM_CANDIDATES', 50))},
+    'flat': {},
+    'mmap': {},
+    'ivf': {'n_lists': int(os.getenv('IVF_LISTS')) if os.getenv('IVF_LISTS') else None,
+            'n_probe': int(os.getenv('IVF_PROBE', 8))},
+    'hnsw': {'M': int(os.getenv('HNSW_M', 16)),
+             'ef_construction': int(os.getenv('HNSW_EF_CONSTRUCTION', 200)),
+             'ef_search': int(os.getenv('HNSW_EF_SEARCH', 64))},
+}
+
+# BM25 index over title + description (written by the ingestion script or lexical_index.py). When it is set,
+# /find accepts "mode": "prune" (dense scoring of the lexical top LEXICAL_CANDIDATES only) or "hybrid".
+LEXICAL_INDEX = os.getenv('LEXICAL_INDEX')
+LEXICAL_CANDIDATES = int(os.getenv('LEXICAL_CANDIDATES', 100))
+
+# Shared secret that POST /cache/invalidate expects in the X-Admin-Token header. The endpoint is disabled when
+# it is not set.
+CACHE_ADMIN_TOKEN = os.getenv('CACHE_ADMIN_TOKEN')
+
+# Limits of the /find/batch endpoint
+MAX_BATCH_QUERIES = int(os.getenv('MAX_BATCH_QUERIES', 256))
+MAX_K = 100
+
+# Instrumentation exposed on /metrics. Every /find is split into stages so slow requests can be attributed to
+# the embedding, the vector search or the response serialization.
+metrics = MetricsRegistry()
+STARTUP_SECONDS = metrics.gauge('bottlebuddy_startup_seconds', 'Time spent in each startup phase.', ['phase'])
+REQUEST_SECONDS = metrics.histogram('bottlebuddy_request_seconds', 'Request latency per endpoint.', ['endpoint'])
+STAGE_SECONDS = metrics.histogram('bottlebuddy_stage_seconds', 'Latency of each stage of a search request.', ['stage'])
+ERRORS = metrics.counter('bottlebuddy_errors_total', 'Errors handled by the backend, per stage.', ['stage'])
+# Opt-in: PROFILE_SAMPLE_RATE=0.01 runs one /find in a hundred under cProfile and writes PROFILE_OUTPUT.
+profiler = profiler_from_env()
+
+# Connect to MongoDB. MONGODB_URI=memory:// uses the in-process stand-in of offline_stubs.py (benchmarks).
+phase_started = time.perf_counter()
 try:
-    client = MongoClient(MONGODB_URI)
+    if MONGODB_URI == 'memory://':
+        from offline_stubs import InMemoryClient
+        client = InMemoryClient()
+    else:
+        client = MongoClient(MONGODB_URI)
     db_name = 'BottleBuddy'
     collection_name = 'Wine'
     db = client[db_name]
@@ -23,66 +81,277 @@ try:
 except Exception as e:
     print(f"Error connecting to MongoDB: {e}")
     exit(1)
+STARTUP_SECONDS.set(time.perf_counter() - phase_started, phase='mongo_connect')
 
-# Initialize the SentenceTransformer model
+# Build the vector store used by fetch_data
+phase_started = time.perf_counter()
 try:
-    gist_model = SentenceTransformer('avsolatorio/GIST-Embedding-v0')
+    vector_store = get_vector_store(VECTOR_BACKEND, collection=collection, file_path=VECTOR_FILE,
+                                    **VECTOR_PARAMS.get(VECTOR_BACKEND, {}))
+except Exception as e:
+    print(f"Error building the '{VECTOR_BACKEND}' vector store: {e}")
+    exit(1)
+STARTUP_SECONDS.set(time.perf_counter() - phase_started, phase='vector_store')
+
+lexical_index = None
+if LEXICAL_INDEX:
+    phase_started = time.perf_counter()
+    try:
+        lexical_index = LexicalIndex.load(LEXICAL_INDEX)
+    except Exception as e:
+        print(f"Error loading the lexical index: {e}")
+        exit(1)
+    STARTUP_SECONDS.set(time.perf_counter() - phase_started, phase='lexical_index')
+
+# Initialize the SentenceTransformer model. The registry pins it to EMBEDDING_DEVICE / EMBEDDING_THREADS.
+phase_started = time.perf_counter()
+try:
+    gist_model = get_model(GIST_MODEL_NAME)
 except Exception as e:
     print(f"Error loading Sentence Transformer model: {e}")
     exit(1)
+STARTUP_SECONDS.set(time.perf_counter() - phase_started, phase='model_load')
+STARTUP_SECONDS.set(time.perf_counter() - startup_started, phase='total')
+
+def collection_version():
+    """Return the marker the ingestion script updates after every (re-)ingestion of the collection."""
+    marker = db['Meta'].find_one({'_id': collection_name})
+    return marker.get('updated_at') if marker else None
+
+# Cache of /find results, keyed by the normalized criteria. It is dropped when the collection is re-ingested.
+query_cache = QueryCache(max_entries=int(os.getenv('QUERY_CACHE_SIZE', 1024)),
+                         ttl=float(os.getenv('QUERY_CACHE_TTL', 300)),
+                         version_fn=collection_version)
+
+def query_cache_metrics():
+    """Expose the query cache statistics on /metrics."""
+    stats = query_cache.stats()
+    families = [('bottlebuddy_query_cache_entries', 'Results held by the query cache.', 'gauge', (),
+                 {(): stats['entries']})]
+    for name in ('hits', 'misses', 'coalesced', 'evictions', 'invalidations'):
+        families.append((f'bottlebuddy_query_cache_{name}_total', f'Query cache {name}.', 'counter', (),
+                         {(): stats[name]}))
+    return families
+
+metrics.collectors.append(query_cache_metrics)
+
+def reload_lexical_index(_version):
+    """Reload the lexical index when the collection changed: the ingestion rewrites LEXICAL_INDEX before it
+    updates the collection marker."""
+    global lexical_index
+    try:
+        lexical_index = LexicalIndex.load(LEXICAL_INDEX)
+    except Exception as e:
+        print(f"Error reloading the lexical index, keeping the previous one: {e}")
+        ERRORS.inc(stage='lexical_index_reload')
+
+def rebuild_vector_store(_version):
+    """Rebuild the in-process vector store when the collection changed. The local indexes are rebuilt from
+    MongoDB (rewriting VECTOR_FILE); the 'mmap' store is reopened, so it has to be exported again before the
+    collection marker is updated."""
+    global vector_store
+    started = time.perf_counter()
+    try:
+        vector_store = get_vector_store(VECTOR_BACKEND, collection=collection, file_path=VECTOR_FILE, refresh=True,
+                                        **VECTOR_PARAMS.get(VECTOR_BACKEND, {}))
+    except Exception as e:
+        print(f"Error rebuilding the '{VECTOR_BACKEND}' vector store, keeping the previous one: {e}")
+        ERRORS.inc(stage='vector_store_rebuild')
+        return
+    print(f"Rebuilt the '{VECTOR_BACKEND}' vector store in {time.perf_counter() - started:.1f}s.")
+
+# The async app (asgi_app.py) shares the query cache, so its version checks reload the indexes as well. Atlas
+# searches the collection itself, so the 'mongo' store never needs a rebuild.
+if LEXICAL_INDEX:
+    query_cache.version_listeners.append(reload_lexical_index)
+if VECTOR_BACKEND != 'mongo':
+    query_cache.version_listeners.append(rebuild_vector_store)
+
+def build_criteria_text(words):
+    """Join the taste criteria into the text that is embedded."""
+    criteria = " "
+    for word in words:
+        criteria += word + ", "
+    return criteria
 
 def embed_data(text):
-    """Generate Gist embeddings for the given text."""
-    return gist_model.encode(text).tolist()
+    """Generate Gist embeddings for the given text, reusing cached embeddings of texts seen before."""
+    with STAGE_SECONDS.time(stage='embed'):
+        return encode_many([text], model_name=GIST_MODEL_NAME)[0].tolist()
 
-def fetch_data(embedding, k=5):
+def fetch_data(embedding, k=5, filters=None, query=None, mode='dense'):
     """
-    Fetch similar embeddings from MongoDB database using a vector search.
+    Fetch similar embeddings using the configured vector store (MongoDB or an in-process index).
+    filters are parsed metadata filters (filter_index.parse_filters), applied before the similarity ranking.
+    In 'prune' and 'hybrid' mode the query text is also matched against the lexical index.
     """
-    query = [
-        {
-            "$vectorSearch": {
-                "index": "gist_index",
-                "path": "gist_embeddings",
-                "queryVector": embedding,
-                "numCandidates": 50,
-                "limit": k
-            }
-        }
-    ]
     try:
-        results = list(collection.aggregate(query))
+        with STAGE_SECONDS.time(stage='vector_search'):
+            results = lexical_search(vector_store, lexical_index, embedding, query, k=k, mode=mode,
+                                     filters=filters, candidates=LEXICAL_CANDIDATES)
     except Exception as e:
-        print(f"Error performing vector search in MongoDB: {e}")
+        print(f"Error performing vector search: {e}")
+        ERRORS.inc(stage='vector_search')
         results = []  # Return an empty list in case of error
 
     return results
 
+def check_criteria(criteria):
+    """Return the error message for criteria that are not a list of strings, or None."""
+    if not isinstance(criteria, list) or not all(isinstance(word, str) for word in criteria):
+        return "criteria must be a list of strings"
+    return None
+
+def check_mode(mode):
+    """Return the error message for a search mode that cannot be served, or None."""
+    if mode not in SEARCH_MODES:
+        return f"mode must be one of {', '.join(SEARCH_MODES)}"
+    if mode != 'dense' and lexical_index is None:
+        return f"mode '{mode}' needs the lexical index (LEXICAL_INDEX)"
+    return None
+
+def format_wine(result):
+    """Turn a vector search result into the wine metadata and score returned by the batch API."""
+    wine = {key: value for key, value in result.items()
+            if key != '_id' and key not in EMBEDDING_FIELDS and key not in HASH_FIELDS}
+    wine_id = result.get('_id')
+    wine['id'] = wine_id if isinstance(wine_id, (int, str)) or wine_id is None else str(wine_id)
+    return wine
+
+def embed_batch(criteria_sets):
+    """Embed many criteria lists with one vectorized encode."""
+    texts = [build_criteria_text(criteria) for criteria in criteria_sets]
+    with STAGE_SECONDS.time(stage='embed_batch'):
+        return encode_many(texts, model_name=GIST_MODEL_NAME)
+
+def search_batch(embeddings, k=5, filters=None):
+    """
+    Search the vector store for many embeddings with one batched call, with the same parsed metadata filters
+    for every query. Returns one list of wines (metadata and score) per embedding, in the same order.
+    """
+    try:
+        with STAGE_SECONDS.time(stage='vector_search_batch'):
+            results = vector_store.search_many(embeddings, k=k, filters=filters)
+    except Exception as e:
+        print(f"Error performing batched vector search: {e}")
+        ERRORS.inc(stage='vector_search_batch')
+        results = [[] for _ in embeddings]  # Return empty lists in case of error
+    return [[format_wine(result) for result in query_results] for query_results in results]
+
+def find_batch(criteria_sets, k=5, filters=None):
+    """
+    Recommend wines for many criteria lists at once: one vectorized encode (embed_batch) and one batched
+    vector store call (search_batch). Returns one list of wines per criteria list, in the same order.
+    """
+    if not criteria_sets:
+        return []
+    return search_batch(embed_batch(criteria_sets), k=k, filters=filters)
+
 @app.route('/find', methods=['POST', 'OPTIONS'])
 @cross_origin(supports_credentials=True)
 def find_data():
-    data = request.json
-    if not data or 'criteria' not in data:
+    """
+    Body: {"criteria": ["dry", "red"], "filters": {"price": {"max": 30}, "province": "Oregon"}, "mode": "hybrid"}
+    filters is optional, see filter_index.py for the columns that can be filtered on.
+    mode is optional: 'dense' (default), or 'prune' / 'hybrid' when the lexical index is loaded.
+    """
+    with REQUEST_SECONDS.time(endpoint='/find'), profiler.profile():
+        return find_response()
+
+def find_response():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'criteria' not in data:
         return jsonify({"error": "No data provided"}), 400
+    error = check_criteria(data['criteria'])
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        filters = parse_filters(data.get('filters'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    mode = data.get('mode', 'dense')
+    error = check_mode(mode)
+    if error:
+        return jsonify({"error": error}), 400
     
-    criteria = " "
-    for word in data['criteria']:
-        criteria += word + ", "
+    # The same tags in any order or case share one cache entry. Only the key is normalized, the criteria are
+    # embedded as the user sent them.
+    words = normalize_criteria(data['criteria'])
 
-    # Embed the input data
-    embedding = embed_data(criteria)
+    def search():
+        # Embed the input data
+        criteria_text = build_criteria_text(data['criteria'])
+        embedding = embed_data(criteria_text)
 
-    # Fetch data from MongoDB using the embedding
-    results = fetch_data(embedding, k=5)
+        # Fetch data from the vector store using the embedding
+        results = fetch_data(embedding, k=5, filters=filters, query=criteria_text, mode=mode)
 
-    results_list = []
-    for result in results:
-        results_list.append(result['title'])
+        results_list = []
+        for result in results:
+            results_list.append(result['title'])
+        return results_list
 
+    # Identical requests that arrive while the first one is still searching wait for its result
+    with STAGE_SECONDS.time(stage='lookup'):
+        results_list = query_cache.get_or_compute((words, 5, filters_key(filters), mode), search)
     print(results_list)
 
     # Return the results to the frontend
-    return jsonify(results_list)
+    with STAGE_SECONDS.time(stage='serialize'):
+        return jsonify(results_list)
+
+@app.route('/find/batch', methods=['POST', 'OPTIONS'])
+@cross_origin(supports_credentials=True)
+def find_batch_data():
+    """
+    Body: {"queries": [["dry", "red"], ["sweet", "white"], ...], "k": 5, "filters": {...}}
+    Returns: {"results": [{"criteria": [...], "wines": [{"title": ..., "score": ..., ...}, ...]}, ...]}
+    """
+    with REQUEST_SECONDS.time(endpoint='/find/batch'):
+        return find_batch_response()
+
+def find_batch_response():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('queries'), list):
+        return jsonify({"error": "No queries provided"}), 400
+    queries = data['queries']
+    k = data.get('k', 5)
+    if any(check_criteria(criteria) for criteria in queries):
+        return jsonify({"error": "Every query must be a list of strings"}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({"error": f"At most {MAX_BATCH_QUERIES} queries per request"}), 400
+    if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= MAX_K:
+        return jsonify({"error": f"k must be an integer between 1 and {MAX_K}"}), 400
+    try:
+        filters = parse_filters(data.get('filters'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    results = find_batch(queries, k=k, filters=filters)
+    with STAGE_SECONDS.time(stage='serialize_batch'):
+        return jsonify({"results": [{"criteria": criteria, "wines": wines}
+                                    for criteria, wines in zip(queries, results)]})
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(query_cache.stats())
+
+def is_cache_admin(token):
+    """Whether token is the CACHE_ADMIN_TOKEN shared secret (always False when none is configured)."""
+    return bool(CACHE_ADMIN_TOKEN) and token is not None and hmac.compare_digest(token.encode(),
+                                                                                  CACHE_ADMIN_TOKEN.encode())
+
+@app.route('/cache/invalidate', methods=['POST'])
+def cache_invalidate():
+    if not is_cache_admin(request.headers.get('X-Admin-Token')):
+        return jsonify({"error": "Forbidden"}), 403
+    query_cache.invalidate()
+    return jsonify(query_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape endpoint: stage latency histograms, error counts, startup timing and cache stats."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
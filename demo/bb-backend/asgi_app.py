@@ -0,0 +1,198 @@
+"""
+Async serving mode for the BottleBuddy backend. Serves the same /find contract as app.py:
+
+    pip install starlette uvicorn motor
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+
+Concurrent /find requests are grouped by a micro-batcher into a single encode call, model inference runs on a
+dedicated thread pool so the event loop keeps accepting requests, and the MongoDB $vectorSearch goes through
+the async motor client. The vector store, query cache and model are the ones configured in app.py.
+
+The PROFILE_SAMPLE_RATE profiler of app.py samples the encode and search calls on the thread pools instead of
+whole requests: cProfile follows a single thread, and on the event loop it would mix the awaits of every
+concurrent request into one profile while missing the work done on the pools.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+import app as backend
+from filter_index import filters_key, parse_filters
+from lexical_index import lexical_search
+from micro_batcher import MicroBatcher
+from model_registry import GIST_MODEL_NAME, encode_many
+from query_cache import normalize_criteria
+from vector_store import MongoVectorStore
+
+# Micro-batching configuration: a batch is sent to the model once it has MICRO_BATCH_SIZE texts or when the
+# oldest text has waited MICRO_BATCH_WAIT_MS, whichever comes first.
+MICRO_BATCH_SIZE = int(os.getenv('MICRO_BATCH_SIZE', 32))
+MICRO_BATCH_WAIT_MS = float(os.getenv('MICRO_BATCH_WAIT_MS', 5))
+# Threads that run model inference. One is usually right on CPU, torch already uses every core per call.
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', 1))
+
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix='inference')
+search_executor = ThreadPoolExecutor(thread_name_prefix='search')
+batcher = None
+motor_collection = None
+
+
+def profiled(fn, *args):
+    """Run a blocking call on a thread pool under the sampling profiler of app.py."""
+    with backend.profiler.profile():
+        return fn(*args)
+
+
+def encode_batch(texts):
+    return profiled(encode_many, texts, GIST_MODEL_NAME)
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    global batcher, motor_collection
+    batcher = MicroBatcher(encode_batch, inference_executor, MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_MS)
+    batch_task = asyncio.create_task(batcher.run())
+    # The in-memory stand-in (MONGODB_URI=memory://) has no motor client; it is searched on the search pool.
+    if isinstance(backend.vector_store, MongoVectorStore) and backend.MONGODB_URI != 'memory://':
+        # Imported here so the local vector store backends do not need motor installed.
+        from motor.motor_asyncio import AsyncIOMotorClient
+        motor_collection = AsyncIOMotorClient(backend.MONGODB_URI)[backend.db_name][backend.collection_name]
+    yield
+    batch_task.cancel()
+
+
+async def fetch_data(embedding, k=5, filters=None, query=None, mode='dense'):
+    """
+    Fetch similar embeddings without blocking the event loop: through motor for MongoDB, or on the search
+    thread pool for the in-process indexes and the lexical search modes.
+    """
+    try:
+        with backend.STAGE_SECONDS.time(stage='vector_search'):
+            if mode != 'dense':
+                return await asyncio.get_running_loop().run_in_executor(
+                    search_executor, profiled, lambda: lexical_search(
+                        backend.vector_store, backend.lexical_index, embedding, query, k=k, mode=mode,
+                        filters=filters, candidates=backend.LEXICAL_CANDIDATES))
+            if motor_collection is not None:
+                return await motor_collection.aggregate(backend.vector_store.pipeline(embedding, k, filters)).to_list(length=None)
+            return await asyncio.get_running_loop().run_in_executor(search_executor, profiled,
+                                                                    backend.vector_store.search, embedding, k, filters)
+    except Exception as e:
+        print(f"Error performing vector search: {e}")
+        backend.ERRORS.inc(stage='vector_search')
+        return []  # Return an empty list in case of error
+
+
+async def find_data(request):
+    with backend.REQUEST_SECONDS.time(endpoint='/find'):
+        return await find_response(request)
+
+
+async def find_response(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or 'criteria' not in data:
+        return JSONResponse({"error": "No data provided"}, status_code=400)
+    error = backend.check_criteria(data['criteria'])
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    try:
+        filters = parse_filters(data.get('filters'))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    mode = data.get('mode', 'dense')
+    error = backend.check_mode(mode)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+
+    # Only the cache key is normalized, the criteria are embedded as the user sent them (as in app.py).
+    words = normalize_criteria(data['criteria'])
+
+    async def search():
+        criteria_text = backend.build_criteria_text(data['criteria'])
+        # Includes the time spent waiting for the micro-batch to fill up
+        with backend.STAGE_SECONDS.time(stage='embed'):
+            embedding = await batcher.submit(criteria_text)
+        results = await fetch_data(embedding.tolist(), k=5, filters=filters, query=criteria_text, mode=mode)
+        return [result['title'] for result in results]
+
+    with backend.STAGE_SECONDS.time(stage='lookup'):
+        results_list = await backend.query_cache.get_or_compute_async((words, 5, filters_key(filters), mode), search)
+    with backend.STAGE_SECONDS.time(stage='serialize'):
+        return JSONResponse(results_list)
+
+
+async def find_batch_data(request):
+    with backend.REQUEST_SECONDS.time(endpoint='/find/batch'):
+        return await find_batch_response(request)
+
+
+async def find_batch_response(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get('queries'), list):
+        return JSONResponse({"error": "No queries provided"}, status_code=400)
+    queries = data['queries']
+    k = data.get('k', 5)
+    if any(backend.check_criteria(criteria) for criteria in queries):
+        return JSONResponse({"error": "Every query must be a list of strings"}, status_code=400)
+    if len(queries) > backend.MAX_BATCH_QUERIES:
+        return JSONResponse({"error": f"At most {backend.MAX_BATCH_QUERIES} queries per request"}, status_code=400)
+    if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= backend.MAX_K:
+        return JSONResponse({"error": f"k must be an integer between 1 and {backend.MAX_K}"}, status_code=400)
+    try:
+        filters = parse_filters(data.get('filters'))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    # A batch is already one vectorized encode and one batched search, so it skips the micro-batcher. The encode
+    # runs on the inference thread, the search on the search pool, so a slow search never holds up inference.
+    results = []
+    if queries:
+        loop = asyncio.get_running_loop()
+        embeddings = await loop.run_in_executor(inference_executor, backend.embed_batch, queries)
+        results = await loop.run_in_executor(search_executor, backend.search_batch, embeddings, k, filters)
+    return JSONResponse({"results": [{"criteria": criteria, "wines": wines}
+                                     for criteria, wines in zip(queries, results)]})
+
+
+async def batcher_stats(request):
+    return JSONResponse({
+        'batches': batcher.batches,
+        'texts': batcher.texts,
+        'avg_batch_size': batcher.texts / batcher.batches if batcher.batches else 0.0,
+        'queued': batcher.queue.qsize(),
+    })
+
+
+async def cache_stats(request):
+    return JSONResponse(backend.query_cache.stats())
+
+
+async def metrics_endpoint(request):
+    return PlainTextResponse(backend.metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+app = Starlette(
+    routes=[
+        Route('/find', find_data, methods=['POST']),
+        Route('/find/batch', find_batch_data, methods=['POST']),
+        Route('/cache/stats', cache_stats, methods=['GET']),
+        Route('/batcher/stats', batcher_stats, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+    ],
+    # Same permissive CORS setup as the Flask app
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_credentials=True,
+                           allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
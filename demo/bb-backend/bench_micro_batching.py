@@ -0,0 +1,96 @@
+"""
+Measures what the micro-batcher of the async backend buys on CPU: the same concurrent /find-style texts are
+embedded once through MicroBatcher and once with one encode call per request, on the same single inference
+thread, so only the batching differs.
+
+    python bench_micro_batching.py --concurrency 32 --texts 1024
+    python bench_micro_batching.py --model path/to/sentence-transformer --backend onnx
+
+Prints texts/s, latency percentiles and the average batch size of both modes.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+from model_registry import GIST_MODEL_NAME, get_model
+from load_test import TASTE_TAGS
+from micro_batcher import MicroBatcher
+
+
+async def run_clients(texts, concurrency, embed):
+    """Send the texts from concurrency clients, each waiting for its embedding before sending the next text."""
+    pending = iter(texts)
+    latencies = []
+
+    async def client():
+        for text in pending:
+            started = time.perf_counter()
+            await embed(text)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - started, latencies
+
+
+async def measure(encode_fn, texts, concurrency, batched, max_batch_size, max_wait_ms):
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+    loop = asyncio.get_running_loop()
+    if batched:
+        batcher = MicroBatcher(encode_fn, executor, max_batch_size, max_wait_ms)
+        batch_task = asyncio.create_task(batcher.run())
+        embed = batcher.submit
+    else:
+        async def embed(text):
+            return (await loop.run_in_executor(executor, encode_fn, [text]))[0]
+    elapsed, latencies = await run_clients(texts, concurrency, embed)
+    if batched:
+        batch_task.cancel()
+    executor.shutdown()
+    latencies = 1000 * np.asarray(latencies)
+    return {
+        'texts_per_second': len(texts) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'avg_batch_size': batcher.texts / batcher.batches if batched else 1.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare micro-batched and per-request encoding throughput.")
+    parser.add_argument('--model', default=GIST_MODEL_NAME)
+    parser.add_argument('--backend', default=None, help="torch, onnx or hash (default EMBEDDING_BACKEND)")
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--texts', type=int, default=512)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    model = get_model(args.model, backend=args.backend)
+
+    def encode_fn(texts):
+        return model.encode(texts, batch_size=args.max_batch_size, convert_to_numpy=True)
+
+    # Same request texts as the backend builds from the taste tags (see build_criteria_text in app.py).
+    rng = random.Random(args.seed)
+    texts = [" " + ", ".join(rng.sample(TASTE_TAGS, rng.randint(1, 5))) + ", " for _ in range(args.texts)]
+    encode_fn(texts[:args.max_batch_size])  # warm up
+
+    print(f"{'concurrency':>11} {'mode':>9} {'texts/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'batch':>6}")
+    for concurrency in args.concurrency:
+        for batched in (False, True):
+            result = asyncio.run(measure(encode_fn, texts, concurrency, batched, args.max_batch_size,
+                                         args.max_wait_ms))
+            print(f"{concurrency:>11} {'batched' if batched else 'unbatched':>9} {result['texts_per_second']:>9.1f} "
+                  f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['avg_batch_size']:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Concurrent load generator for the /find endpoint. Works against both serving modes, e.g.
+
+    python app.py                                   # or: uvicorn asgi_app:app --port 5000
+    python load_test.py --concurrency 32 --requests 2000
+
+Prints the throughput and latency percentiles.
+"""
+import argparse
+import json
+import random
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Taste tags the frontend offers; each request picks a few at random.
+TASTE_TAGS = ['dry', 'sweet', 'red', 'white', 'oaky', 'tannic', 'citrus', 'fruity', 'earthy', 'spicy',
+              'crisp', 'buttery', 'floral', 'smoky', 'bold', 'light']
+
+
+def post_find(url, criteria):
+    body = json.dumps({'criteria': criteria}).encode('utf-8')
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    started = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the /find endpoint.")
+    parser.add_argument('--url', default='http://localhost:5000/find')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=3, help="Number of taste tags per request.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    queries = [rng.sample(TASTE_TAGS, args.tags) for _ in range(args.requests)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(lambda criteria: post_find(args.url, criteria), queries))
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}: {args.requests / elapsed:.1f} req/s")
+    for q in (50, 95, 99):
+        print(f"p{q}: {1000 * percentile(latencies, q):.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import cProfile
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond cache hits up to slow cold model calls.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """A value that can go up and down, e.g. the time a startup phase took."""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """
+    Cumulative latency histogram in the Prometheus layout (_bucket, _sum and _count series), optionally split
+    by labels.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the with-block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', key + (_format_value(bound),), cumulative))
+            samples.append((self.name + '_sum', key, total))
+            samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Holds the metrics of the process and renders them in the Prometheus text exposition format."""
+    def __init__(self):
+        self.metrics = []
+        # Callbacks returning extra (name, documentation, kind, {labels tuple: value}) families at scrape time,
+        # used for values that live elsewhere such as the query cache statistics.
+        self.collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            labelnames = metric.labelnames + ('le',) if metric.kind == 'histogram' else metric.labelnames
+            for name, key, value in metric.samples():
+                names = labelnames if name.endswith('_bucket') else metric.labelnames
+                lines.append(f'{name}{_format_labels(names, key)} {_format_value(value)}')
+        for collect in self.collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+                continue
+            for name, documentation, kind, labelnames, values in families:
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {kind}')
+                for key, value in values.items():
+                    lines.append(f'{name}{_format_labels(labelnames, key)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """
+    Opt-in cProfile hook for the hot path. A fraction sample_rate of the profiled blocks runs under cProfile
+    and the statistics are accumulated into output_path (open it with `python -m pstats` or snakeviz) every
+    dump_every samples. With sample_rate 0 (the default) the hook costs one random() call.
+
+    Only one block is profiled at a time: cProfile cannot run in several threads of a process at once.
+    """
+    def __init__(self, sample_rate=0.0, output_path='find.prof', dump_every=20):
+        self.sample_rate = sample_rate
+        self.output_path = output_path
+        self.dump_every = dump_every
+        self.samples = 0
+        self._stats = None
+        self._busy = threading.Lock()
+
+    @contextmanager
+    def profile(self):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate or not self._busy.acquire(blocking=False):
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            self._add(profiler)
+        finally:
+            self._busy.release()
+
+    def _add(self, profiler):
+        if self._stats is None:
+            self._stats = pstats.Stats(profiler)
+        else:
+            self._stats.add(profiler)
+        self.samples += 1
+        if self.samples % self.dump_every == 0:
+            self.dump()
+
+    def dump(self):
+        """Write the accumulated statistics to output_path."""
+        if self._stats is not None:
+            self._stats.dump_stats(self.output_path)
+
+
+def profiler_from_env():
+    """Build the SamplingProfiler configured by PROFILE_SAMPLE_RATE and PROFILE_OUTPUT."""
+    return SamplingProfiler(sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', 0)),
+                            output_path=os.getenv('PROFILE_OUTPUT', 'find.prof'))
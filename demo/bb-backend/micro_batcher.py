@@ -0,0 +1,51 @@
+import asyncio
+
+
+class MicroBatcher:
+    """
+    Collects texts submitted by concurrent requests and embeds them with one encode call per batch.
+    """
+    def __init__(self, encode_fn, executor, max_batch_size=32, max_wait_ms=5.0):
+        self.encode_fn = encode_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.texts = 0
+
+    async def submit(self, text):
+        """Queue a text and wait for its embedding."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def run(self):
+        """Batching loop, runs for the lifetime of the app."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(self.executor, self.encode_fn, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.texts += len(texts)
+            for (_, future), embedding in zip(batch, embeddings):
+                # The request may have been cancelled (client went away) while the batch was running.
+                if not future.done():
+                    future.set_result(embedding)
@@ -0,0 +1,202 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Marks that the collection version has not been read yet
+_UNSET = object()
+
+
+class _Abandoned(Exception):
+    """Set on an in-flight computation whose owner was cancelled, so a waiting request computes it itself."""
+
+
+def normalize_criteria(criteria):
+    """
+    Normalize a list of taste criteria so the same tags in a different order, case or spacing give the same key.
+    """
+    return tuple(sorted({word.strip().lower() for word in criteria if word and word.strip()}))
+
+
+class QueryCache:
+    """
+    LRU + TTL cache for /find results.
+
+    Concurrent requests for a key that is being computed wait for that computation instead of starting their
+    own (request coalescing). The whole cache is dropped when version_fn returns a new value, which is how a
+    re-ingested collection invalidates it. version_fn is called at most once every version_check_interval seconds.
+    The functions in version_listeners are called with the new version before the cache is dropped, so other
+    state derived from the collection (e.g. the lexical index) is reloaded together with it.
+    Empty results are never cached, because fetch_data returns an empty list when the vector search fails.
+    """
+    def __init__(self, max_entries=1024, ttl=300, version_fn=None, version_check_interval=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_fn = version_fn
+        self.version_check_interval = version_check_interval
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._version = _UNSET
+        self._version_checked_at = 0.0
+        self.version_listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+
+    def invalidate(self):
+        """Drop every cached result. Computations that are in flight are not stored when they finish."""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.invalidations += 1
+
+    def _version_check_due(self):
+        # Claims the next version check, so only one of the concurrent requests pays for it.
+        with self._lock:
+            now = time.monotonic()
+            if self.version_fn is None or now - self._version_checked_at < self.version_check_interval:
+                return False
+            self._version_checked_at = now
+            return True
+
+    def _refresh_version(self):
+        try:
+            version = self.version_fn()
+        except Exception as e:
+            print(f"Error checking the collection version for the query cache: {e}")
+            return
+        with self._lock:
+            previous, self._version = self._version, version
+        # The very first check only records the version, there is nothing to invalidate yet.
+        if previous is not _UNSET and version != previous:
+            # The listeners run first: a request that misses after the invalidation must not recompute its
+            # result from the old state.
+            for listener in self.version_listeners:
+                try:
+                    listener(version)
+                except Exception as e:
+                    print(f"Error in a collection version listener: {e}")
+            self.invalidate()
+
+    def _begin(self, key):
+        # Returns (True, value) on a hit, otherwise (False, (future, owner, generation)).
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return False, (future, False, None)
+            future = Future()
+            self._in_flight[key] = future
+            self.misses += 1
+            return False, (future, True, self._generation)
+
+    def _finish(self, key, future, generation, value, error, started):
+        with self._lock:
+            del self._in_flight[key]
+            if error is None and value and generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            self.miss_seconds += time.perf_counter() - started
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    def _record_hit(self, started):
+        with self._lock:
+            self.hit_seconds += time.perf_counter() - started
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached value for key, or call compute() to produce it. Only one compute() runs per key.
+        """
+        if self._version_check_due():
+            self._refresh_version()
+        started = time.perf_counter()
+        hit, result = self._begin(key)
+        if hit:
+            self._record_hit(started)
+            return result
+        future, owner, generation = result
+        if not owner:
+            try:
+                return future.result()
+            except _Abandoned:
+                return self.get_or_compute(key, compute)
+        try:
+            value = compute()
+        except BaseException as e:
+            self._finish(key, future, generation, None, self._waiter_error(e), started)
+            raise
+        self._finish(key, future, generation, value, None, started)
+        return value
+
+    @staticmethod
+    def _waiter_error(error):
+        # An owner that is cancelled or interrupted (not an Exception) did not fail the computation, so the
+        # waiters retry it instead of seeing the cancellation.
+        return error if isinstance(error, Exception) else _Abandoned()
+
+    async def get_or_compute_async(self, key, compute):
+        """
+        Same as get_or_compute for asyncio code: compute is a coroutine function, and neither waiting for a
+        computation that is already in flight nor the collection version check (run in the default executor)
+        blocks the event loop. A cancelled waiter leaves the shared computation running for the others; a
+        cancelled owner hands it over to a waiter.
+        """
+        if self._version_check_due():
+            await asyncio.get_running_loop().run_in_executor(None, self._refresh_version)
+        started = time.perf_counter()
+        hit, result = self._begin(key)
+        if hit:
+            self._record_hit(started)
+            return result
+        future, owner, generation = result
+        if not owner:
+            try:
+                # Shielded: cancelling this waiter must not cancel the future every other request waits on.
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except _Abandoned:
+                return await self.get_or_compute_async(key, compute)
+        try:
+            value = await compute()
+        except BaseException as e:
+            self._finish(key, future, generation, None, self._waiter_error(e), started)
+            raise
+        self._finish(key, future, generation, value, None, started)
+        return value
+
+    def stats(self):
+        """Hit rate, sizes and average latency (in milliseconds) of hits and misses."""
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'avg_hit_ms': 1000 * self.hit_seconds / self.hits if self.hits else 0.0,
+                'avg_miss_ms': 1000 * self.miss_seconds / self.misses if self.misses else 0.0,
+            }
@@ -1,11 +1,40 @@
-import pandas as pd
+import hashlib
+import os
+import pickle
 import pandas as pd
 from sklearn.neighbors import NearestNeighbors
 from sklearn.preprocessing import OneHotEncoder
 import numpy as np
+from scipy import sparse
 from sklearn.preprocessing import StandardScaler
 from sklearn.neighbors import NearestNeighbors
 
+# Columns that are one-hot encoded and numeric columns that are used as-is in the KNN feature matrix
+CATEGORICAL_COLUMNS = ['country', 'designation', 'province', 'variety', 'winery']
+NUMERIC_COLUMNS = ['price']
+FEATURE_ENCODER_PATH = 'data/knn_feature_encoder.pkl'
+
+# Columns read from the CSV and their compact dtypes. The wine reviews repeat the same countries, provinces,
+# varieties and wineries over and over, so categoricals store them once instead of once per row.
+# price stays float64: the missing prices are imputed with group means, and float32 means shift the imputed
+# values and with them the KNN neighbors. Only the final feature matrix is float32 (see _stack_features).
+RAW_DTYPES = {
+    'country': 'category',
+    'designation': 'category',
+    'points': 'int16',
+    'price': 'float64',
+    'province': 'category',
+    'taster_name': 'category',
+    'title': 'object',
+    'variety': 'category',
+    'winery': 'category',
+}
+# Cleaned datasets are cached here, keyed by a hash of the source CSV. Bump CLEANING_VERSION whenever
+# clean_data changes so old artifacts are not reused.
+CLEANED_CACHE_DIR = 'data/cache'
+CLEANING_VERSION = 2
+_file_hashes = {}
+
 
 def clean_data(df):
     """
@@ -15,105 +44,276 @@ def clean_data(df):
     returns:
         df_cleaned (DataFrame): cleaned dataframe
     """
-    df.drop(columns = ['description', 'region_1', 'region_2', 'taster_twitter_handle'], inplace = True)
+    df = df.drop(columns = ['description', 'region_1', 'region_2', 'taster_twitter_handle'], errors = 'ignore')
 
     #drop rows that do not have any info on province, variety, and/or country
-    df_drop_na = df.dropna(subset = ['variety', 'province', 'country'])
+    df_drop_na = df.dropna(subset = ['variety', 'province', 'country']).copy()
 
     #replace NA of designation with 'no designation'
+    if isinstance(df_drop_na['designation'].dtype, pd.CategoricalDtype) and \
+            'no designation' not in df_drop_na['designation'].cat.categories:
+        df_drop_na['designation'] = df_drop_na['designation'].cat.add_categories('no designation')
     df_drop_na['designation']= df_drop_na['designation'].fillna('no designation')
 
-    #replace NA values for price with the average price of other wines that have same winery, variety values
-    df_drop_na['price'] = df_drop_na.groupby(['winery', 'variety'])['price'].transform(lambda x: x.fillna(x.mean()))
-    df_drop_na['price'] = df_drop_na.groupby(['variety'])['price'].transform(lambda x: x.fillna(x.mean()))
+    #replace NA values for price with the average price of other wines that have same winery, variety values.
+    #transform('mean') computes the group means in one vectorized pass instead of calling a lambda per group
+    group_means = df_drop_na.groupby(['winery', 'variety'], observed=True)['price'].transform('mean')
+    df_drop_na['price'] = df_drop_na['price'].fillna(group_means)
+    group_means = df_drop_na.groupby(['variety'], observed=True)['price'].transform('mean')
+    df_drop_na['price'] = df_drop_na['price'].fillna(group_means)
     df_drop_na = df_drop_na.dropna(subset = ['price'])
 
-    #drop the rows where the winery name, designation, variety, province is a singular instance
-    value_counts = df_drop_na['winery'].value_counts()
-    values_to_drop = value_counts[value_counts==1].index
-    df_drop_na = df_drop_na[~df_drop_na['winery'].isin(values_to_drop)]
-    value_counts= df_drop_na['designation'].value_counts()
-    values_to_drop = value_counts[value_counts==1].index
-    df_drop_na = df_drop_na[~df_drop_na['designation'].isin(values_to_drop)]
-    value_counts = df_drop_na['variety'].value_counts()
-    values_to_drop = value_counts[value_counts<100].index
-    df_drop_na = df_drop_na[~df_drop_na['variety'].isin(values_to_drop)]
-    value_counts = df_drop_na['province'].value_counts()
-    values_to_drop = value_counts[value_counts<100].index
-    df_drop_na = df_drop_na[~df_drop_na['province'].isin(values_to_drop)]
+    #drop the rows where the winery name, designation is a singular instance, and where the variety, province
+    #has fewer than 100 instances. Each pass counts what is left after the previous one
+    for column, min_count in [('winery', 2), ('designation', 2), ('variety', 100), ('province', 100)]:
+        value_counts = df_drop_na[column].value_counts()
+        values_to_drop = value_counts[value_counts<min_count].index
+        df_drop_na = df_drop_na[~df_drop_na[column].isin(values_to_drop)]
 
     df_cleaned = df_drop_na.reset_index(drop=True)
     return df_cleaned
 
-def run_evaluation(model, tasters, data, scaled_data):
+def load_raw_data(csv_path):
+    """
+    Read only the columns the cleaning and KNN stages use, with compact dtypes
+    parameters:
+        csv_path (str): path to the wine reviews CSV
+    returns:
+        df (DataFrame): raw dataframe
+    """
+    return pd.read_csv(csv_path, usecols=list(RAW_DTYPES), dtype=RAW_DTYPES)
+
+def file_hash(path):
+    """
+    Hash the contents of a file, reusing the hash recorded for the same size and modification time
+    parameters:
+        path (str): path of the file
+    returns:
+        digest (str): hex sha256 of the file contents
+    """
+    stat = os.stat(path)
+    stamp = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    if stamp in _file_hashes:
+        return _file_hashes[stamp]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    _file_hashes[stamp] = digest.hexdigest()
+    return _file_hashes[stamp]
+
+def load_cleaned_data(csv_path='data/data_first10k.csv', cache_dir=CLEANED_CACHE_DIR):
+    """
+    Return the cleaned dataset, reading it from the columnar cache when the source file has been cleaned before.
+    The cache file name contains a hash of the source file and CLEANING_VERSION, so any change to either
+    produces a new artifact. Only main() starts from it: the backend serves from MongoDB and never reads the CSV,
+    and eval_runner needs the descriptions, which clean_data drops
+    parameters:
+        csv_path (str): path to the wine reviews CSV
+        cache_dir (str): directory that holds the cleaned artifacts
+    returns:
+        df_cleaned (DataFrame): cleaned dataframe
+    """
+    key = f"{file_hash(csv_path)[:16]}_v{CLEANING_VERSION}"
+    parquet_path = os.path.join(cache_dir, f"cleaned_{key}.parquet")
+    pickle_path = os.path.join(cache_dir, f"cleaned_{key}.pkl")
+    if os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path)
+    if os.path.exists(pickle_path):
+        return pd.read_pickle(pickle_path)
+
+    df_cleaned = clean_data(load_raw_data(csv_path))
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary name first so a crash never leaves a half written artifact behind.
+    try:
+        df_cleaned.to_parquet(parquet_path + '.tmp')
+        os.replace(parquet_path + '.tmp', parquet_path)
+    except ImportError:
+        # Parquet needs pyarrow (or fastparquet). Without it we still cache, just as a pickle.
+        df_cleaned.to_pickle(pickle_path + '.tmp')
+        os.replace(pickle_path + '.tmp', pickle_path)
+    return df_cleaned
+
+def _stack_features(df, encoder):
+    one_hot = encoder.transform(df[CATEGORICAL_COLUMNS])
+    numeric = sparse.csr_matrix(df[NUMERIC_COLUMNS].to_numpy(dtype=np.float32))
+    return sparse.hstack([numeric, one_hot], format='csr', dtype=np.float32)
+
+def fit_feature_encoder(df_cleaned):
+    """
+    Fit the one-hot encoder and the scaler that turn cleaned wine rows into KNN features
+    parameters:
+        df_cleaned (DataFrame): cleaned dataframe
+    returns:
+        feature_encoder (dict): the fitted 'encoder' (OneHotEncoder) and 'scaler' (StandardScaler)
+    """
+    # Categories that were not seen during fitting are encoded as all zeros instead of raising.
+    encoder = OneHotEncoder(handle_unknown='ignore', dtype=np.float32)
+    encoder.fit(df_cleaned[CATEGORICAL_COLUMNS])
+    # Centering would turn every zero of the one-hot matrix into a non-zero. Euclidean distances do not change
+    # when every row is shifted by the same mean, so scaling without centering gives the same neighbors.
+    scaler = StandardScaler(with_mean=False)
+    scaler.fit(_stack_features(df_cleaned, encoder))
+    return {'encoder': encoder, 'scaler': scaler}
+
+def build_features(df_cleaned, feature_encoder):
+    """
+    Encode cleaned wine rows into the scaled KNN feature matrix, kept sparse (CSR, float32) end to end
+    parameters:
+        df_cleaned (DataFrame): cleaned dataframe
+        feature_encoder (dict): fitted encoder returned by fit_feature_encoder or load_feature_encoder
+    returns:
+        scaled_data (csr_matrix): one row of features per wine
+    """
+    scaled_data = feature_encoder['scaler'].transform(_stack_features(df_cleaned, feature_encoder['encoder']))
+    return scaled_data.astype(np.float32)
+
+def save_feature_encoder(feature_encoder, path=FEATURE_ENCODER_PATH):
+    """
+    Save the fitted feature encoder so serving and evaluation can reuse it without fitting it again
+    parameters:
+        feature_encoder (dict): fitted encoder returned by fit_feature_encoder
+        path (str): where to write the encoder
+    """
+    with open(path, 'wb') as f:
+        pickle.dump(feature_encoder, f)
+
+def load_feature_encoder(path=FEATURE_ENCODER_PATH):
+    """
+    Load a feature encoder written by save_feature_encoder
+    parameters:
+        path (str): where the encoder was written
+    returns:
+        feature_encoder (dict): the fitted encoder
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def select_reference_wines(tasters, data, top_n=10):
+    """
+    Pick each taster's top_n wines by points as the reference wines of the evaluation, and build the lookup
+    that resolves a (taster, title) pair to the points that taster gave the wine
+    parameters:
+        tasters: list of unique taster_name in the original dataset
+        data: data that includes the points given to each wine by each taster
+        top_n: number of reference wines per taster
+    returns:
+        references (DataFrame): one row per reference wine with its row 'position' in data, its 'points' and
+            the index of its 'taster' in tasters, grouped per taster in the order of tasters
+        points_lookup (Series): points indexed by (taster index, title). When a taster rated the same title
+            more than once, the entry that sorts first by points is kept
+    """
+    taster_groups = dict(tuple(data.groupby('taster_name', sort=False, observed=True)))
+    references = []
+    lookups = []
+    for taster, name in enumerate(tasters):
+        if name not in taster_groups:
+            continue
+        group = taster_groups[name]
+        # Same order as the original loop: pandas' default sort of int64 points. Its order among equal points
+        # depends on the dtype, so compact (int16) points are compared as int64 to pick the same references.
+        voted_wines = group.loc[group['points'].astype(np.int64).sort_values(ascending=False).index]
+        top_wines = voted_wines.head(top_n)
+        references.append(pd.DataFrame({'position': top_wines.index, 'points': top_wines['points'].values,
+                                        'taster': taster}))
+        rated_titles = voted_wines.dropna(subset=['title']).drop_duplicates(subset='title')
+        lookups.append(pd.DataFrame({'taster': taster, 'title': rated_titles['title'].values,
+                                     'points': rated_titles['points'].values}))
+    if not references:
+        return pd.DataFrame(columns=['position', 'points', 'taster']), pd.Series(dtype=float)
+    references = pd.concat(references, ignore_index=True)
+    lookups = pd.concat(lookups, ignore_index=True)
+    points_lookup = pd.Series(lookups['points'].values, index=pd.MultiIndex.from_frame(lookups[['taster', 'title']]))
+    return references, points_lookup
+
+def score_recommendations(references, points_lookup, neighbor_titles, threshold=5):
+    """
+    For every reference wine, find which recommended wines the same taster also rated and what share of them
+    is within threshold points of the reference wine, then average those shares per taster
+    parameters:
+        references: reference wines returned by select_reference_wines
+        points_lookup: (taster, title) -> points lookup returned by select_reference_wines
+        neighbor_titles: 2D array with the titles of the recommended wines, one row per reference wine
+        threshold: maximum point difference for a recommendation to count as similar
+    returns: list with the average share per taster, in the order of tasters (tasters without any rated
+        recommendation are left out)
+    """
+    neighbor_titles = np.asarray(neighbor_titles, dtype=object)
+    if len(references) == 0 or neighbor_titles.size == 0:
+        return []
+    n_neighbors = neighbor_titles.shape[1]
+    query = pd.MultiIndex.from_arrays([np.repeat(references['taster'].values, n_neighbors), neighbor_titles.ravel()])
+    matches = points_lookup.index.get_indexer(query).reshape(neighbor_titles.shape)
+
+    rated = matches >= 0
+    neighbor_points = np.where(rated, points_lookup.values[matches], np.nan)
+    differences = np.abs(references['points'].values[:, None] - neighbor_points)
+    rated_counts = rated.sum(axis=1)
+    within_counts = (rated & (differences <= threshold)).sum(axis=1)
+
+    # The shares are averaged with plain Python floats, in the same order as the original loop, so the result
+    # is identical to the per-wine implementation.
+    final_percentages = []
+    for taster in pd.unique(references['taster']):
+        rows = np.flatnonzero((references['taster'].values == taster) & (rated_counts != 0))
+        tasters_differences = [int(within_counts[row]) / int(rated_counts[row]) for row in rows]
+        if len(tasters_differences) != 0:
+            final_percentages.append(sum(tasters_differences) / len(tasters_differences))
+    return final_percentages
+
+def recommend_neighbors(model, scaled_data, positions, n_neighbors=None):
+    """
+    Query the nearest wines of the wines at positions with a single batched kneighbors call, and drop the first
+    neighbor returned for each, which is the queried wine itself
+    parameters:
+        model: fitted NearestNeighbors model
+        scaled_data: the feature matrix the model was fitted on
+        positions: row positions of the query wines
+        n_neighbors: neighbors to query per wine, the wine itself included (defaults to the model's n_neighbors)
+    returns:
+        indices (ndarray): one row of n_neighbors - 1 row positions per query wine, nearest first
+    """
+    _, indices = model.kneighbors(scaled_data[positions], n_neighbors=n_neighbors)
+    return indices[:, 1:]
+
+def run_evaluation(model, tasters, data, scaled_data, threshold=5, top_n=10):
     """
     Run evaluation on model: for evaluation, we consider each taster's top 10 wines based on the points given.
     For each of the top 10, we look at the 5 closest neighbors as recommendations, and see what percentage of the 
-    recommended wines were within <5 points of the original top10 wine of each taster-- thus demonstrating similar interest
+    recommended wines were within <5 points of the original top10 wine of each taster-- thus demonstrating similar interest.
+    All reference wines are queried with a single batched kneighbors call.
 
     parameters:
         model: KNN trained model
         tasters: list of unique taster_name in the original dataset
         data: data that includes the points given to each wine by each taster
         scaled_data: the scaled data X used for unsupervising training of the KNN
+        threshold: maximum point difference for a recommendation to count as similar
+        top_n: number of reference wines per taster
     returns: percentage value of how often the recommended wines were within <5 points of original top-10 wine for each user
     """
-    final_percentages_recommended_less5difference = []
-    wine_names = data['title']
-    for name in tasters:
-        tasters_differences = []
-        voted_wines =  data[data['taster_name']==name]
-        voted_wines.sort_values(by='points', ascending=False, inplace = True)
-
-        voters_top_10 = voted_wines.head(10)
-        point_values = voters_top_10['points'].tolist()
-        indexes = voters_top_10.index.tolist()
-        for i in range(len(indexes)):
-            recommended_point_differences = []
-            index_value = indexes[i]
-            reference_index = index_value # Adjust as needed
-            reference_wine = scaled_data[reference_index].reshape(1, -1)  # Reshape to match the input format expected by kneighbors
-            _, indices = model.kneighbors(reference_wine)
-
-            nearest_neighbor_indices = indices[0]  # Indices of nearest neighbors
-            nearest_neighbor_names = wine_names.iloc[nearest_neighbor_indices]
-            nearest_neighbor_names = nearest_neighbor_names[1:]
-
-            #get the points
-            for nearest_neighbor_name in nearest_neighbor_names:
-                if nearest_neighbor_name in voted_wines['title'].values:
-                # Get the row where the name is present in the 'title' column
-                    row = voted_wines[voted_wines['title'] == nearest_neighbor_name]
-                # Get the points column value from the row
-                    difference = abs(point_values[i]-row['points'].values[0])
-                    recommended_point_differences.append(difference)
-            meets_threshold_count = 0
-            for x in recommended_point_differences:
-                if x<=5:
-                    meets_threshold_count+=1
-            if len(recommended_point_differences)!=0:
-                tasters_differences.append(meets_threshold_count/len(recommended_point_differences))
-        if len(tasters_differences)!=0:
-            final_percentages_recommended_less5difference.append(sum(tasters_differences)/len(tasters_differences))
-    return final_percentages_recommended_less5difference
+    references, points_lookup = select_reference_wines(tasters, data, top_n)
+    if len(references) == 0:
+        return []
+    neighbor_titles = data['title'].values[recommend_neighbors(model, scaled_data, references['position'].values)]
+    return score_recommendations(references, points_lookup, neighbor_titles, threshold)
 
 def main():
-    df_original = pd.read_csv('data/data_first10k.csv')
-    df_cleaned = clean_data(df_original)
-
-    data = pd.get_dummies(df_cleaned, columns=['country', 'designation', 'province', 'variety', 'winery' ])
+    df_cleaned = load_cleaned_data('data/data_first10k.csv')
 
-    scaler = StandardScaler()
-    X = data.drop(columns = ['title', 'taster_name', 'points'], axis=1)
-    scaled_data = scaler.fit_transform(X)
+    # One-hot encode the categorical columns and scale the features into a sparse matrix
+    feature_encoder = fit_feature_encoder(df_cleaned)
+    save_feature_encoder(feature_encoder)
+    scaled_data = build_features(df_cleaned, feature_encoder)
 
     k = 6  # Number of neighbors to consider
-    knn_model = NearestNeighbors(n_neighbors=k, metric='euclidean')  # You can use different metrics like 'cosine' for similarity
+    # Brute force search is the neighbor algorithm in scikit-learn that works directly on sparse input
+    knn_model = NearestNeighbors(n_neighbors=k, metric='euclidean', algorithm='brute')  # You can use different metrics like 'cosine' for similarity
     knn_model.fit(scaled_data)
 
-    tasters = data['taster_name'].unique().tolist()
+    tasters = df_cleaned['taster_name'].unique().tolist()
 
-    taster_percentages = run_evaluation(knn_model, tasters, data, scaled_data)
+    taster_percentages = run_evaluation(knn_model, tasters, df_cleaned, scaled_data)
     
     if len(taster_percentages)!=0:
         print(sum(taster_percentages)/len(taster_percentages) *100)
@@ -0,0 +1,279 @@
+"""
+Reproducible performance benchmarks that run without Atlas or OpenAI:
+
+    python scripts/benchmark.py --rows 100000
+    python scripts/benchmark.py --rows 100000 --compare data/bench/baseline.json
+
+The wine reviews in data_first10k.csv are replicated to the requested number of rows (cached under data/bench),
+MongoDB is replaced by the in-memory collection and the embedding models by the hash embedder of
+offline_stubs.py. Measured: clean_data, the KNN evaluation, ingestion throughput (full load and a no-change
+sync) and /find latency percentiles under concurrent load, with a cold and a warm query cache. The results are
+written as JSON, and --compare prints the change against an earlier run.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors
+from KNN import build_features, clean_data, fit_feature_encoder, load_raw_data, run_evaluation
+from offline_stubs import HashEmbedder, InMemoryClient
+from open_ai_embeddings import process_csv_file, sync_csv_file
+
+BENCH_DIR = 'data/bench'
+SUITES = ('clean_data', 'knn_eval', 'ingestion', 'find')
+# Taste words the /find queries are drawn from, like the tags of the frontend.
+CRITERIA = ['dry', 'sweet', 'red', 'white', 'fruity', 'oaky', 'crisp', 'bold', 'light', 'tannic', 'spicy',
+            'earthy', 'citrus', 'berry', 'cherry', 'vanilla', 'floral', 'mineral', 'smooth', 'acidic']
+
+
+def replicate_dataset(csv_path, rows, output_dir=BENCH_DIR):
+    """
+    Purpose: Write a copy of the wine reviews CSV scaled to the given number of rows, by repeating the file.
+    The titles of the copies get a " #<copy>" suffix, so recommendations can still tell copies apart.
+    Input: csv_path - The source CSV (data_first10k.csv).
+    Input: rows - The number of rows of the replicated file.
+    Input: output_dir - Where the replicated files are cached, one per source file version and row count.
+    Output: The path of the replicated CSV.
+    """
+    # The cache key covers which source file it was made from and its version, so another --csv or an edited
+    # source file never reuses a stale replica.
+    stat = os.stat(csv_path)
+    source_key = hashlib.sha256(f"{os.path.abspath(csv_path)}:{stat.st_mtime_ns}:{stat.st_size}".encode('utf-8'))
+    path = os.path.join(output_dir, f"wines_{rows}_{source_key.hexdigest()[:12]}.csv")
+    if os.path.exists(path):
+        return path
+    os.makedirs(output_dir, exist_ok=True)
+    source = pd.read_csv(csv_path)
+    tmp_path = path + '.tmp'
+    written = 0
+    copy = 0
+    # Written one copy at a time, so a million rows never have to be held in memory.
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        while written < rows:
+            part = source.head(rows - written).copy()
+            if copy:
+                part['title'] = part['title'].fillna('') + f" #{copy}"
+            part.to_csv(f, header=not copy, index=False)
+            written += len(part)
+            copy += 1
+    os.replace(tmp_path, path)
+    return path
+
+
+def _best_of(fn, repeat):
+    # The fastest of several runs is the least disturbed by other processes on the machine.
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def bench_clean_data(csv_path, repeat=3):
+    """
+    Purpose: Time reading the CSV (load_raw_data) and clean_data.
+    """
+    read_seconds, raw = _best_of(lambda: load_raw_data(csv_path), repeat)
+    clean_seconds, cleaned = _best_of(lambda: clean_data(raw), repeat)
+    return {'rows': len(raw), 'cleaned_rows': len(cleaned), 'read_seconds': read_seconds,
+            'clean_seconds': clean_seconds}
+
+
+def bench_knn_eval(csv_path, k=6):
+    """
+    Purpose: Time the stages of the KNN evaluation of KNN.py: feature encoding, fitting and run_evaluation.
+    """
+    data = clean_data(load_raw_data(csv_path))
+    started = time.perf_counter()
+    features = build_features(data, fit_feature_encoder(data))
+    features_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    model = NearestNeighbors(n_neighbors=k, metric='euclidean', algorithm='brute').fit(features)
+    fit_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    percentages = run_evaluation(model, data['taster_name'].unique().tolist(), data, features)
+    evaluation_seconds = time.perf_counter() - started
+    return {'rows': len(data), 'features_seconds': features_seconds, 'fit_seconds': fit_seconds,
+            'evaluation_seconds': evaluation_seconds,
+            'score': sum(percentages) / len(percentages) if percentages else None}
+
+
+def bench_ingestion(csv_path, embedder, batch_size=100, max_workers=4):
+    """
+    Purpose: Time a full ingestion into an empty in-memory collection, then a sync of the unchanged file. The
+    collection is the one the backend reads with MONGODB_URI=memory://, so bench_find can serve it afterwards.
+    """
+    client = InMemoryClient()
+    client.drop_database('BottleBuddy')
+    collection = client['BottleBuddy']['Wine']
+    # The ingestion functions print a line per batch, which would dominate the output and the timing.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        stored = process_csv_file(csv_path, collection, embed_fn=embedder, batch_size=batch_size,
+                                  max_workers=max_workers, resume=False, embedding_field='gist_embeddings')
+        ingest_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        summary = sync_csv_file(csv_path, collection, embed_fn=embedder, batch_size=batch_size,
+                                max_workers=max_workers, embedding_field='gist_embeddings')
+        sync_seconds = time.perf_counter() - started
+    return {'rows': stored, 'ingest_seconds': ingest_seconds, 'ingest_rows_per_second': stored / ingest_seconds,
+            'sync_seconds': sync_seconds, 'sync_rows_per_second': stored / sync_seconds,
+            'sync_unchanged': summary['unchanged']}
+
+
+def _latency_stats(latencies, wall_seconds):
+    latencies = 1000 * np.asarray(latencies)
+    return {'requests': len(latencies), 'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)), 'p99_ms': float(np.percentile(latencies, 99)),
+            'mean_ms': float(latencies.mean()), 'requests_per_second': len(latencies) / wall_seconds}
+
+
+def _load(app, queries, concurrency):
+    # One test client per thread; the Flask app itself is shared like under a threaded server.
+    local = threading.local()
+    errors = []
+
+    def send(criteria):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        started = time.perf_counter()
+        response = local.client.post('/find', json={'criteria': criteria})
+        if response.status_code != 200:
+            errors.append(response.status_code)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(send, queries))
+    stats = _latency_stats(latencies, time.perf_counter() - started)
+    stats['errors'] = len(errors)
+    return stats
+
+
+def bench_find(dim, n_requests=500, concurrency=8, vector_backend='mongo', seed=0):
+    """
+    Purpose: Measure /find latency under concurrent load against the collection filled by bench_ingestion.
+    The 'cold' run sends distinct criteria (query and embedding cache misses), the 'warm' run repeats them.
+    Input: dim - The dimension of the stored hash embeddings, the backend has to embed queries the same way.
+    """
+    import model_registry
+    model_registry.HASH_EMBEDDING_DIM = dim
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    # The backend reads its configuration when it is imported.
+    os.environ.update({'MONGODB_URI': 'memory://', 'EMBEDDING_BACKEND': 'hash', 'VECTOR_BACKEND': vector_backend,
+                       'EMBEDDING_CACHE_PATH': os.path.join(tempfile.mkdtemp(prefix='bench_'), 'embeddings.sqlite'),
+                       'QUERY_CACHE_SIZE': str(2 * n_requests)})
+    sys.path.append(os.path.join(scripts_dir, '..', 'demo', 'bb-backend'))
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        import app as backend
+    startup_seconds = time.perf_counter() - started
+
+    rng = random.Random(seed)
+    queries = []
+    seen = set()
+    while len(queries) < n_requests:
+        criteria = rng.sample(CRITERIA, rng.randint(1, 6))
+        if frozenset(criteria) not in seen:
+            seen.add(frozenset(criteria))
+            queries.append(criteria)
+
+    backend.query_cache.invalidate()
+    # /find prints every result list, which is not part of the request cost being measured.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        cold = _load(backend.app, queries, concurrency)
+        warm = _load(backend.app, queries, concurrency)
+    return {'vector_backend': vector_backend, 'concurrency': concurrency, 'startup_seconds': startup_seconds,
+            'cold': cold, 'warm': warm}
+
+
+def _flatten(results, prefix=''):
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(old, new):
+    """
+    Purpose: Print every numeric result of two benchmark runs side by side, with the relative change.
+    Input: old, new - Benchmark reports as written by this script.
+    """
+    if old['meta'].get('rows') != new['meta'].get('rows'):
+        print(f"Note: the runs used different row counts ({old['meta'].get('rows')} vs {new['meta'].get('rows')}).")
+    old_values = _flatten(old['results'])
+    new_values = _flatten(new['results'])
+    print(f"{'metric':<40} {'old':>12} {'new':>12} {'change':>8}")
+    for key, value in new_values.items():
+        if key not in old_values:
+            continue
+        change = f"{100 * (value - old_values[key]) / old_values[key]:+.1f}%" if old_values[key] else ''
+        print(f"{key:<40} {old_values[key]:>12.4g} {value:>12.4g} {change:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline offline on a replicated dataset.")
+    parser.add_argument('--csv', default='data/data_first10k.csv', help="CSV that is replicated")
+    parser.add_argument('--rows', type=int, default=100000, help="Rows of the replicated dataset (100k - 1M)")
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--dim', type=int, default=128,
+                        help="Dimension of the hash embeddings (kept small, the collection is held in memory)")
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4, help="Embedding threads of the ingestion")
+    parser.add_argument('--requests', type=int, default=500, help="/find requests per cache state")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent /find clients")
+    parser.add_argument('--vector-backend', default='mongo', help="VECTOR_BACKEND of the backend under test")
+    parser.add_argument('--output', default=None, help="Report path (default data/bench/benchmark_<rows>.json)")
+    parser.add_argument('--compare', default=None, help="Earlier report to compare the results with")
+    args = parser.parse_args()
+
+    if 'find' in args.suites and 'ingestion' not in args.suites:
+        parser.error("the find suite serves the collection filled by the ingestion suite")
+
+    csv_path = replicate_dataset(args.csv, args.rows)
+    report = {
+        'meta': {'rows': args.rows, 'csv': csv_path, 'dim': args.dim, 'started_at': time.time(),
+                 'python': platform.python_version(), 'platform': platform.platform(),
+                 'processor': platform.processor(), 'cpus': os.cpu_count(), 'numpy': np.__version__,
+                 'pandas': pd.__version__},
+        'results': {},
+    }
+    for suite in SUITES:
+        if suite not in args.suites:
+            continue
+        print(f"Running {suite} on {args.rows} rows...")
+        if suite == 'clean_data':
+            result = bench_clean_data(csv_path)
+        elif suite == 'knn_eval':
+            result = bench_knn_eval(csv_path)
+        elif suite == 'ingestion':
+            result = bench_ingestion(csv_path, HashEmbedder(args.dim), args.batch_size, args.workers)
+        else:
+            result = bench_find(args.dim, args.requests, args.concurrency, args.vector_backend)
+        report['results'][suite] = result
+        print(json.dumps(result, indent=2))
+
+    output = args.output or os.path.join(BENCH_DIR, f"benchmark_{args.rows}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote the report to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
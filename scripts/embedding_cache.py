@@ -0,0 +1,205 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import numpy as np
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'bottlebuddy', 'embeddings.sqlite')
+
+
+def normalize_text(text):
+    """
+    Purpose: Normalize text before it is hashed, so that the same wine text with different unicode forms or
+    stray whitespace maps to the same cache entry. Case is kept because the embedding models are case sensitive.
+    Input: text - The text to normalize.
+    """
+    return ' '.join(unicodedata.normalize('NFC', str(text)).split())
+
+
+def cache_key(model_name, text):
+    """
+    Purpose: Content-addressed key of an embedding: a hash of the model name and the normalized text.
+    Input: model_name - The name of the model that produced the embedding.
+    Input: text - The embedded text.
+    """
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode('utf-8')).digest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache stored in SQLite. Vectors are kept as float32 blobs keyed by cache_key, and the
+    least recently used entries are evicted once the cache grows past max_entries or max_bytes. The file can
+    be shared by several processes (the scripts and the backend workers).
+    Lookups only read: the last use of the hits is kept in memory and written with the next put_many (so before
+    any eviction), or once touch_flush_size hits or touch_flush_interval seconds have piled up.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=1_000_000, max_bytes=4 * 1024 ** 3,
+                 touch_flush_size=1000, touch_flush_interval=60.0):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes_since_check = 0
+        self.touch_flush_size = touch_flush_size
+        self.touch_flush_interval = touch_flush_interval
+        # key -> last time it was looked up, not written to the database yet
+        self._touched = {}
+        self._touches_flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # WAL lets other processes keep reading while one of them writes.
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key BLOB PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, model_name, texts):
+        """
+        Purpose: Look up the cached embeddings of the texts.
+        Input: model_name - The name of the model that produced the embeddings.
+        Input: texts - The texts to look up.
+        Output: A list with a float32 array for every hit and None for every miss.
+        """
+        keys = [cache_key(model_name, text) for text in texts]
+        found = {}
+        with self._lock:
+            # SQLite limits the number of bound parameters, so large batches are looked up in slices.
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update(rows)
+            now = time.time()
+            for key in found:
+                self._touched[key] = now
+            # A write transaction on every lookup makes the backend workers wait for each other's locks.
+            if len(self._touched) >= self.touch_flush_size or \
+                    time.monotonic() - self._touches_flushed_at >= self.touch_flush_interval:
+                self._flush_touches()
+                self._conn.commit()
+            hits = sum(key in found for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return [np.frombuffer(found[key], dtype=np.float32) if key in found else None for key in keys]
+
+    def put_many(self, model_name, texts, vectors):
+        """
+        Purpose: Store the embeddings of the texts and evict old entries if the cache is over its limits.
+        Input: model_name - The name of the model that produced the embeddings.
+        Input: texts - The embedded texts.
+        Input: vectors - One embedding per text.
+        """
+        now = time.time()
+        rows = [(cache_key(model_name, text), model_name, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                for text, vector in zip(texts, vectors)]
+        with self._lock:
+            self._flush_touches()
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+            # Counting the table is a full scan, so the limits are only checked every 1000 writes.
+            self._writes_since_check += len(rows)
+            if self._writes_since_check >= 1000:
+                self._writes_since_check = 0
+                self._evict()
+
+    def flush(self):
+        """
+        Purpose: Write the last use of the entries looked up since the last write.
+        """
+        with self._lock:
+            self._flush_touches()
+            self._conn.commit()
+
+    def _flush_touches(self):
+        # Part of the caller's transaction; the caller holds the lock and commits.
+        if self._touched:
+            self._conn.executemany("UPDATE embeddings SET last_used = MAX(last_used, ?) WHERE key = ?",
+                                   [(used, key) for key, used in self._touched.items()])
+            self._touched.clear()
+        self._touches_flushed_at = time.monotonic()
+
+    def _evict(self):
+        entries, size = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+        # Every vector of a model has the same size, so the byte limit can be turned into an entry limit.
+        average = size / entries
+        keep = min(self.max_entries, int(self.max_bytes / average))
+        # Evicting down to 90% of the limit means we do not pay for an eviction on every insert.
+        remove = entries - int(keep * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (remove,))
+        self._conn.commit()
+        self.evictions += remove
+
+    def embed(self, model_name, texts, embed_fn):
+        """
+        Purpose: Return the embeddings of the texts, computing only the ones that are not cached yet.
+        Input: model_name - The name of the model behind embed_fn.
+        Input: texts - The texts to embed.
+        Input: embed_fn - Function that takes a list of texts and returns a list of embeddings.
+        Output: A list with one float32 array per text.
+        """
+        vectors = self.get_many(model_name, texts)
+        missing = {}
+        for position, (text, vector) in enumerate(zip(texts, vectors)):
+            if vector is None:
+                # Duplicate texts in the same call are only embedded once.
+                missing.setdefault(normalize_text(text), []).append(position)
+        if missing:
+            new_texts = [texts[positions[0]] for positions in missing.values()]
+            new_vectors = [np.asarray(vector, dtype=np.float32) for vector in embed_fn(new_texts)]
+            self.put_many(model_name, new_texts, new_vectors)
+            for positions, vector in zip(missing.values(), new_vectors):
+                for position in positions:
+                    vectors[position] = vector
+        return vectors
+
+    def stats(self):
+        """
+        Purpose: Return the hit/miss counters of this process and the current size of the cache.
+        """
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size,
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Purpose: Return the process-wide cache. Its location and limits come from the EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_MAX_ENTRIES and EMBEDDING_CACHE_MAX_MB environment variables.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache(
+                path=os.getenv('EMBEDDING_CACHE_PATH', DEFAULT_CACHE_PATH),
+                max_entries=int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', 1_000_000)),
+                max_bytes=int(os.getenv('EMBEDDING_CACHE_MAX_MB', 4096)) * 1024 ** 2,
+            )
+        return _default_cache
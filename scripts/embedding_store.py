@@ -0,0 +1,350 @@
+import argparse
+import os
+import shutil
+import time
+import numpy as np
+from bson import json_util
+from pymongo import UpdateOne
+from filter_index import FilterIndex
+from vector_store import EMBEDDING_FIELDS, HASH_FIELDS, normalize_rows, top_k_indices
+
+# On-disk layout of an embedding store directory:
+#   index.json   - dtype, count, dim and the list of document ids. The vector of ids[i] is row i of
+#                  vectors.bin, at byte offset i * dim * itemsize. Written as MongoDB extended JSON, so ids
+#                  like ObjectId keep their type.
+#   vectors.bin  - contiguous row-major matrix of the unit-normalized vectors, float16 or int8.
+#   norms.npy    - float32 length of every original vector, so the original vectors can be rebuilt.
+#   scales.npy   - (int8 only) float32 per-vector scale: vector = codes * scale.
+#   documents.json - optional metadata (title, ...) of every row.
+STORE_DTYPES = ('float16', 'int8')
+
+
+def quantize(unit_vectors, dtype):
+    """
+    Purpose: Convert a block of unit-normalized float32 vectors to the storage dtype.
+    Input: unit_vectors - 2D float32 array of unit vectors.
+    Input: dtype - 'float16' or 'int8'. int8 uses symmetric scalar quantization with one scale per vector.
+    Output: (codes, scales) where scales is None for float16.
+    """
+    if dtype == 'float16':
+        return unit_vectors.astype(np.float16), None
+    scales = np.abs(unit_vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(unit_vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class EmbeddingStoreWriter:
+    """
+    Streams vectors into a new embedding store directory, one block at a time. The store is written to a
+    temporary directory next to path and only moved to path by close(), so a backend worker that (re)opens
+    path never sees half of an export.
+    """
+    def __init__(self, path, dtype='float16'):
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"dtype must be one of {STORE_DTYPES}")
+        self.final_path = path.rstrip(os.sep)
+        self.path = f"{self.final_path}.tmp-{os.getpid()}"
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self.dtype = dtype
+        self.dim = None
+        self.ids = []
+        self.norms = []
+        self.scales = []
+        self.documents = []
+        self._vectors = open(os.path.join(self.path, 'vectors.bin'), 'wb')
+
+    def add(self, ids, matrix, documents=None):
+        """
+        Purpose: Append a block of vectors.
+        Input: ids - One document id per row.
+        Input: matrix - 2D array of the original (not normalized) vectors.
+        Input: documents - Optional metadata dictionary per row.
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if self.dim is None:
+            self.dim = matrix.shape[1]
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got {matrix.shape[1]}")
+        codes, scales = quantize(normalize_rows(matrix), self.dtype)
+        self._vectors.write(codes.tobytes())
+        self.norms.append(np.linalg.norm(matrix, axis=1).astype(np.float32))
+        if scales is not None:
+            self.scales.append(scales)
+        self.ids.extend(ids)
+        if documents is not None:
+            self.documents.extend(documents)
+
+    def close(self):
+        self._vectors.close()
+        np.save(os.path.join(self.path, 'norms.npy'),
+                np.concatenate(self.norms) if self.norms else np.empty(0, np.float32))
+        if self.dtype == 'int8':
+            np.save(os.path.join(self.path, 'scales.npy'),
+                    np.concatenate(self.scales) if self.scales else np.empty(0, np.float32))
+        if self.documents:
+            with open(os.path.join(self.path, 'documents.json'), 'w') as f:
+                f.write(json_util.dumps(self.documents))
+        with open(os.path.join(self.path, 'index.json'), 'w') as f:
+            f.write(json_util.dumps({'dtype': self.dtype, 'count': len(self.ids), 'dim': self.dim or 0,
+                                     'ids': self.ids}))
+        # A directory cannot be renamed over a non-empty one, so the previous store is moved aside first. Workers
+        # that still map its files keep reading them until they reopen the store.
+        if os.path.exists(self.final_path):
+            old_path = f"{self.final_path}.old-{os.getpid()}"
+            os.rename(self.final_path, old_path)
+            os.rename(self.path, self.final_path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(self.path, self.final_path)
+
+
+def write_embedding_store(path, matrix, ids, documents=None, dtype='float16'):
+    """
+    Purpose: Write an in-memory embedding matrix as an embedding store directory.
+    Input: path - The directory to write.
+    Input: matrix - 2D array with one embedding per row.
+    Input: ids - One document id per row.
+    Input: documents - Optional metadata dictionary per row.
+    Input: dtype - 'float16' or 'int8'.
+    """
+    writer = EmbeddingStoreWriter(path, dtype)
+    writer.add(ids, matrix, documents)
+    writer.close()
+
+
+class EmbeddingStore:
+    """
+    Read-only view of an embedding store directory. vectors.bin is opened with mmap, so every process that
+    opens the same store shares one page-cached copy of it and nothing is deserialized up front.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json_util.loads(f.read())
+        self.dtype = index['dtype']
+        self.dim = index['dim']
+        self.ids = index['ids']
+        if index['count'] and self.dim:
+            self.codes = np.memmap(os.path.join(path, 'vectors.bin'), dtype=self.dtype, mode='r',
+                                   shape=(index['count'], self.dim))
+            mmap_mode = 'r'
+        else:
+            # An empty store has a zero-byte vectors.bin, which cannot be memory mapped.
+            self.codes = np.empty((0, self.dim), dtype=self.dtype)
+            mmap_mode = None
+        self.norms = np.load(os.path.join(path, 'norms.npy'), mmap_mode=mmap_mode)
+        self.scales = np.load(os.path.join(path, 'scales.npy'), mmap_mode=mmap_mode) if self.dtype == 'int8' else None
+        self._positions = None
+        documents_path = os.path.join(path, 'documents.json')
+        if os.path.exists(documents_path):
+            with open(documents_path) as f:
+                self.documents = json_util.loads(f.read())
+        else:
+            self.documents = [{'_id': doc_id} for doc_id in self.ids]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, doc_id):
+        """
+        Purpose: Return the row of the document id. The id -> row index is built on first use.
+        """
+        if self._positions is None:
+            self._positions = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        return self._positions[doc_id]
+
+    def unit_vectors(self, start=0, stop=None):
+        """
+        Purpose: Decode rows start:stop into unit-normalized float32 vectors.
+        """
+        block = np.asarray(self.codes[start:stop], dtype=np.float32)
+        if self.scales is not None:
+            block *= self.scales[start:stop, None]
+        return block
+
+    def get(self, doc_id):
+        """
+        Purpose: Return the (approximately) original float32 vector of a document.
+        """
+        row = self.position(doc_id)
+        return self.unit_vectors(row, row + 1)[0] * self.norms[row]
+
+    def search(self, embedding, k=5, block_size=65536, rows=None):
+        """
+        Purpose: Exact cosine top-k over the stored (quantized) vectors, scanned in blocks.
+        Input: embedding - The query embedding.
+        Input: k - The number of results.
+        Input: block_size - Rows decoded at a time; bounds the temporary memory of a query.
+        Input: rows - Optional sorted rows to restrict the search to (e.g. the candidates of a metadata filter).
+        Output: (rows, scores) ordered from best to worst.
+        """
+        if len(self) == 0:
+            # An empty export does not know the dimension of the vectors, so there is nothing to compare with.
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = normalize_rows(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+        if rows is not None:
+            # Only the candidate rows are read from the mapped file.
+            scores = np.asarray(self.codes[rows], dtype=np.float32) @ query
+            if self.scales is not None:
+                scores *= self.scales[rows]
+            best = top_k_indices(scores, k)
+            return rows[best], scores[best]
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, len(self), block_size):
+            scores = np.asarray(self.codes[start:start + block_size], dtype=np.float32) @ query
+            if self.scales is not None:
+                scores *= self.scales[start:start + block_size]
+            top = top_k_indices(scores, k)
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            keep = top_k_indices(best_scores, k)
+            best_rows, best_scores = best_rows[keep], best_scores[keep]
+        return best_rows, best_scores
+
+    def memory_bytes(self):
+        """
+        Purpose: Size of the vectors and per-vector arrays on disk (and in the page cache once touched).
+        """
+        size = self.codes.nbytes + self.norms.nbytes
+        if self.scales is not None:
+            size += self.scales.nbytes
+        return size
+
+
+class MmapVectorStore:
+    """
+    Vector store backend ('mmap') over an embedding store directory, for the backend workers.
+    """
+    tuning_knob = None
+
+    def __init__(self, path):
+        self.store = EmbeddingStore(path)
+        self.documents = self.store.documents
+        self.filter_index = FilterIndex(self.documents)
+
+    def __len__(self):
+        return len(self.store)
+
+    def search(self, embedding, k=5, filters=None):
+        rows, scores = self.store.search(embedding, k, rows=self.filter_index.candidates(filters))
+        return [dict(self.documents[row], score=float(score)) for row, score in zip(rows, scores)]
+
+    def search_many(self, embeddings, k=5, filters=None):
+        return [self.search(embedding, k, filters) for embedding in embeddings]
+
+
+def export_from_mongo(collection, path, field='gist_embeddings', dtype='float16', batch_size=10000):
+    """
+    Purpose: Export the embeddings stored on the MongoDB documents to an embedding store directory.
+    The collection is streamed, so the export never holds more than one batch of vectors in memory.
+    Input: collection - The MongoDB collection that holds the wine documents.
+    Input: path - The directory to write.
+    Input: field - The document field that holds the embedding.
+    Input: dtype - 'float16' or 'int8'.
+    Input: batch_size - The number of documents converted at a time.
+    """
+    writer = EmbeddingStoreWriter(path, dtype)
+    projection = {other: 0 for other in EMBEDDING_FIELDS + HASH_FIELDS if other != field}
+    ids, vectors, documents = [], [], []
+    for doc in collection.find({field: {'$exists': True}}, projection, batch_size=batch_size):
+        vectors.append(doc.pop(field))
+        ids.append(doc['_id'])
+        documents.append(doc)
+        if len(vectors) == batch_size:
+            writer.add(ids, vectors, documents)
+            ids, vectors, documents = [], [], []
+    if vectors:
+        writer.add(ids, vectors, documents)
+    writer.close()
+    print(f"Exported {len(writer.ids)} '{field}' vectors to {path} as {dtype}.")
+
+
+def import_to_mongo(path, collection, field='gist_embeddings', batch_size=1000):
+    """
+    Purpose: Write the vectors of an embedding store back onto the existing MongoDB documents with the same _id.
+    Documents are never created, so a vector whose document is gone does not turn into a document that only
+    holds the vector.
+    Input: path - The embedding store directory.
+    Input: collection - The MongoDB collection to update.
+    Input: field - The document field in which to store the embedding.
+    Input: batch_size - The number of documents per bulk_write.
+    Output: The number of vectors whose document was not found.
+    """
+    store = EmbeddingStore(path)
+    matched = 0
+    for start in range(0, len(store), batch_size):
+        vectors = store.unit_vectors(start, start + batch_size) * store.norms[start:start + batch_size, None]
+        operations = [UpdateOne({'_id': doc_id}, {'$set': {field: vector.tolist()}})
+                      for doc_id, vector in zip(store.ids[start:start + batch_size], vectors)]
+        matched += collection.bulk_write(operations, ordered=False).matched_count
+    missing = len(store) - matched
+    print(f"Imported {matched} vectors from {path} into '{field}'"
+          f"{f', {missing} had no matching document' if missing else ''}.")
+    return missing
+
+
+def evaluate_store(path, reference, n_queries=200, k=10, seed=0):
+    """
+    Purpose: Measure what the quantized store costs: its size against the float32 matrix, recall@k of its
+    top-k against exact float32 search, and the query latency.
+    Input: path - The embedding store directory.
+    Input: reference - The original float32 matrix, in the same row order as the store.
+    Input: n_queries - The number of stored vectors used as queries.
+    Input: k - The number of neighbors compared.
+    """
+    store = EmbeddingStore(path)
+    reference = normalize_rows(reference)
+    rng = np.random.default_rng(seed)
+    queries = reference[rng.choice(len(reference), min(n_queries, len(reference)), replace=False)]
+
+    recalls = []
+    started = time.perf_counter()
+    for query in queries:
+        rows, _ = store.search(query, k)
+        exact = top_k_indices(reference @ query, k)
+        recalls.append(len(set(rows.tolist()) & set(exact.tolist())) / k)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'dtype': store.dtype,
+        'count': len(store),
+        'dim': store.dim,
+        'store_bytes': store.memory_bytes(),
+        'float32_bytes': reference.nbytes,
+        'compression': reference.nbytes / store.memory_bytes(),
+        f'recall@{k}': float(np.mean(recalls)),
+        # Includes the exact float32 search used as ground truth
+        'ms_per_query': 1000 * elapsed / len(queries),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export, import and evaluate compact embedding stores.")
+    parser.add_argument('command', choices=['export', 'import', 'evaluate'])
+    parser.add_argument('path', help="The embedding store directory.")
+    parser.add_argument('--field', default='gist_embeddings')
+    parser.add_argument('--dtype', choices=STORE_DTYPES, default='float16')
+    args = parser.parse_args()
+
+    from open_ai_embeddings import get_database, mark_collection_updated
+    from vector_store import load_embeddings_from_mongo
+
+    db = get_database()
+    if db is not None:
+        collection = db['Wine']
+        if args.command == 'export':
+            export_from_mongo(collection, args.path, args.field, args.dtype)
+            # Backends serving the store (VECTOR_BACKEND=mmap) reopen it when the collection marker changes.
+            mark_collection_updated(collection)
+        elif args.command == 'import':
+            import_to_mongo(args.path, collection, args.field)
+        else:
+            matrix, documents = load_embeddings_from_mongo(collection, args.field)
+            # Line the reference rows up with the row order of the store
+            rows = {str(doc['_id']): row for row, doc in enumerate(documents)}
+            store_ids = EmbeddingStore(args.path).ids
+            print(evaluate_store(args.path, matrix[[rows[str(doc_id)] for doc_id in store_ids]]))
@@ -3,7 +3,8 @@ import certifi
 import pymongo.errors as mongo_errors
 import pandas as pd
 import openai
-from sentence_transformers import SentenceTransformer
+from embedding_cache import get_default_cache
+from model_registry import GIST_MODEL_NAME, encode_many
 
 # Here we create the openai object and set the API key so that we can use the OpenAI API.
 openai.api_key = 'your_openai_api_key'
@@ -58,22 +59,17 @@ def store_row_with_embedding(custom_id, title, description, collection):
     # is added to the MongoDB collection.
     print(f"Content with title '{title}' has been successfully stored in MongoDB with ID {custom_id}.")
 
-def generate_gist_embedding(user_data, model_name='avsolatorio/GIST-Embedding-v0'):
+def generate_gist_embedding(user_data, model_name=GIST_MODEL_NAME):
     """
     Purpose: Generate an embedding for the given user_data using the specified model.
     Input: user_data - The user_data for which an embedding is to be generated.
     Input: model_name - The model to use for generating the embedding.
     """
-    # Initialize the SentenceTransformer
-    model = SentenceTransformer(model_name)
+    # The model is loaded once per process by the model registry, and cached texts skip the model entirely.
+    embedding = encode_many([user_data], model_name=model_name)[0]
 
-    # Embed the query
-    embedding = model.encode([user_data], convert_to_tensor=True)
-
-    # Convert embedded query tensor to list before querying the index
-    embedding = embedding[0].squeeze().tolist()
-
-    return embedding
+    # Convert embedded query to list before querying the index
+    return embedding.tolist()
 
 def generate_openai_embedding(text, model="text-embedding-ada-002"):
     """
@@ -81,11 +77,14 @@ def generate_openai_embedding(text, model="text-embedding-ada-002"):
     Input: text - The text for which an embedding is to be generated.
     Input: model - The model to use for generating the embedding.
     """
-    #client = openai.Client(OPENAI_API_KEY)
-    openai.api_key = 'your-openai-api-key'
-    response = openai.Embedding.create(input=text, model=model)
-    embedding = response['data'][0]['embedding']
-    return embedding
+    def request_embeddings(texts):
+        #client = openai.Client(OPENAI_API_KEY)
+        openai.api_key = 'your-openai-api-key'
+        response = openai.Embedding.create(input=texts, model=model)
+        return [item['embedding'] for item in sorted(response['data'], key=lambda item: item['index'])]
+
+    # Only texts that are not in the embedding cache yet are sent to the API.
+    return get_default_cache().embed(model, [text], request_embeddings)[0].tolist()
 
 def fetch_data(embedding, name, k=5):
     """
@@ -123,23 +122,24 @@ def run_evaluation(tasters, data, points):
     returns: percentage value of how often the recommended wines were within <5 points of original top-10 wine for each user
     """
     final_percentages_recommended_less5difference = []
-    wine_names = data['title']
+
+    # Collect the top 10 wines of every taster first, so all reference wines are embedded in one batched pass
+    # instead of one model call per wine.
+    taster_wines = []
     for name in tasters:
-        tasters_differences = []
         voted_wines =  data[data['taster_name']==name]
-        voted_wines.sort_values(by='points', ascending=False, inplace = True)
+        voted_wines = voted_wines.sort_values(by='points', ascending=False)
+        taster_wines.append((voted_wines, voted_wines.head(10)))
+    reference_descriptions = [description for _, top in taster_wines for description in top['description']]
+    reference_embeddings = iter(encode_many(reference_descriptions))
 
-        voters_top_10 = voted_wines.head(10)
+    for voted_wines, voters_top_10 in taster_wines:
+        tasters_differences = []
         point_values = voters_top_10['points'].tolist()
         indexes = voters_top_10.index.tolist()
         for i in range(len(indexes)):
             recommended_point_differences = []
-            index_value = indexes[i]
-            reference_index = index_value # Adjust as needed
-            reference_wine = data.loc[reference_index]['description']
-            # reference_wine = scaled_data[reference_index].reshape(1, -1)  # Reshape to match the input format expected by kneighbors
-            # _, indices = model.kneighbors(reference_wine)
-            reference_desc = generate_gist_embedding(reference_wine)
+            reference_desc = next(reference_embeddings).tolist()
             gist_results = fetch_data(reference_desc, 'gist', 10)
             results_list = []
             for result in gist_results:
@@ -173,7 +173,7 @@ if __name__ == "__main__":
         collection = db['Wine']
 
         # Set up data for evaluation
-        df = pd.read_csv('/content/data_first10k.csv')
+        df = pd.read_csv('data/data_first10k.csv')
         data = pd.get_dummies(df, columns=['country', 'designation', 'province', 'variety', 'winery' ])
         tasters = data['taster_name'].unique().tolist()
 
@@ -0,0 +1,227 @@
+import argparse
+import itertools
+import json
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+from KNN import RAW_DTYPES, build_features, clean_data, fit_feature_encoder, recommend_neighbors, \
+    score_recommendations, select_reference_wines
+from vector_store import exact_top_k, normalize_rows
+
+# Models that have their own embedding function below. Any other name is treated as a SentenceTransformer model
+# name and embedded through the model registry, e.g. 'avsolatorio/GIST-Embedding-v0'.
+# 'knn' is the one-hot/price feature matrix of KNN.py (euclidean distance), all others are compared by cosine.
+BUILTIN_MODELS = ('knn', 'gist', 'openai', 'doc2vec', 'spacy', 'stub')
+
+RESULT_COLUMNS = ['model', 'k', 'threshold', 'top_n', 'score', 'taster_scores', 'n_tasters', 'wall_seconds',
+                  'embed_seconds']
+
+# Per worker process: the dataset, the memory mapped model matrices and the neighbor indexes fitted on the
+# sparse ones, loaded once and shared by every run the worker executes.
+_shared_dir = None
+_shared_data = None
+_shared_matrices = {}
+_shared_neighbor_indexes = {}
+
+
+def load_dataset(csv_path):
+    """
+    Purpose: Load and clean the wine reviews once for every run, keeping the descriptions the embedding models need.
+    Input: csv_path - Path to the wine reviews CSV.
+    Output: (cleaned DataFrame, list of descriptions aligned with its rows)
+    """
+    raw = pd.read_csv(csv_path, usecols=list(RAW_DTYPES) + ['description'], dtype=RAW_DTYPES)
+    # clean_data drops the description and resets the index, so the source row is carried through explicitly.
+    raw['source_row'] = np.arange(len(raw))
+    data = clean_data(raw)
+    descriptions = raw['description'].fillna('').values[data['source_row'].values].tolist()
+    return data.drop(columns='source_row'), descriptions
+
+
+def _tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def embed_dataset(model, data, descriptions):
+    """
+    Purpose: Compute the matrix a model compares wines with, one row per wine.
+    Input: model - One of BUILTIN_MODELS or a SentenceTransformer model name.
+    Input: data - The cleaned dataset.
+    Input: descriptions - The wine descriptions, aligned with data.
+    Output: A sparse feature matrix for 'knn', otherwise a unit-normalized float32 matrix.
+    """
+    if model == 'knn':
+        return build_features(data, fit_feature_encoder(data))
+    if model == 'openai':
+        from open_ai_embeddings import embed_with_retry, generate_embeddings
+        batches = [descriptions[i:i + 100] for i in range(0, len(descriptions), 100)]
+        matrix = np.vstack([np.asarray(embed_with_retry(generate_embeddings, batch), dtype=np.float32)
+                            for batch in batches])
+    elif model == 'stub':
+        # Deterministic fake embeddings, to try the runner without a model or an API key.
+        from open_ai_embeddings import generate_stub_embeddings
+        matrix = np.asarray(generate_stub_embeddings(descriptions, dim=256), dtype=np.float32)
+    elif model == 'doc2vec':
+        # Trained on the evaluated descriptions, as in notebooks/doc2vec.ipynb.
+        from gensim.models.doc2vec import Doc2Vec, TaggedDocument
+        documents = [TaggedDocument(_tokenize(text), [i]) for i, text in enumerate(descriptions)]
+        doc2vec = Doc2Vec(documents, vector_size=100, min_count=2, epochs=40, workers=1, seed=0)
+        matrix = np.vstack([doc2vec.dv[i] for i in range(len(documents))])
+    elif model == 'spacy':
+        import spacy
+        nlp = spacy.load(os.getenv('SPACY_MODEL', 'en_core_web_lg'), disable=['parser', 'ner', 'lemmatizer'])
+        matrix = np.vstack([doc.vector for doc in nlp.pipe(descriptions, batch_size=256)])
+    else:
+        from model_registry import GIST_MODEL_NAME, encode_many
+        matrix = encode_many(descriptions, model_name=GIST_MODEL_NAME if model == 'gist' else model)
+    return normalize_rows(matrix)
+
+
+def _matrix_path(model):
+    return os.path.join(_shared_dir, re.sub(r'[^\w.-]', '_', model))
+
+
+def _init_worker(shared_dir):
+    global _shared_dir, _shared_data
+    _shared_dir = shared_dir
+    _shared_data = pd.read_pickle(os.path.join(shared_dir, 'data.pkl'))
+
+
+def _load_matrix(model):
+    if model not in _shared_matrices:
+        path = _matrix_path(model)
+        if os.path.exists(path + '.npz'):
+            _shared_matrices[model] = sparse.load_npz(path + '.npz')
+        else:
+            # Memory mapped, so all workers share one page cached copy of the embeddings.
+            _shared_matrices[model] = np.load(path + '.npy', mmap_mode='r')
+    return _shared_matrices[model]
+
+
+def fit_neighbor_index(matrix):
+    """
+    Purpose: Fit the euclidean NearestNeighbors index of a sparse feature matrix. The number of neighbors is
+    passed per query, so one index serves every k of the grid.
+    """
+    return NearestNeighbors(metric='euclidean', algorithm='brute').fit(matrix)
+
+
+def _load_neighbor_index(model):
+    matrix = _load_matrix(model)
+    if not sparse.issparse(matrix):
+        return None
+    if model not in _shared_neighbor_indexes:
+        _shared_neighbor_indexes[model] = fit_neighbor_index(matrix)
+    return _shared_neighbor_indexes[model]
+
+
+def nearest_neighbors(matrix, positions, k, index=None):
+    """
+    Purpose: The k nearest wines of the wines at positions, the wine itself left out.
+    Input: index - For a sparse matrix, its index from fit_neighbor_index (fitted here when not given).
+    Output: 2D array of row positions, one row per query position. When the matrix has fewer than k other
+            wines, the missing neighbors are -1.
+    """
+    if sparse.issparse(matrix):
+        # The KNN.py features: same neighbors as KNN.run_evaluation, which drops the first one kneighbors returns.
+        index = index if index is not None else fit_neighbor_index(matrix)
+        found = recommend_neighbors(index, matrix, positions, min(k + 1, matrix.shape[0]))
+    else:
+        indices, _ = exact_top_k(matrix, matrix[positions], k + 1)
+        # Drop the wine itself. Exact duplicates may come back before it, so drop it by position, not by rank.
+        found = [candidates[candidates != position][:k] for position, candidates in zip(positions, indices)]
+    neighbors = np.full((len(positions), k), -1, dtype=np.int64)
+    for row, candidates in enumerate(found):
+        neighbors[row, :len(candidates)] = candidates
+    return neighbors
+
+
+def run_one(model, k, threshold, top_n):
+    """
+    Purpose: Evaluate one grid point in a worker process, using the shared dataset and embeddings.
+    Output: A dictionary with the RESULT_COLUMNS except embed_seconds.
+    """
+    started = time.perf_counter()
+    data = _shared_data
+    tasters = data['taster_name'].unique().tolist()
+    references, points_lookup = select_reference_wines(tasters, data, top_n)
+    percentages = []
+    if len(references):
+        neighbors = nearest_neighbors(_load_matrix(model), references['position'].values, k,
+                                      _load_neighbor_index(model))
+        # A missing neighbor (-1) has no title, so it never counts as a rated recommendation.
+        titles = np.where(neighbors >= 0, data['title'].values[neighbors], None)
+        percentages = score_recommendations(references, points_lookup, titles, threshold)
+    return {
+        'model': model,
+        'k': k,
+        'threshold': threshold,
+        'top_n': top_n,
+        'score': sum(percentages) / len(percentages) if percentages else float('nan'),
+        'taster_scores': json.dumps(percentages),
+        'n_tasters': len(percentages),
+        'wall_seconds': time.perf_counter() - started,
+    }
+
+
+def run_grid(csv_path, models, ks, thresholds, top_ns, max_workers=None):
+    """
+    Purpose: Evaluate every (model, k, threshold, top_n) combination. The dataset is cleaned and every model's
+    embeddings are computed once, written to a temporary directory, and shared by the runs, which are fanned
+    out over a process pool.
+    Input: csv_path - Path to the wine reviews CSV.
+    Input: models, ks, thresholds, top_ns - The values of the grid.
+    Input: max_workers - Number of worker processes (defaults to the number of CPUs).
+    Output: DataFrame with one row per run, see RESULT_COLUMNS.
+    """
+    global _shared_dir
+    data, descriptions = load_dataset(csv_path)
+    embed_seconds = {}
+    results = []
+    with tempfile.TemporaryDirectory(prefix='eval_runner_') as shared_dir:
+        data.to_pickle(os.path.join(shared_dir, 'data.pkl'))
+        _shared_dir = shared_dir
+        for model in models:
+            started = time.perf_counter()
+            matrix = embed_dataset(model, data, descriptions)
+            if sparse.issparse(matrix):
+                sparse.save_npz(_matrix_path(model) + '.npz', matrix)
+            else:
+                np.save(_matrix_path(model) + '.npy', matrix)
+            embed_seconds[model] = time.perf_counter() - started
+            print(f"Embedded {len(data)} wines with '{model}' in {embed_seconds[model]:.1f}s")
+
+        grid = list(itertools.product(models, ks, thresholds, top_ns))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(shared_dir,)) as executor:
+            futures = [executor.submit(run_one, *point) for point in grid]
+            for future in as_completed(futures):
+                result = future.result()
+                result['embed_seconds'] = embed_seconds[result['model']]
+                results.append(result)
+    results = pd.DataFrame(results, columns=RESULT_COLUMNS)
+    return results.sort_values(['model', 'k', 'threshold', 'top_n'], ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate a grid of embedding models and KNN parameters.")
+    parser.add_argument('--csv', default='data/data_first10k.csv', help="Wine reviews CSV")
+    parser.add_argument('--models', nargs='+', default=['knn', 'gist'],
+                        help=f"Models to compare: {', '.join(BUILTIN_MODELS)} or a SentenceTransformer name")
+    parser.add_argument('--k', nargs='+', type=int, default=[5], help="Recommendations per reference wine")
+    parser.add_argument('--thresholds', nargs='+', type=float, default=[5], help="Point difference thresholds")
+    parser.add_argument('--top-n', nargs='+', type=int, default=[10], help="Reference wines per taster")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes")
+    parser.add_argument('--output', default='data/eval_results.csv', help="Where to write the results table")
+    args = parser.parse_args()
+
+    results = run_grid(args.csv, args.models, args.k, args.thresholds, args.top_n, args.workers)
+    results.to_csv(args.output, index=False)
+    print(results.drop(columns='taster_scores').to_string(index=False))
+    print(f"Wrote {len(results)} runs to {args.output}")
@@ -0,0 +1,141 @@
+import numpy as np
+
+# Metadata the recommendation queries can filter on. Categorical columns match one value or a list of values
+# (exactly, as stored, like the MongoDB filter), range columns take {"min": ..., "max": ...} (both ends
+# inclusive, either one optional).
+CATEGORICAL_FILTERS = ('country', 'province', 'variety')
+RANGE_FILTERS = ('price', 'points')
+# Internal filter that restricts a search to a set of document IDs (e.g. the candidates of the lexical index).
+# It is not accepted from requests, parse_filters rejects it.
+ID_FILTER = '_id'
+
+
+def parse_filters(filters):
+    """
+    Purpose: Validate a filter specification and bring it into a canonical form.
+    Input: filters - e.g. {"price": {"max": 30}, "province": "Oregon", "variety": ["Pinot Noir"]}, or None.
+    Output: A dictionary {column: tuple of values} for categorical columns and
+            {column: (min, max)} for range columns, or None when there is nothing to filter on.
+    Raises ValueError for unknown columns or malformed values.
+    """
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    parsed = {}
+    for column, value in filters.items():
+        if column in CATEGORICAL_FILTERS:
+            values = value if isinstance(value, list) else [value]
+            if not values or not all(isinstance(v, str) for v in values):
+                raise ValueError(f"'{column}' must be a string or a list of strings")
+            # The only normalization: every backend and the cache key see the same stripped values.
+            parsed[column] = tuple(sorted({v.strip() for v in values}))
+        elif column in RANGE_FILTERS:
+            if not isinstance(value, dict) or not set(value) <= {'min', 'max'}:
+                raise ValueError(f"'{column}' must be an object with 'min' and/or 'max'")
+            bounds = []
+            for key, default in (('min', -np.inf), ('max', np.inf)):
+                bound = value.get(key)
+                if bound is None:
+                    bounds.append(default)
+                elif isinstance(bound, (int, float)) and not isinstance(bound, bool):
+                    bounds.append(float(bound))
+                else:
+                    raise ValueError(f"'{column}.{key}' must be a number")
+            # Without a bound there is nothing to filter on (the MongoDB filter would not have a clause either).
+            if np.isfinite(bounds).any():
+                parsed[column] = tuple(bounds)
+        else:
+            raise ValueError(f"Cannot filter on '{column}'. Choose from "
+                             f"{', '.join(CATEGORICAL_FILTERS + RANGE_FILTERS)}.")
+    return parsed or None
+
+
+def filters_key(parsed):
+    """
+    Purpose: Hashable form of parsed filters, used in cache keys.
+    """
+    return tuple(sorted(parsed.items())) if parsed else ()
+
+
+def filters_to_mongo(parsed):
+    """
+    Purpose: Translate parsed filters into the MQL 'filter' of a $vectorSearch stage. The Atlas index has to
+    declare these fields (and _id, for the lexical candidates) as filter fields.
+    """
+    if not parsed:
+        return None
+    clauses = []
+    for column, value in parsed.items():
+        if column in CATEGORICAL_FILTERS or column == ID_FILTER:
+            clauses.append({column: {'$in': list(value)}})
+        else:
+            low, high = value
+            bounds = {}
+            if np.isfinite(low):
+                bounds['$gte'] = low
+            if np.isfinite(high):
+                bounds['$lte'] = high
+            if bounds:
+                clauses.append({column: bounds})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {'$and': clauses}
+
+
+class FilterIndex:
+    """
+    Precomputed filter structures over the documents of a vector store: one packed bitmap per value of every
+    categorical column, and the positions of every range column sorted by value. A query combines them with
+    bitwise AND into the candidate rows before any vector is scored.
+    """
+    def __init__(self, documents):
+        self.size = len(documents)
+        self.rows_by_id = {str(doc.get('_id')): row for row, doc in enumerate(documents)}
+        self.bitmaps = {}
+        self.sorted_ranges = {}
+        for column in CATEGORICAL_FILTERS:
+            rows_by_value = {}
+            for row, doc in enumerate(documents):
+                value = doc.get(column)
+                if isinstance(value, str):
+                    rows_by_value.setdefault(value, []).append(row)
+            self.bitmaps[column] = {value: self._bitmap(rows) for value, rows in rows_by_value.items()}
+        for column in RANGE_FILTERS:
+            # Like MongoDB comparisons, only numbers fall in a range: not missing values, text or booleans.
+            values = np.array([value if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan
+                               for value in (doc.get(column) for doc in documents)], dtype=np.float64)
+            rows = np.flatnonzero(~np.isnan(values))
+            order = np.argsort(values[rows], kind='stable')
+            self.sorted_ranges[column] = (values[rows][order], rows[order])
+
+    def _bitmap(self, rows):
+        bits = np.zeros(self.size, dtype=bool)
+        bits[rows] = True
+        return np.packbits(bits)
+
+    def candidates(self, parsed):
+        """
+        Purpose: Return the sorted row positions that pass every filter, or None when there are no filters.
+        Input: parsed - Filters returned by parse_filters.
+        """
+        if not parsed:
+            return None
+        combined = None
+        for column, value in parsed.items():
+            if column == ID_FILTER:
+                rows = [self.rows_by_id[str(doc_id)] for doc_id in value if str(doc_id) in self.rows_by_id]
+                bitmap = self._bitmap(rows)
+            elif column in CATEGORICAL_FILTERS:
+                empty = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+                bitmap = empty
+                for v in value:
+                    bitmap = bitmap | self.bitmaps[column].get(v, empty)
+            else:
+                sorted_values, rows = self.sorted_ranges[column]
+                low, high = value
+                start = np.searchsorted(sorted_values, low, side='left')
+                stop = np.searchsorted(sorted_values, high, side='right')
+                bitmap = self._bitmap(rows[start:stop])
+            combined = bitmap if combined is None else combined & bitmap
+        return np.flatnonzero(np.unpackbits(combined, count=self.size))
@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+from filter_index import ID_FILTER
+from vector_store import top_k_indices
+
+# Ways /find can combine the lexical index with the vector search:
+#   dense  - vector search only (the original behaviour)
+#   prune  - score only the lexical top candidates with the dense vectors
+#   hybrid - fuse the lexical and the dense ranking with reciprocal rank fusion
+SEARCH_MODES = ('dense', 'prune', 'hybrid')
+# Constant of reciprocal rank fusion; larger values flatten the difference between the top ranks.
+RRF_K = 60
+
+_token_pattern = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """
+    Purpose: Split a text into lowercase word tokens.
+    """
+    return _token_pattern.findall(text.lower()) if isinstance(text, str) else []
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index. The postings are stored in CSR layout: the documents and term frequencies of term t
+    are doc_rows[offsets[t]:offsets[t + 1]] and term_freqs[offsets[t]:offsets[t + 1]], so a query only touches
+    the postings of its own terms.
+    """
+    def __init__(self, ids, vocabulary, offsets, doc_rows, term_freqs, doc_lengths, k1=1.2, b=0.75):
+        self.ids = list(ids)
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_rows = doc_rows
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        n = len(self.ids)
+        document_freqs = np.diff(offsets)
+        self.idf = np.log(1 + (n - document_freqs + 0.5) / (document_freqs + 0.5)).astype(np.float32)
+        # The length normalisation of BM25 only depends on the document, so it is computed once.
+        average_length = doc_lengths.mean() if n else 0.0
+        self.length_norm = (k1 * (1 - b + b * doc_lengths / max(average_length, 1e-9))).astype(np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids, texts, **params):
+        """
+        Purpose: Build the index.
+        Input: ids - The document ID of every text (the MongoDB _id).
+        Input: texts - The indexed text of every document.
+        Input: params - BM25 parameters k1 and b.
+        """
+        vocabulary = {}
+        term_ids = []
+        rows = []
+        freqs = []
+        doc_lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[row] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                term_ids.append(vocabulary.setdefault(token, len(vocabulary)))
+                rows.append(row)
+                freqs.append(count)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)))))
+        return cls(ids, vocabulary, offsets, np.asarray(rows, dtype=np.int32)[order],
+                   np.asarray(freqs, dtype=np.float32)[order], doc_lengths, **params)
+
+    def scores(self, query):
+        """
+        Purpose: BM25 score of every document for a query text.
+        Output: float32 array with one score per document, 0 for documents without any query term.
+        """
+        scores = np.zeros(len(self), dtype=np.float32)
+        for token in set(tokenize(query)):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, stop = self.offsets[term], self.offsets[term + 1]
+            rows = self.doc_rows[start:stop]
+            freqs = self.term_freqs[start:stop]
+            # Every document appears at most once in the postings of a term, so fancy-index += is safe.
+            scores[rows] += self.idf[term] * freqs * (self.k1 + 1) / (freqs + self.length_norm[rows])
+        return scores
+
+    def top(self, query, n=100):
+        """
+        Purpose: The n best matching document IDs and their scores. Documents without a query term are left out.
+        """
+        scores = self.scores(query)
+        best = top_k_indices(scores, n)
+        best = best[scores[best] > 0]
+        return [self.ids[row] for row in best], scores[best]
+
+    def save(self, path):
+        """
+        Purpose: Write the index to a .npz file. It is written to a temporary name first, so a backend that
+        reloads the index never reads a half written file.
+        """
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, offsets=self.offsets, doc_rows=self.doc_rows, term_freqs=self.term_freqs,
+                     doc_lengths=self.doc_lengths, params=np.array([self.k1, self.b]),
+                     vocabulary=json.dumps(self.vocabulary), ids=json.dumps(self.ids))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Purpose: Read an index written by save.
+        """
+        with np.load(path) as data:
+            k1, b = data['params'].tolist()
+            return cls(json.loads(str(data['ids'])), json.loads(str(data['vocabulary'])), data['offsets'],
+                       data['doc_rows'], data['term_freqs'], data['doc_lengths'], k1=k1, b=b)
+
+
+def build_lexical_index(csv_path, chunk_size=10000, ids=None):
+    """
+    Purpose: Build the index over title + description of the wine reviews CSV.
+    Input: ids - The document ID of every row. Defaults to the row positions, the custom _id the ingestion
+                 script gives every row; a sync keeps the _id of rows that moved, so it passes the IDs.
+    """
+    texts = []
+    for chunk in pd.read_csv(csv_path, usecols=['title', 'description'], chunksize=chunk_size):
+        texts.extend((chunk['title'].fillna('') + " " + chunk['description'].fillna('')).tolist())
+    return LexicalIndex.build(range(len(texts)) if ids is None else ids, texts)
+
+
+def lexical_search(store, index, embedding, query, k=5, mode='dense', filters=None, candidates=100):
+    """
+    Purpose: Vector search combined with the lexical index.
+    Input: store - The vector store (see vector_store.get_vector_store).
+    Input: index - The LexicalIndex over the same documents (unused in 'dense' mode).
+    Input: embedding - The query embedding.
+    Input: query - The query text matched against the index.
+    Input: k - The number of documents to return.
+    Input: mode - One of SEARCH_MODES.
+    Input: filters - Parsed metadata filters (see filter_index.parse_filters).
+    Input: candidates - The number of lexical (and, in 'hybrid' mode, dense) candidates.
+    Output: The k best documents. Queries without any indexed term fall back to the dense search.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode '{mode}'. Choose from {', '.join(SEARCH_MODES)}.")
+    lexical_ids, lexical_scores = ([], []) if mode == 'dense' else index.top(query, max(candidates, k))
+    if not lexical_ids:
+        return store.search(embedding, k, filters)
+
+    # The lexical candidates are passed to the store as an ID filter, so only their vectors are scored.
+    restricted = dict(filters or {}, **{ID_FILTER: tuple(lexical_ids)})
+    if mode == 'prune':
+        results = store.search(embedding, k, restricted)
+        if len(results) < k:
+            # The candidates are picked before the metadata filters, so few of them may pass; top up with dense.
+            seen = {str(doc['_id']) for doc in results}
+            results += [doc for doc in store.search(embedding, k, filters) if str(doc['_id']) not in seen]
+        return results[:k]
+
+    # Hybrid: the dense top candidates plus the dense scores of the lexical candidates, ranked both ways.
+    documents = {}
+    for doc in store.search(embedding, max(candidates, k), filters) + store.search(embedding, len(lexical_ids),
+                                                                                   restricted):
+        documents[str(doc['_id'])] = doc
+    lexical_rank = {str(doc_id): rank for rank, doc_id in enumerate(lexical_ids)}
+    lexical_score = dict(zip(map(str, lexical_ids), lexical_scores.tolist()))
+    dense_order = sorted(documents, key=lambda doc_id: -documents[doc_id]['score'])
+    fused = {}
+    for rank, doc_id in enumerate(dense_order):
+        fused[doc_id] = 1 / (RRF_K + rank)
+        if doc_id in lexical_rank:
+            fused[doc_id] += 1 / (RRF_K + lexical_rank[doc_id])
+    results = []
+    for doc_id in sorted(fused, key=lambda doc_id: -fused[doc_id])[:k]:
+        doc = dict(documents[doc_id])
+        doc['dense_score'] = doc['score']
+        doc['lexical_score'] = lexical_score.get(doc_id, 0.0)
+        doc['score'] = fused[doc_id]
+        results.append(doc)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the BM25 index over the wine reviews.")
+    parser.add_argument('csv_path')
+    parser.add_argument('--output', default='data/lexical_index.npz')
+    parser.add_argument('--query', default=None, help="Print the top matches of a query after building")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    lexical_index = build_lexical_index(args.csv_path)
+    lexical_index.save(args.output)
+    print(f"Indexed {len(lexical_index)} reviews ({len(lexical_index.vocabulary)} terms) in "
+          f"{time.perf_counter() - started:.1f}s, written to {args.output}.")
+    if args.query:
+        print(lexical_index.top(args.query, 10))
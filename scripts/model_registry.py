@@ -0,0 +1,80 @@
+import os
+import threading
+import numpy as np
+from embedding_cache import get_default_cache
+
+GIST_MODEL_NAME = 'avsolatorio/GIST-Embedding-v0'
+# 'torch' runs the SentenceTransformer, 'onnx' the int8 ONNX Runtime export of it (see onnx_encoder.py) and
+# 'hash' a deterministic fake encoder for offline runs and benchmarks (see offline_stubs.py).
+EMBEDDING_BACKENDS = ('torch', 'onnx', 'hash')
+# Dimension of the 'hash' embeddings, the GIST model has 768.
+HASH_EMBEDDING_DIM = int(os.getenv('HASH_EMBEDDING_DIM', 768))
+
+# Loaded models, keyed by (model name, device, backend). Every model is only loaded once per process.
+_models = {}
+# Reentrant, because the first 'onnx' load exports the model and the export loads the 'torch' model through
+# get_model again on the same thread.
+_models_lock = threading.RLock()
+
+
+def get_backend(backend=None):
+    """
+    Purpose: Resolve the inference backend, defaulting to the EMBEDDING_BACKEND environment variable.
+    """
+    backend = backend or os.getenv('EMBEDDING_BACKEND', 'torch')
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}'. Choose from {', '.join(EMBEDDING_BACKENDS)}.")
+    return backend
+
+def get_model(model_name=GIST_MODEL_NAME, device=None, backend=None):
+    """
+    Purpose: Return the encoder for model_name, loading it on first use.
+    Input: model_name - The name of the SentenceTransformer model.
+    Input: device - The device to pin the model to. Defaults to the EMBEDDING_DEVICE environment variable,
+                    or the SentenceTransformer default (GPU if available) when that is not set either.
+    Input: backend - 'torch', 'onnx' (CPU only, exported and cached on first use) or 'hash' (fake, offline).
+                     Defaults to the EMBEDDING_BACKEND environment variable, or 'torch'.
+    """
+    backend = get_backend(backend)
+    device = device or os.getenv('EMBEDDING_DEVICE')
+    key = (model_name, device, backend)
+    with _models_lock:
+        if key not in _models and backend == 'onnx':
+            from onnx_encoder import load_onnx_encoder
+            _models[key] = load_onnx_encoder(model_name)
+        if key not in _models and backend == 'hash':
+            from offline_stubs import HashEmbedder
+            _models[key] = HashEmbedder(HASH_EMBEDDING_DIM)
+        if key not in _models:
+            # Imported here so that importing this module (and the backend) does not pay for loading torch.
+            import torch
+            from sentence_transformers import SentenceTransformer
+
+            threads = os.getenv('EMBEDDING_THREADS')
+            if threads:
+                torch.set_num_threads(int(threads))
+            _models[key] = SentenceTransformer(model_name, device=device)
+        return _models[key]
+
+
+def encode_many(texts, model_name=GIST_MODEL_NAME, batch_size=64, use_cache=True):
+    """
+    Purpose: Embed a list of texts in one vectorized pass through the model.
+    Input: texts - The texts to embed.
+    Input: model_name - The name of the SentenceTransformer model.
+    Input: batch_size - The number of texts per forward pass.
+    Input: use_cache - Serve texts that were embedded before from the embedding cache.
+    Output: A float32 matrix with one row per text.
+    """
+    if len(texts) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+
+    def encode(batch):
+        return get_model(model_name).encode(batch, batch_size=batch_size, convert_to_numpy=True)
+
+    if use_cache:
+        # The int8 ONNX (and the fake) embeddings differ from the PyTorch ones, so they get their own cache entries.
+        cache_name = {'torch': model_name, 'onnx': f"{model_name}#onnx-int8",
+                      'hash': f"hash-{HASH_EMBEDDING_DIM}"}[get_backend()]
+        return np.vstack(get_default_cache().embed(cache_name, texts, encode))
+    return np.asarray(encode(list(texts)), dtype=np.float32)
@@ -0,0 +1,380 @@
+"""
+Local stand-ins for the external services, so the scripts and the backend can run (and be benchmarked)
+without Atlas credentials or an OpenAI key:
+
+- InMemoryClient / InMemoryCollection: the subset of the pymongo API the project uses, including aggregate
+  with $vectorSearch. The vector search is exact, Atlas returns approximate results for the same query.
+- HashEmbedder: deterministic feature-hashing embeddings. Texts that share words get similar vectors, so
+  searches return plausible neighbors, but the vectors carry no learned meaning.
+
+The backend uses them with MONGODB_URI=memory:// and EMBEDDING_BACKEND=hash.
+"""
+import numbers
+import re
+import threading
+import zlib
+import numpy as np
+import pymongo
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+_MISSING = object()
+_token_pattern = re.compile(r"[a-z0-9]+")
+
+
+def _comparable(value, operand):
+    # MongoDB only compares values of the same type: numbers with numbers (booleans are not numbers), strings
+    # with strings. A comparison across types, e.g. a price stored as text, does not match instead of failing.
+    if isinstance(value, numbers.Real) and isinstance(operand, numbers.Real):
+        return isinstance(value, bool) == isinstance(operand, bool)
+    return type(value) is type(operand)
+
+
+def _compare(value, operator, operand):
+    if operator == '$exists':
+        return (value is not _MISSING) == bool(operand)
+    if value is _MISSING:
+        return operator in ('$ne', '$nin')
+    if operator == '$eq':
+        return value == operand
+    if operator == '$ne':
+        return value != operand
+    if operator == '$in':
+        return value in operand
+    if operator == '$nin':
+        return value not in operand
+    if value is None or (operator in ('$gt', '$gte', '$lt', '$lte') and not _comparable(value, operand)):
+        return False
+    if operator == '$gt':
+        return value > operand
+    if operator == '$gte':
+        return value >= operand
+    if operator == '$lt':
+        return value < operand
+    if operator == '$lte':
+        return value <= operand
+    raise OperationFailure(f"Unsupported query operator {operator}")
+
+
+def matches(doc, query):
+    """
+    Purpose: Whether a document satisfies a MongoDB query (equality, $exists, $in, $nin, $ne, comparisons,
+    $and and $or on top-level fields).
+    """
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(op.startswith('$') for op in condition):
+            value = doc.get(key, _MISSING)
+            if not all(_compare(value, op, operand) for op, operand in condition.items()):
+                return False
+        elif doc.get(key, _MISSING) != condition:
+            return False
+    return True
+
+
+def _write_model_arguments(request):
+    """
+    Purpose: The (filter, document, upsert) of a pymongo write model (InsertOne, UpdateOne, ...). pymongo has
+    no public accessors for them; they are the _filter / _doc / _upsert attributes in every 4.x release, which
+    is why requirements.txt pins pymongo to 4.x. They are only read here, so a pymongo upgrade that changes
+    them fails loudly in one place.
+    """
+    kind = type(request).__name__
+    try:
+        if kind == 'InsertOne':
+            return None, request._doc, False
+        if kind in ('UpdateOne', 'UpdateMany', 'ReplaceOne'):
+            return request._filter, request._doc, bool(request._upsert)
+        if kind in ('DeleteOne', 'DeleteMany'):
+            return request._filter, None, False
+    except AttributeError as e:
+        raise OperationFailure(f"{kind} of pymongo {pymongo.version} is not supported by the in-memory "
+                               f"collection: {e}")
+    raise OperationFailure(f"Unsupported bulk write request {kind}")
+
+
+def project(doc, projection):
+    """
+    Purpose: Apply an inclusion ({field: 1}) or exclusion ({field: 0}) projection to a document.
+    """
+    if not projection:
+        return dict(doc)
+    included = {field for field, keep in projection.items() if keep and field != '_id'}
+    if included:
+        result = {field: doc[field] for field in included if field in doc}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    return {field: value for field, value in doc.items() if projection.get(field, 1)}
+
+
+class InMemoryCollection:
+    """
+    A MongoDB collection held in a dictionary keyed by _id. Thread-safe, like a pymongo collection.
+    """
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._docs = {}
+        self._lock = threading.RLock()
+        # Stacked embedding matrices per vector field, rebuilt after writes.
+        self._vectors = {}
+
+    def _changed(self):
+        self._vectors = {}
+
+    def _matching_ids(self, query):
+        # Lookups by _id (the common case for updates and deletes) skip the scan over every document.
+        condition = (query or {}).get('_id', _MISSING)
+        if len(query or {}) == 1 and condition is not _MISSING:
+            if not isinstance(condition, dict):
+                return [condition] if condition in self._docs else []
+            if set(condition) == {'$in'}:
+                return [doc_id for doc_id in condition['$in'] if doc_id in self._docs]
+        return [doc_id for doc_id, doc in self._docs.items() if matches(doc, query)]
+
+    def insert_one(self, document):
+        return InsertOneResult(self.insert_many([document]).inserted_ids[0], True)
+
+    def insert_many(self, documents, ordered=True):
+        with self._lock:
+            inserted = []
+            for document in documents:
+                if document['_id'] in self._docs:
+                    raise DuplicateKeyError(f"E11000 duplicate key error: _id {document['_id']!r}")
+                self._docs[document['_id']] = dict(document)
+                inserted.append(document['_id'])
+            self._changed()
+            return InsertManyResult(inserted, True)
+
+    def _update(self, document, update):
+        for operator, fields in update.items():
+            if operator == '$set':
+                document.update(fields)
+            elif operator == '$unset':
+                for field in fields:
+                    document.pop(field, None)
+            else:
+                raise OperationFailure(f"Unsupported update operator {operator}")
+
+    def _update_matching(self, query, update, upsert, many, replace=False):
+        with self._lock:
+            doc_ids = self._matching_ids(query)
+            if not many:
+                doc_ids = doc_ids[:1]
+            upserted = None
+            if not doc_ids and upsert:
+                upserted = query['_id'] if '_id' in query else None
+                if upserted is None:
+                    raise OperationFailure("The in-memory collection only upserts by _id")
+                self._docs[upserted] = {key: value for key, value in query.items() if not key.startswith('$')}
+            modified = 0
+            for doc_id in doc_ids or ([] if upserted is None else [upserted]):
+                before = dict(self._docs[doc_id])
+                if replace:
+                    self._docs[doc_id] = dict(update, _id=doc_id)
+                else:
+                    self._update(self._docs[doc_id], update)
+                modified += self._docs[doc_id] != before and upserted is None
+            if doc_ids or upserted is not None:
+                self._changed()
+            return UpdateResult({'n': len(doc_ids) or int(upserted is not None), 'nModified': modified,
+                                 'upserted': upserted}, True)
+
+    def update_one(self, query, update, upsert=False):
+        return self._update_matching(query, update, upsert, many=False)
+
+    def update_many(self, query, update, upsert=False):
+        return self._update_matching(query, update, upsert, many=True)
+
+    def replace_one(self, query, replacement, upsert=False):
+        return self._update_matching(query, replacement, upsert, many=False, replace=True)
+
+    def _delete(self, query, many):
+        with self._lock:
+            doc_ids = self._matching_ids(query)
+            if not many:
+                doc_ids = doc_ids[:1]
+            for doc_id in doc_ids:
+                del self._docs[doc_id]
+            if doc_ids:
+                self._changed()
+            return DeleteResult({'n': len(doc_ids)}, True)
+
+    def delete_one(self, query):
+        return self._delete(query, many=False)
+
+    def delete_many(self, query):
+        return self._delete(query, many=True)
+
+    def bulk_write(self, requests, ordered=True):
+        counts = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        for index, request in enumerate(requests):
+            query, document, upsert = _write_model_arguments(request)
+            kind = type(request).__name__
+            if kind == 'InsertOne':
+                self.insert_one(document)
+                counts['nInserted'] += 1
+                continue
+            if kind.startswith('Delete'):
+                counts['nRemoved'] += self._delete(query, many=kind == 'DeleteMany').deleted_count
+                continue
+            result = self._update_matching(query, document, upsert, many=kind == 'UpdateMany',
+                                           replace=kind == 'ReplaceOne')
+            if result.upserted_id is not None:
+                counts['nUpserted'] += 1
+                counts['upserted'].append({'index': index, '_id': result.upserted_id})
+            else:
+                counts['nMatched'] += result.matched_count
+                counts['nModified'] += result.modified_count
+        return BulkWriteResult(counts, True)
+
+    def count_documents(self, query):
+        with self._lock:
+            return sum(1 for doc in self._docs.values() if matches(doc, query))
+
+    def find(self, query=None, projection=None, sort=None, limit=0, batch_size=0):
+        # batch_size only tunes the round trips of a real cursor; the whole result is already in memory.
+        with self._lock:
+            found = [self._docs[doc_id] for doc_id in self._matching_ids(query)]
+        for field, direction in reversed(sort or []):
+            found.sort(key=lambda doc: doc.get(field), reverse=direction < 0)
+        if limit:
+            found = found[:limit]
+        return iter([project(doc, projection) for doc in found])
+
+    def find_one(self, query=None, projection=None, sort=None):
+        return next(self.find(query, projection, sort, limit=1), None)
+
+    def _vector_matrix(self, path):
+        with self._lock:
+            if path not in self._vectors:
+                ids = [doc_id for doc_id, doc in self._docs.items() if doc.get(path) is not None]
+                matrix = np.array([self._docs[doc_id][path] for doc_id in ids], dtype=np.float32)
+                if len(ids):
+                    matrix /= np.clip(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12, None)
+                self._vectors[path] = (ids, matrix)
+            return self._vectors[path]
+
+    def _vector_search(self, spec):
+        limit = spec['limit']
+        if spec.get('numCandidates', limit) < limit:
+            raise OperationFailure("numCandidates must be greater than or equal to limit")
+        ids, matrix = self._vector_matrix(spec['path'])
+        if not ids:
+            return []
+        query = np.asarray(spec['queryVector'], dtype=np.float32)
+        scores = matrix @ (query / max(np.linalg.norm(query), 1e-12))
+        if spec.get('filter'):
+            allowed = np.array([matches(self._docs[doc_id], spec['filter']) for doc_id in ids])
+            scores = np.where(allowed, scores, -np.inf)
+        count = min(limit, int(np.isfinite(scores).sum()))
+        best = np.argpartition(-scores, count - 1)[:count] if count else np.empty(0, dtype=np.int64)
+        best = best[np.argsort(-scores[best], kind='stable')]
+        results = []
+        for row in best:
+            doc = dict(self._docs[ids[row]])
+            # Atlas reports cosine similarity rescaled to [0, 1] as the vectorSearchScore.
+            doc['__score'] = (1 + float(scores[row])) / 2
+            results.append(doc)
+        return results
+
+    def aggregate(self, pipeline):
+        """
+        Purpose: Run an aggregation pipeline made of $vectorSearch (first stage), $match, $addFields (including
+        {'$meta': 'vectorSearchScore'}), $project and $limit.
+        """
+        documents = None
+        for stage in pipeline:
+            (operator, spec), = stage.items()
+            if operator == '$vectorSearch':
+                documents = self._vector_search(spec)
+                continue
+            if documents is None:
+                documents = list(self.find())
+            if operator == '$match':
+                documents = [doc for doc in documents if matches(doc, spec)]
+            elif operator == '$addFields':
+                for doc in documents:
+                    for field, value in spec.items():
+                        doc[field] = doc.get('__score') if value == {'$meta': 'vectorSearchScore'} else value
+            elif operator == '$project':
+                documents = [project(doc, spec) for doc in documents]
+            elif operator == '$limit':
+                documents = documents[:spec]
+            else:
+                raise OperationFailure(f"Unsupported aggregation stage {operator}")
+        for doc in documents or []:
+            doc.pop('__score', None)
+        return iter(documents or [])
+
+
+class InMemoryDatabase:
+    def __init__(self, name):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = InMemoryCollection(self, name)
+            return self._collections[name]
+
+    def list_collection_names(self):
+        return list(self._collections)
+
+
+# Databases are shared by every InMemoryClient of the process, like a server would be.
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+class InMemoryClient:
+    """Stand-in for pymongo.MongoClient. Every client of a process sees the same databases."""
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getitem__(self, name):
+        with _databases_lock:
+            if name not in _databases:
+                _databases[name] = InMemoryDatabase(name)
+            return _databases[name]
+
+    def list_database_names(self):
+        return list(_databases)
+
+    def drop_database(self, name):
+        with _databases_lock:
+            _databases.pop(name, None)
+
+
+class HashEmbedder:
+    """
+    Deterministic fake sentence encoder: every word is hashed to one of dim buckets with a +1/-1 sign, and
+    the counts are normalized. Exposes the SentenceTransformer.encode arguments the project uses.
+    """
+    def __init__(self, dim=768):
+        self.dim = dim
+
+    def embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in _token_pattern.findall(text.lower()):
+            bucket = zlib.crc32(token.encode('utf-8'))
+            vector[bucket % self.dim] += 1.0 if bucket & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, **kwargs):
+        if isinstance(sentences, str):
+            return self.embed(sentences)
+        return np.array([self.embed(text) for text in sentences], dtype=np.float32).reshape(-1, self.dim)
+
+    def __call__(self, texts):
+        """Embed texts as lists of floats, the interface of the embed_fn of the ingestion script."""
+        return self.encode(texts).tolist()
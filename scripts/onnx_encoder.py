@@ -0,0 +1,240 @@
+"""
+ONNX Runtime backend for the sentence embedding models, for CPU-only serving:
+
+    pip install onnx onnxruntime tokenizers
+    python scripts/onnx_encoder.py export            # export + int8 quantization, needs torch once
+    python scripts/onnx_encoder.py verify            # compare against the PyTorch model
+    EMBEDDING_BACKEND=onnx python demo/bb-backend/app.py
+
+The encoder is exported once with torch.onnx.export, dynamically quantized to int8 weights and cached under
+ONNX_CACHE_DIR (default ~/.cache/bottlebuddy/onnx). Loading the cached artifact needs neither torch nor
+sentence_transformers, which also makes the backend start much faster.
+"""
+import argparse
+import inspect
+import json
+import os
+import re
+import shutil
+import time
+import numpy as np
+
+ONNX_CACHE_DIR = os.getenv('ONNX_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'bottlebuddy', 'onnx'))
+ONNX_OPSET = 14
+# Inputs of the exported transformer, in the order of its forward() arguments
+INPUT_NAMES = ('input_ids', 'attention_mask', 'token_type_ids')
+
+
+def artifact_dir(model_name, cache_dir=None):
+    """
+    Purpose: Directory that holds the exported artifacts of a model.
+    """
+    return os.path.join(cache_dir or ONNX_CACHE_DIR, re.sub(r'[^\w.-]', '_', model_name))
+
+
+def export_onnx(model_name, cache_dir=None, quantize=True):
+    """
+    Purpose: Export a SentenceTransformer to ONNX (and an int8 copy) next to its tokenizer and pooling settings.
+    Input: model_name - The name of the SentenceTransformer model.
+    Input: cache_dir - Root of the artifact cache (ONNX_CACHE_DIR by default).
+    Input: quantize - Also write the dynamically quantized int8 model.
+    Output: The artifact directory.
+    """
+    import torch
+    from sentence_transformers.models import Normalize, Pooling
+    from model_registry import get_model
+
+    model = get_model(model_name, device='cpu', backend='torch')
+    transformer = model[0].auto_model.eval()
+    pooling = next(module for module in model if isinstance(module, Pooling)).get_config_dict()
+    # Older sentence_transformers versions store one flag per mode, newer ones the name of the mode.
+    if pooling.get('pooling_mode_cls_token') or pooling.get('pooling_mode') == 'cls':
+        pooling_mode = 'cls'
+    elif pooling.get('pooling_mode_mean_tokens') or pooling.get('pooling_mode') == 'mean':
+        pooling_mode = 'mean'
+    else:
+        raise ValueError(f"Unsupported pooling of '{model_name}': {pooling}")
+
+    sample = model.tokenizer(["A crisp white wine with citrus notes."], return_tensors='pt')
+    input_names = [name for name in INPUT_NAMES if name in sample]
+
+    class HiddenStates(torch.nn.Module):
+        # Only the token embeddings are exported, pooling is done in numpy.
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, *inputs):
+            return self.transformer(**dict(zip(input_names, inputs))).last_hidden_state
+
+    path = artifact_dir(model_name, cache_dir)
+    # Written to a temporary directory first, so an interrupted export never looks like a finished one.
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']}
+    export_options = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # Newer torch versions default to the dynamo exporter (which needs onnxscript); dynamic_axes belongs to
+        # the TorchScript exporter.
+        export_options['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(HiddenStates(), tuple(sample[name] for name in input_names),
+                          os.path.join(tmp_path, 'model.onnx'), input_names=input_names,
+                          output_names=['last_hidden_state'], dynamic_axes=dynamic_axes,
+                          opset_version=ONNX_OPSET, do_constant_folding=True, **export_options)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(os.path.join(tmp_path, 'model.onnx'), os.path.join(tmp_path, 'model.int8.onnx'),
+                         weight_type=QuantType.QInt8)
+
+    model.tokenizer.save_pretrained(tmp_path)
+    with open(os.path.join(tmp_path, 'encoder.json'), 'w') as f:
+        json.dump({
+            'model_name': model_name,
+            'pooling': pooling_mode,
+            'normalize': any(isinstance(module, Normalize) for module in model),
+            'max_seq_length': model.max_seq_length,
+            'pad_token': model.tokenizer.pad_token,
+            'pad_token_id': model.tokenizer.pad_token_id,
+        }, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+class OnnxEncoder:
+    """
+    Sentence encoder running an exported model on ONNX Runtime. encode() mirrors SentenceTransformer.encode
+    for the arguments the project uses, so it can stand in for it in the model registry.
+    """
+    def __init__(self, path, quantized=True, threads=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(path, 'encoder.json')) as f:
+            self.config = json.load(f)
+        model_file = os.path.join(path, 'model.int8.onnx' if quantized else 'model.onnx')
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        threads = threads or os.getenv('EMBEDDING_THREADS')
+        if threads:
+            options.intra_op_num_threads = int(threads)
+        self.session = ort.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=self.config['max_seq_length'])
+        self.tokenizer.enable_padding(pad_id=self.config['pad_token_id'], pad_token=self.config['pad_token'])
+        self.quantized = quantized
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            'input_ids': np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            'attention_mask': np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            'token_type_ids': np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+        if self.config['pooling'] == 'cls':
+            embeddings = hidden[:, 0]
+        else:
+            mask = inputs['attention_mask'][:, :, None].astype(np.float32)
+            embeddings = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config['normalize']:
+            embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings.astype(np.float32)
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, **kwargs):
+        """
+        Purpose: Embed a text or a list of texts.
+        Input: sentences - A string or a list of strings.
+        Input: batch_size - The number of texts per inference call.
+        Output: A float32 vector for a string, a float32 matrix with one row per text for a list.
+        """
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size)[0]
+        texts = list(sentences)
+        # Texts of similar length are batched together, so little compute is spent on padding.
+        order = np.argsort([len(text) for text in texts], kind='stable')
+        batches = [self._encode_batch([texts[i] for i in order[start:start + batch_size]])
+                   for start in range(0, len(texts), batch_size)]
+        if not batches:
+            return np.empty((0, 0), dtype=np.float32)
+        embeddings = np.empty((len(texts), batches[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.vstack(batches)
+        return embeddings
+
+
+def load_onnx_encoder(model_name, cache_dir=None, quantized=True):
+    """
+    Purpose: Return the ONNX encoder of a model, exporting it first when it is not in the cache yet.
+    Input: model_name - The name of the SentenceTransformer model.
+    Input: cache_dir - Root of the artifact cache (ONNX_CACHE_DIR by default).
+    Input: quantized - Use the int8 model instead of the float32 export.
+    """
+    path = artifact_dir(model_name, cache_dir)
+    model_file = os.path.join(path, 'model.int8.onnx' if quantized else 'model.onnx')
+    if not os.path.exists(model_file):
+        print(f"Exporting '{model_name}' to ONNX in {path}.")
+        export_onnx(model_name, cache_dir, quantize=quantized)
+    return OnnxEncoder(path, quantized=quantized)
+
+
+def verify_encoder(model_name, texts, min_cosine=0.99, quantized=True, cache_dir=None):
+    """
+    Purpose: Check that the ONNX encoder stays within a cosine tolerance of the PyTorch model, and compare
+    their speed on the same texts.
+    Input: model_name - The name of the SentenceTransformer model.
+    Input: texts - The texts to embed with both encoders.
+    Input: min_cosine - The lowest cosine similarity between the two embeddings of a text that is accepted.
+    Output: Dictionary with the cosine statistics, the latency of both encoders and whether the check passed.
+    """
+    from model_registry import get_model
+
+    reference_model = get_model(model_name, device='cpu', backend='torch')
+    onnx_model = load_onnx_encoder(model_name, cache_dir, quantized)
+
+    timings = {}
+    embeddings = {}
+    for name, model in (('torch', reference_model), ('onnx', onnx_model)):
+        model.encode(texts[:8], batch_size=32, convert_to_numpy=True)  # warm up
+        started = time.perf_counter()
+        embeddings[name] = np.asarray(model.encode(texts, batch_size=32, convert_to_numpy=True), dtype=np.float32)
+        timings[name] = 1000 * (time.perf_counter() - started) / len(texts)
+
+    reference, candidate = embeddings['torch'], embeddings['onnx']
+    cosines = (reference * candidate).sum(axis=1) / (np.linalg.norm(reference, axis=1) *
+                                                     np.linalg.norm(candidate, axis=1))
+    return {
+        'model': model_name,
+        'quantized': quantized,
+        'texts': len(texts),
+        'min_cosine': float(cosines.min()),
+        'mean_cosine': float(cosines.mean()),
+        'torch_ms_per_text': timings['torch'],
+        'onnx_ms_per_text': timings['onnx'],
+        'passed': bool(cosines.min() >= min_cosine),
+    }
+
+
+if __name__ == "__main__":
+    from model_registry import GIST_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="Export a sentence encoder to ONNX and verify it.")
+    parser.add_argument('command', choices=['export', 'verify'])
+    parser.add_argument('--model', default=GIST_MODEL_NAME)
+    parser.add_argument('--no-quantize', action='store_true', help="Use the float32 export instead of int8.")
+    parser.add_argument('--min-cosine', type=float, default=0.99)
+    parser.add_argument('--csv', default='data/data_first10k.csv', help="Descriptions used by verify")
+    parser.add_argument('--texts', type=int, default=256, help="Number of descriptions used by verify")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print(f"Exported to {export_onnx(args.model, quantize=not args.no_quantize)}")
+    else:
+        import pandas as pd
+        texts = pd.read_csv(args.csv, usecols=['description'])['description'].dropna().head(args.texts).tolist()
+        report = verify_encoder(args.model, texts, args.min_cosine, quantized=not args.no_quantize)
+        print(json.dumps(report, indent=2))
+        raise SystemExit(0 if report['passed'] else 1)
@@ -1,13 +1,26 @@
 
-from pymongo import MongoClient
+import argparse
+import hashlib
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, UpdateOne
 import certifi
 import pymongo.errors as mongo_errors
+import numpy as np
 import pandas as pd
 import openai
+from embedding_cache import get_default_cache
+from lexical_index import build_lexical_index
 
 # Here we create the openai object and set the API key so that we can use the OpenAI API.
 openai.api_key = 'your_openai_api_key'
 
+# Columns from the wine reviews CSV that are stored on each document next to the title and description,
+# so the backend can return and filter on them without going back to the CSV.
+METADATA_COLUMNS = ['country', 'province', 'variety', 'winery', 'price', 'points']
+
 def get_database():
     """
     Purpose: Establish a connection to the MongoDB database.
@@ -33,9 +46,55 @@ def generate_embedding(text, model="text-embedding-ada-002"):
     Input: text - The text for which an embedding is to be generated.
     Input: model - The model to use for generating the embedding.
     """
-    response = openai.Embedding.create(input=[text], model=model)
-    embedding = response['data'][0]['embedding']
-    return embedding
+    return generate_embeddings([text], model=model)[0]
+
+def generate_embeddings(texts, model="text-embedding-ada-002"):
+    """
+    Purpose: Generate embeddings for a batch of texts with a single multi-input request.
+    Texts that were embedded before are served from the embedding cache and are not sent to the API.
+    Input: texts - The list of texts for which embeddings are to be generated.
+    Input: model - The model to use for generating the embeddings.
+    """
+    def request_embeddings(missing_texts):
+        response = openai.Embedding.create(input=missing_texts, model=model)
+        # Every item carries the index of its input, so we sort on it instead of trusting the response order.
+        data = sorted(response['data'], key=lambda item: item['index'])
+        return [item['embedding'] for item in data]
+
+    return [embedding.tolist() for embedding in get_default_cache().embed(model, texts, request_embeddings)]
+
+def generate_stub_embeddings(texts, dim=1536):
+    """
+    Purpose: Offline stand-in for generate_embeddings. Returns a deterministic pseudo-random vector per text
+    so the ingestion pipeline can be run and benchmarked without an API key or network access.
+    Input: texts - The list of texts for which embeddings are to be generated.
+    Input: dim - The embedding dimension (1536 matches text-embedding-ada-002).
+    """
+    embeddings = []
+    for text in texts:
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        embeddings.append(np.random.default_rng(seed).standard_normal(dim, dtype=np.float32).tolist())
+    return embeddings
+
+def embed_with_retry(embed_fn, texts, max_retries=5, base_delay=1.0):
+    """
+    Purpose: Call the embedding function, retrying with exponential backoff when it fails
+    (rate limits, timeouts and other transient API errors).
+    Input: embed_fn - Function that takes a list of texts and returns a list of embeddings.
+    Input: texts - The texts to embed.
+    Input: max_retries - How many times to retry before giving up.
+    Input: base_delay - The delay in seconds before the first retry. It doubles on every attempt.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return embed_fn(texts)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            # The jitter keeps the worker threads from retrying in lockstep.
+            delay = base_delay * (2 ** attempt) * (0.5 + random.random())
+            print(f"Embedding request failed ({e}), retrying in {delay:.1f}s.")
+            time.sleep(delay)
 
 def store_row_with_embedding(custom_id, title, description, collection):
     """
@@ -58,27 +117,387 @@ def store_row_with_embedding(custom_id, title, description, collection):
     # is added to the MongoDB collection.
     print(f"Content with title '{title}' has been successfully stored in MongoDB with ID {custom_id}.")
 
-def process_csv_file(csv_path, collection):
+def mark_collection_updated(collection):
+    """
+    Purpose: Record when the collection was last (re-)ingested. The backend watches this marker and drops its
+    cached /find results and reloads its lexical index when it changes.
+    Input: collection - The MongoDB collection that was updated.
+    """
+    collection.database['Meta'].update_one({'_id': collection.name}, {'$set': {'updated_at': time.time()}},
+                                           upsert=True)
+
+def save_resume_cursor(collection, next_row, next_id):
+    """
+    Purpose: Record how far the CSV file has been ingested, next to the update marker in the Meta collection.
+    Input: collection - The MongoDB collection in which the documents are stored.
+    Input: next_row - The number of CSV rows that are stored.
+    Input: next_id - The _id the next new row gets.
+    """
+    collection.database['Meta'].update_one({'_id': collection.name},
+                                           {'$set': {'next_row': next_row, 'next_id': next_id}}, upsert=True)
+
+def get_resume_cursor(collection):
+    """
+    Purpose: Find the CSV row to continue ingesting at and the _id it gets. After a sync the IDs no longer follow
+    the row positions, so both are read from the cursor that process_csv_file and sync_csv_file record (see
+    save_resume_cursor). Collections ingested before the cursor existed continue after the highest stored _id.
+    Input: collection - The MongoDB collection in which the documents are stored.
+    Output: (next_row, next_id)
+    """
+    # MongoDB only compares numbers with numbers, so documents with other IDs (like ObjectIds) are not looked at.
+    last = collection.find_one({'_id': {'$gte': 0}}, projection={'_id': 1}, sort=[('_id', -1)])
+    stored_next_id = 0 if last is None else int(last['_id']) + 1
+    marker = collection.database['Meta'].find_one({'_id': collection.name})
+    if marker is None or 'next_row' not in marker:
+        return stored_next_id, stored_next_id
+    # Batches are written strictly in order with consecutive IDs, so a batch stored just before a crash, whose
+    # cursor update never happened, shows up as IDs past the cursor and is skipped as well.
+    written = max(0, stored_next_id - marker['next_id'])
+    return marker['next_row'] + written, marker['next_id'] + written
+
+def iter_csv_batches(csv_path, batch_size, start_row=0, chunk_size=10000):
+    """
+    Purpose: Stream the CSV file in chunks and yield it as (first_row, rows) batches.
+    Input: csv_path - The path to the CSV file containing the content.
+    Input: batch_size - The number of rows per batch (and per embedding request).
+    Input: start_row - The number of rows at the top of the file to skip (already ingested).
+    Input: chunk_size - The number of rows read from disk at a time.
+    """
+    next_row = start_row
+    # skiprows keeps the header (line 0) and skips the data rows that were already ingested.
+    reader = pd.read_csv(csv_path, chunksize=chunk_size, skiprows=range(1, start_row + 1))
+    for chunk in reader:
+        for start in range(0, len(chunk), batch_size):
+            rows = chunk.iloc[start:start + batch_size]
+            yield next_row, rows
+            next_row += len(rows)
+
+def content_hash(title, description):
+    """
+    Purpose: Fingerprint the text a row is embedded from, so a sync can tell which rows changed.
+    Input: title - The title of the content (None/NaN counts as empty).
+    Input: description - The description of the content (None/NaN counts as empty).
+    """
+    parts = ['' if pd.isna(value) else str(value) for value in (title, description)]
+    # The separator keeps ("ab", "c") and ("a", "bc") apart.
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+def embedding_hash_field(embedding_field):
+    """
+    Purpose: Name of the document field that records which content_hash the embedding in embedding_field was
+    computed from, so a sync can tell a stale embedding from a current one.
+    """
+    return embedding_field + '_hash'
+
+def _metadata_records(rows):
+    columns = [column for column in METADATA_COLUMNS if column in rows.columns]
+    # Converting through object dtype turns NaN into None and numpy scalars into plain Python values.
+    return rows[columns].astype(object).where(rows[columns].notna(), None).to_dict('records')
+
+def build_documents(first_id, rows, embeddings, embedding_field='openai_embedding'):
+    """
+    Purpose: Turn a batch of CSV rows and their embeddings into MongoDB documents.
+    Input: first_id - The custom ID of the first row in the batch.
+    Input: rows - The DataFrame slice holding the batch.
+    Input: embeddings - One embedding per row.
+    Input: embedding_field - The document field in which to store the embedding.
+    """
+    metadata = _metadata_records(rows)
+    documents = []
+    for offset, (title, description, embedding) in enumerate(zip(rows['title'], rows['description'], embeddings)):
+        document = {"_id": first_id + offset, "title": title, "description": description,
+                    "content_hash": content_hash(title, description)}
+        document.update(metadata[offset])
+        document[embedding_field] = embedding
+        document[embedding_hash_field(embedding_field)] = document['content_hash']
+        documents.append(document)
+    return documents
+
+def write_lexical_index(csv_path, lexical_index_path, ids=None):
+    """
+    Purpose: Rebuild the BM25 index over the ingested rows (see lexical_index.py), so the backend's lexical
+    search modes see the same documents as the collection.
+    Input: csv_path - The path to the CSV file that was ingested.
+    Input: lexical_index_path - Where to write the index.
+    Input: ids - The _id of every row, when they are not the row positions (after a sync).
+    """
+    started = time.perf_counter()
+    lexical_index = build_lexical_index(csv_path, ids=ids)
+    lexical_index.save(lexical_index_path)
+    print(f"Wrote the lexical index of {len(lexical_index)} rows to {lexical_index_path} "
+          f"({time.perf_counter() - started:.1f}s).")
+
+def process_csv_file(csv_path, collection, embed_fn=generate_embeddings, batch_size=100, max_workers=4,
+                     chunk_size=10000, resume=True, embedding_field='openai_embedding', lexical_index_path=None):
     """
     Purpose: Process the CSV file and store the content along with its embedding in the database.
+    The file is streamed in chunks, each batch of rows is embedded with one multi-input request on a
+    thread pool, and the finished batches are written with insert_many.
+    Input: csv_path - The path to the CSV file containing the content.
+    Input: collection - The MongoDB collection in which to store the documents.
+    Input: embed_fn - Function that takes a list of texts and returns a list of embeddings
+                      (generate_embeddings, or generate_stub_embeddings to run offline).
+    Input: batch_size - The number of rows per embedding request and per insert_many.
+    Input: max_workers - The number of embedding requests in flight at the same time.
+    Input: chunk_size - The number of rows read from the CSV at a time.
+    Input: resume - Continue where the last run stopped (see get_resume_cursor) instead of at the first row.
+    Input: embedding_field - The document field in which to store the embedding.
+    Input: lexical_index_path - Also write the BM25 index over title + description to this file.
+    """
+    start_row, start_id = get_resume_cursor(collection) if resume else (0, 0)
+    if start_row:
+        print(f"Resuming ingestion at row {start_row} with ID {start_id}.")
+
+    stored = 0
+    started = time.perf_counter()
+    pending = deque()
+
+    def write_oldest():
+        nonlocal stored
+        first_row, rows, future = pending.popleft()
+        first_id = start_id + first_row - start_row
+        documents = build_documents(first_id, rows, future.result(), embedding_field)
+        collection.insert_many(documents, ordered=True)
+        save_resume_cursor(collection, first_row + len(documents), first_id + len(documents))
+        stored += len(documents)
+        rate = stored / (time.perf_counter() - started)
+        print(f"Stored IDs {first_id}-{first_id + len(documents) - 1} in MongoDB ({rate:.0f} rows/s).")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for first_row, rows in iter_csv_batches(csv_path, batch_size, start_row, chunk_size):
+            texts = (rows['title'].fillna('').astype(str) + " " + rows['description'].fillna('').astype(str)).tolist()
+            pending.append((first_row, rows, executor.submit(embed_with_retry, embed_fn, texts)))
+            # Batches are written in the order they were read, so a crash never leaves a gap behind the
+            # resume cursor. Capping the queue bounds both memory and the number of open requests.
+            while len(pending) > max_workers:
+                write_oldest()
+        while pending:
+            write_oldest()
+
+    # The index is written before the marker, because the backend reloads it when the marker changes.
+    if lexical_index_path:
+        write_lexical_index(csv_path, lexical_index_path)
+    if stored:
+        mark_collection_updated(collection)
+
+    print(f"Stored {stored} rows in {time.perf_counter() - started:.1f}s.")
+    return stored
+
+def load_stored_documents(collection, embedding_field='openai_embedding'):
+    """
+    Purpose: Read what a sync compares the CSV with: the content hash, title, metadata and embedding hash of
+    every document this script ingested (integer _id), without the embeddings themselves. Documents ingested
+    before hashes were stored get them computed from the stored title and description; an embedding without
+    a recorded hash is assumed to match the stored text.
+    Input: collection - The MongoDB collection in which the documents are stored.
+    Input: embedding_field - The document field that holds the embedding being synced.
+    Output: Dictionary _id -> document.
+    """
+    hash_field = embedding_hash_field(embedding_field)
+    projection = {field: 1 for field in ['title', 'description', 'content_hash', hash_field] + METADATA_COLUMNS}
+    # Only whether the embedding exists is needed, but projections cannot express that, so it is queried apart.
+    embedded = {doc['_id'] for doc in collection.find({embedding_field: {'$exists': True}}, projection={'_id': 1})}
+    documents = {}
+    for doc in collection.find({}, projection=projection):
+        if not isinstance(doc['_id'], int):
+            # IDs this script did not assign are left alone.
+            continue
+        doc['_stored_hashes'] = {field: doc.get(field) for field in ('content_hash', hash_field)}
+        if doc.get('content_hash') is None:
+            doc['content_hash'] = content_hash(doc.get('title'), doc.get('description'))
+        doc.pop('description', None)
+        if doc['_id'] in embedded and doc.get(hash_field) is None:
+            doc[hash_field] = doc['content_hash']
+        documents[doc['_id']] = doc
+    return documents
+
+def match_rows(row_hashes, row_titles, stored):
+    """
+    Purpose: Pair every CSV row with the stored document it corresponds to. A row first claims a document with
+    the same content hash, wherever it is in the file, so inserted, deleted or reordered rows do not make the
+    rows after them look changed. Rows whose text changed then claim a remaining document with the same
+    title. Duplicate rows each claim their own document.
+    Input: row_hashes - The content hash of every CSV row, in file order.
+    Input: row_titles - The title of every CSV row, in file order.
+    Input: stored - The stored documents (see load_stored_documents).
+    Output: (matched _id per row, or None for new rows; set of the rows matched by title only)
+    """
+    by_hash = {}
+    for doc_id in sorted(stored):
+        by_hash.setdefault(stored[doc_id]['content_hash'], deque()).append(doc_id)
+    matches = [None] * len(row_hashes)
+    for row, row_hash in enumerate(row_hashes):
+        if by_hash.get(row_hash):
+            matches[row] = by_hash[row_hash].popleft()
+
+    by_title = {}
+    for doc_id in sorted(doc_id for doc_ids in by_hash.values() for doc_id in doc_ids):
+        if stored[doc_id].get('title') is not None:
+            by_title.setdefault(stored[doc_id]['title'], deque()).append(doc_id)
+    changed = set()
+    for row, title in enumerate(row_titles):
+        if matches[row] is None and title is not None and by_title.get(title):
+            matches[row] = by_title[title].popleft()
+            changed.add(row)
+    return matches, changed
+
+def sync_csv_file(csv_path, collection, embed_fn=generate_embeddings, batch_size=100, max_workers=4,
+                  chunk_size=10000, embedding_field='openai_embedding', dry_run=False, lexical_index_path=None):
+    """
+    Purpose: Bring the collection in line with the CSV file while only embedding what changed. Rows are matched
+    to the stored documents by the hash of their title + description, falling back to the title for rows whose
+    text changed (see match_rows), so the cost is proportional to the changes, not to where they are in the
+    file. Matched documents are updated with $set of only the fields that differ: the embedding is only
+    recomputed when the text changed or was embedded from an older text, and other fields (like the other
+    model's embeddings) are kept. New rows are inserted under new IDs and documents without a row are deleted.
     Input: csv_path - The path to the CSV file containing the content.
     Input: collection - The MongoDB collection in which to store the documents.
+    Input: embed_fn - Function that takes a list of texts and returns a list of embeddings.
+    Input: batch_size - The number of rows per embedding request and per bulk_write.
+    Input: max_workers - The number of embedding requests in flight at the same time.
+    Input: chunk_size - The number of rows read from the CSV at a time.
+    Input: embedding_field - The document field in which to store the embedding.
+    Input: dry_run - Only compute and print the delta, without embedding or writing anything.
+    Input: lexical_index_path - Also rebuild the BM25 index over title + description in this file.
+    Output: Dictionary with the number of new, changed (text), updated (metadata only), unchanged, deleted and
+            embedded rows.
     """
-    data = pd.read_csv(csv_path)
-    next_id = 0
-    # Here we iterate over each row and store the content along with its embedding in the database.
-    for index, row in data.iterrows():
-        # We use the store_row_with_embedding function that we just created to store the content in the database.
-        store_row_with_embedding(next_id, row['title'], row['description'], collection)
-        next_id += 1
+    started = time.perf_counter()
+    hash_field = embedding_hash_field(embedding_field)
+    stored = load_stored_documents(collection, embedding_field)
+
+    # First pass: hash every row, so rows can be matched anywhere in the file.
+    row_hashes = []
+    row_titles = []
+    for _, rows in iter_csv_batches(csv_path, chunk_size, 0, chunk_size):
+        row_hashes.extend(content_hash(title, description)
+                          for title, description in zip(rows['title'], rows['description']))
+        row_titles.extend(None if pd.isna(title) else title for title in rows['title'])
+    matches, changed_rows = match_rows(row_hashes, row_titles, stored)
+    next_id = max(stored, default=-1) + 1
+    for row, doc_id in enumerate(matches):
+        if doc_id is None:
+            matches[row] = next_id
+            next_id += 1
+    matched_ids = {doc_id for doc_id in matches if doc_id in stored}
+    removed = sorted(doc_id for doc_id in stored if doc_id not in matched_ids)
+
+    summary = {'new': 0, 'changed': 0, 'updated': 0, 'unchanged': 0, 'deleted': len(removed), 'embedded': 0}
+    updates = []
+    pending = deque()
+
+    def write(requests):
+        for start in range(0, len(requests), 1000):
+            collection.bulk_write(requests[start:start + 1000], ordered=False)
+
+    def write_oldest():
+        batch_updates, future = pending.popleft()
+        write([UpdateOne({'_id': doc_id}, {'$set': dict(fields, **{embedding_field: embedding})}, upsert=True)
+               for (doc_id, fields), embedding in zip(batch_updates, future.result())])
+        print(f"Embedded and wrote {len(batch_updates)} rows ({time.perf_counter() - started:.1f}s).")
+
+    # Second pass: compute the $set of every row and embed the rows whose embedding is missing or stale.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        to_embed = []
+
+        def submit_embeddings():
+            texts = [text for _, _, text in to_embed]
+            pending.append(([(doc_id, fields) for doc_id, fields, _ in to_embed],
+                            executor.submit(embed_with_retry, embed_fn, texts)))
+            to_embed.clear()
+            while len(pending) > max_workers:
+                write_oldest()
+
+        for first_row, rows in iter_csv_batches(csv_path, chunk_size, 0, chunk_size):
+            metadata = _metadata_records(rows)
+            for offset, (title, description) in enumerate(zip(rows['title'], rows['description'])):
+                row = first_row + offset
+                doc_id, row_hash = matches[row], row_hashes[row]
+                doc = stored.get(doc_id)
+                title = None if pd.isna(title) else title
+                description = None if pd.isna(description) else description
+                wanted = dict(metadata[offset], title=title, description=description, content_hash=row_hash)
+                if doc is None:
+                    summary['new'] += 1
+                    fields = wanted
+                else:
+                    fields = {field: value for field, value in wanted.items()
+                              if field != 'description' and doc.get(field) != value}
+                    if row in changed_rows:
+                        summary['changed'] += 1
+                        fields['description'] = description
+                    elif fields:
+                        summary['updated'] += 1
+                    else:
+                        summary['unchanged'] += 1
+                    # Hashes that were computed for old documents are written back.
+                    if doc['_stored_hashes']['content_hash'] is None:
+                        fields['content_hash'] = row_hash
+                if doc is not None and doc.get(hash_field) == row_hash:
+                    if doc['_stored_hashes'][hash_field] is None:
+                        fields[hash_field] = row_hash
+                    if fields:
+                        updates.append(UpdateOne({'_id': doc_id}, {'$set': fields}))
+                    continue
+                # New, changed, or embedded from an older text: the embedding is (re)computed.
+                summary['embedded'] += 1
+                fields[hash_field] = row_hash
+                if dry_run:
+                    continue
+                to_embed.append((doc_id, fields, ('' if title is None else str(title)) + " " +
+                                 ('' if description is None else str(description))))
+                if len(to_embed) >= batch_size:
+                    submit_embeddings()
+        if to_embed:
+            submit_embeddings()
+        while pending:
+            write_oldest()
+
+    if not dry_run:
+        write(updates)
+        for start in range(0, len(removed), 1000):
+            collection.delete_many({'_id': {'$in': removed[start:start + 1000]}})
+        # Every row of the file is stored now, under IDs that no longer follow the row positions, so a later
+        # default run only ingests rows appended to the file, under new IDs.
+        save_resume_cursor(collection, len(matches), next_id)
+        if lexical_index_path:
+            # The documents keep their _id when rows move, so the index is built with the matched IDs.
+            write_lexical_index(csv_path, lexical_index_path, ids=matches)
+        if summary['new'] or summary['changed'] or summary['updated'] or summary['deleted'] or \
+                summary['embedded']:
+            mark_collection_updated(collection)
+
+    print(f"{'Dry run: ' if dry_run else ''}{summary['new']} new, {summary['changed']} changed, "
+          f"{summary['updated']} metadata updated, {summary['unchanged']} unchanged, {summary['deleted']} deleted "
+          f"rows, {summary['embedded']} to embed ({time.perf_counter() - started:.1f}s).")
+    return summary
 
 # The main function that will be executed when the script is run.
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the wine reviews CSV and store it in MongoDB.")
+    # Define the path to the csv file where you want to extract the data from
+    parser.add_argument('csv_path', nargs='?', default="path_to_your_csv_file.csv")
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--no-resume', action='store_true', help="Start from the first row of the CSV.")
+    parser.add_argument('--stub', action='store_true', help="Use offline stub embeddings instead of OpenAI.")
+    parser.add_argument('--sync', action='store_true',
+                        help="Only embed and upsert new or changed rows and delete removed ones.")
+    parser.add_argument('--dry-run', action='store_true', help="With --sync, only report the delta.")
+    parser.add_argument('--lexical-index', default=None,
+                        help="Also write the BM25 index used by the backend's lexical search modes to this file.")
+    args = parser.parse_args()
+
     db = get_database()
     if db is not None:
         # Define the collection
         collection = db['Wine']
-        # Define the path to the csv file where you want to extract the data from
-        csv_path = "path_to_your_csv_file.csv"
-        # Run the process_csv_file function to process the CSV file and store the content in the database.
-        process_csv_file(csv_path, collection)
+        embed_fn = generate_stub_embeddings if args.stub else generate_embeddings
+        if args.sync:
+            sync_csv_file(args.csv_path, collection, embed_fn=embed_fn, batch_size=args.batch_size,
+                          max_workers=args.workers, dry_run=args.dry_run, lexical_index_path=args.lexical_index)
+        else:
+            # Run the process_csv_file function to process the CSV file and store the content in the database.
+            process_csv_file(args.csv_path, collection, embed_fn=embed_fn, batch_size=args.batch_size,
+                             max_workers=args.workers, resume=not args.no_resume,
+                             lexical_index_path=args.lexical_index)
@@ -0,0 +1,137 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from model_registry import GIST_MODEL_NAME, encode_many
+from vector_store import LOCAL_BACKENDS, MongoVectorStore, exact_top_k, get_vector_store, \
+    load_embeddings_from_file, load_embeddings_from_mongo, normalize_rows
+
+# Values tried for the knob of each backend when --values is not given. The flat index is exact and has no
+# knob, it is measured once as the latency baseline.
+DEFAULT_SWEEPS = {
+    'num_candidates': [10, 20, 50, 100, 200, 400],
+    'n_probe': [1, 2, 4, 8, 16, 32],
+    'ef_search': [16, 32, 64, 128, 256],
+    None: [None],
+}
+
+
+def load_queries(csv_path, n_queries=200, seed=0, model_name=GIST_MODEL_NAME):
+    """
+    Purpose: Draw a reproducible query set from the wine descriptions and embed it.
+    Input: csv_path - The wine reviews CSV the descriptions are sampled from.
+    Input: n_queries - The number of queries.
+    Input: seed - Seed of the sample.
+    Input: model_name - The model that embedded the stored vectors.
+    Output: A float32 matrix with one query embedding per row.
+    """
+    descriptions = pd.read_csv(csv_path, usecols=['description'])['description'].dropna()
+    sample = descriptions.sample(n=min(n_queries, len(descriptions)), random_state=seed)
+    return encode_many(sample.tolist(), model_name=model_name)
+
+
+def ground_truth(matrix, documents, queries, k):
+    """
+    Purpose: Exact top-k document IDs of every query, computed with a brute-force scan of the full matrix.
+    Output: One list of IDs per query, ordered from best to worst.
+    """
+    indices, _ = exact_top_k(normalize_rows(matrix), queries, k)
+    return [[str(documents[row]['_id']) for row in row_indices] for row_indices in indices]
+
+
+def measure(store, queries, truth, k):
+    """
+    Purpose: recall@k and per-query latency of a vector store over the query set.
+    Input: store - A vector store (see vector_store.get_vector_store).
+    Input: queries - The query embeddings.
+    Input: truth - The exact top IDs per query, at least k of them.
+    Input: k - The number of results per query.
+    """
+    # One untimed query so connection setup and lazy initialisation do not count as latency.
+    store.search(queries[0], k)
+    latencies = []
+    recalls = []
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        results = store.search(query, k)
+        latencies.append(time.perf_counter() - started)
+        found = {str(result['_id']) for result in results}
+        recalls.append(len(found & set(expected[:k])) / min(k, len(expected)))
+    latencies = 1000 * np.asarray(latencies)
+    return {
+        'recall': float(np.mean(recalls)),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'qps': float(1000 / latencies.mean()),
+    }
+
+
+def sweep(backend, store, queries, truth, ks, values=None):
+    """
+    Purpose: Measure a store at every value of its tuning knob and every k, giving its recall@k vs. latency
+    curve. The knob is changed on the built store, so the index is only built once.
+    Output: A list of result rows.
+    """
+    knob = store.tuning_knob
+    if knob is None or not values:
+        values = DEFAULT_SWEEPS[knob]
+    rows = []
+    for value in values:
+        if knob is not None:
+            setattr(store, knob, value)
+        for k in ks:
+            row = {'backend': backend, 'knob': knob, 'value': value, 'k': k}
+            row.update(measure(store, queries, truth, k))
+            rows.append(row)
+            print(f"{backend} {knob}={value} k={k}: recall {row['recall']:.3f}, "
+                  f"p50 {row['p50_ms']:.2f} ms, p95 {row['p95_ms']:.2f} ms")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep the vector search knobs and report recall@k vs. latency.")
+    parser.add_argument('--backends', nargs='+', default=['mongo'],
+                        help=f"Backends to measure: mongo, mmap, {', '.join(LOCAL_BACKENDS)}")
+    parser.add_argument('--values', nargs='+', type=int, default=None,
+                        help="Knob values to try (num_candidates, n_probe or ef_search), instead of the defaults")
+    parser.add_argument('--k', nargs='+', type=int, default=[5, 10])
+    parser.add_argument('--queries', type=int, default=200, help="Size of the query set")
+    parser.add_argument('--csv', default='data/data_first10k.csv', help="CSV the query descriptions come from")
+    parser.add_argument('--field', default='gist_embeddings', help="The document field that holds the embedding")
+    parser.add_argument('--vector-file', default=None,
+                        help="Load the embeddings from this .npz file instead of MongoDB")
+    parser.add_argument('--store-dir', default=None, help="Embedding store directory for the mmap backend")
+    parser.add_argument('--output', default='data/vector_search_tuning.csv')
+    args = parser.parse_args()
+
+    collection = None
+    if 'mongo' in args.backends or not args.vector_file:
+        from open_ai_embeddings import get_database
+        db = get_database()
+        if db is None:
+            raise SystemExit(1)
+        collection = db['Wine']
+
+    if args.vector_file:
+        matrix, documents = load_embeddings_from_file(args.vector_file)
+    else:
+        matrix, documents = load_embeddings_from_mongo(collection, args.field)
+    queries = load_queries(args.csv, args.queries)
+    truth = ground_truth(matrix, documents, queries, max(args.k))
+    print(f"Ground truth for {len(queries)} queries over {len(documents)} vectors computed.")
+
+    results = []
+    for backend in args.backends:
+        if backend == 'mongo':
+            store = MongoVectorStore(collection, path=args.field)
+        elif backend == 'mmap':
+            store = get_vector_store('mmap', file_path=args.store_dir)
+        else:
+            started = time.perf_counter()
+            store = LOCAL_BACKENDS[backend](matrix, documents)
+            print(f"Built the {backend} index in {time.perf_counter() - started:.1f}s.")
+        results.extend(sweep(backend, store, queries, truth, args.k, args.values))
+
+    pd.DataFrame(results).to_csv(args.output, index=False)
+    print(f"Wrote {len(results)} measurements to {args.output}")
@@ -0,0 +1,415 @@
+import json
+import os
+import numpy as np
+from filter_index import FilterIndex, filters_to_mongo
+
+# Embedding fields that are stored on every document in the Wine collection. We never want to carry the raw
+# vectors around in the result documents, so they are projected out whenever documents are loaded.
+EMBEDDING_FIELDS = ('gist_embeddings', 'openai_embedding')
+# Bookkeeping the ingestion script stores for its syncs: the hash of the embedded text and, per embedding, the
+# hash of the text it was computed from. They are not wine metadata, so they are projected out as well.
+HASH_FIELDS = ('content_hash',) + tuple(field + '_hash' for field in EMBEDDING_FIELDS)
+
+
+def normalize_rows(matrix):
+    """
+    Purpose: Scale every row of the matrix to unit length so that a dot product is the cosine similarity.
+    Input: matrix - 2D float array of embeddings.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores, k):
+    """
+    Purpose: Return the indices of the k largest scores, ordered from best to worst.
+    Input: scores - 1D array of similarity scores.
+    Input: k - The number of indices to return.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    # argpartition is O(n) so we only pay for a full sort on the k winners.
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+def exact_top_k(vectors, queries, k=5, block_size=256, corpus_block_size=65536):
+    """
+    Purpose: Exact cosine top-k of every query against every stored vector, the ground truth the approximate
+    indexes are measured against. A block of queries is scored against one block of the corpus at a time with
+    one matrix multiplication; argpartition keeps the k winners of each block and merges them into the running
+    top-k of every query, and only the final k are sorted.
+    Input: vectors - 2D array of unit-normalized stored vectors (see normalize_rows).
+    Input: queries - 2D array with one query embedding per row (normalized here).
+    Input: k - The number of neighbors per query.
+    Input: block_size - Queries scored per matrix multiplication.
+    Input: corpus_block_size - Stored vectors scored per matrix multiplication. Together with block_size it
+                               bounds the (block_size x corpus_block_size) score matrix, whatever the corpus size.
+    Output: (indices, scores), both of shape (len(queries), min(k, n)), ordered from best to worst.
+    """
+    queries = normalize_rows(queries)
+    k = min(k, len(vectors))
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    best_scores = np.empty((len(queries), k), dtype=np.float32)
+    if k <= 0:
+        return indices, best_scores
+    for start in range(0, len(queries), block_size):
+        block = queries[start:start + block_size]
+        top_indices = np.empty((len(block), 0), dtype=np.int64)
+        top_scores = np.empty((len(block), 0), dtype=np.float32)
+        for corpus_start in range(0, len(vectors), corpus_block_size):
+            scores = block @ vectors[corpus_start:corpus_start + corpus_block_size].T
+            keep = min(k, scores.shape[1])
+            best = np.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+            top_indices = np.concatenate([top_indices, best + corpus_start], axis=1)
+            top_scores = np.concatenate([top_scores, np.take_along_axis(scores, best, axis=1)], axis=1)
+            if top_scores.shape[1] > k:
+                # Merge: the running top-k and the winners of this block compete for the k places.
+                best = np.argpartition(-top_scores, k - 1, axis=1)[:, :k]
+                top_indices = np.take_along_axis(top_indices, best, axis=1)
+                top_scores = np.take_along_axis(top_scores, best, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        indices[start:start + block_size] = np.take_along_axis(top_indices, order, axis=1)
+        best_scores[start:start + block_size] = np.take_along_axis(top_scores, order, axis=1)
+    return indices, best_scores
+
+
+def load_embeddings_from_mongo(collection, path='gist_embeddings'):
+    """
+    Purpose: Load every stored embedding from the MongoDB collection into a contiguous float32 matrix.
+    Input: collection - The MongoDB collection that holds the wine documents.
+    Input: path - The document field that holds the embedding.
+    Output: (matrix, documents) where documents[i] is the metadata of the wine in row i of the matrix.
+    """
+    query = {path: {'$exists': True}}
+    projection = {field: 0 for field in EMBEDDING_FIELDS + HASH_FIELDS if field != path}
+    count = collection.count_documents(query)
+
+    matrix = None
+    documents = []
+    for row, doc in enumerate(collection.find(query, projection)):
+        if row >= count:
+            break
+        vector = doc.pop(path)
+        # We only know the dimension once we have seen the first vector.
+        if matrix is None:
+            matrix = np.empty((count, len(vector)), dtype=np.float32)
+        matrix[row] = vector
+        documents.append(doc)
+
+    if matrix is None:
+        return np.empty((0, 0), dtype=np.float32), []
+    return matrix[:len(documents)], documents
+
+
+def save_embeddings_to_file(file_path, matrix, documents):
+    """
+    Purpose: Save an embedding matrix and its document metadata to a local .npz file.
+    Input: file_path - Where to write the file.
+    Input: matrix - 2D float array of embeddings.
+    Input: documents - List of metadata dictionaries, one per row of the matrix.
+    """
+    # Writing through a file handle stops numpy from silently appending '.npz' to the name. The file is written
+    # under a temporary name and renamed, so a backend worker that loads it never sees half of it.
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, embeddings=np.asarray(matrix, dtype=np.float32),
+                 documents=np.array(json.dumps(documents, default=str)))
+    os.replace(tmp_path, file_path)
+
+
+def load_embeddings_from_file(file_path):
+    """
+    Purpose: Load an embedding matrix and its document metadata written by save_embeddings_to_file.
+    Input: file_path - The .npz file to read.
+    Output: (matrix, documents)
+    """
+    with np.load(file_path) as data:
+        matrix = data['embeddings'].astype(np.float32, copy=False)
+        documents = json.loads(str(data['documents']))
+    return matrix, documents
+
+
+class MongoVectorStore:
+    """
+    Vector search through MongoDB Atlas $vectorSearch. This is the original behaviour of fetch_data.
+    """
+    tuning_knob = 'num_candidates'
+
+    def __init__(self, collection, index='gist_index', path='gist_embeddings', num_candidates=50):
+        self.collection = collection
+        self.index = index
+        self.path = path
+        self.num_candidates = num_candidates
+
+    def pipeline(self, embedding, k=5, filters=None):
+        """
+        Purpose: Build the $vectorSearch aggregation pipeline. Also used by the async backend with its own client.
+        Input: embedding - The query embedding as a list of floats.
+        Input: k - The number of documents to return.
+        Input: filters - Parsed metadata filters (see filter_index.parse_filters), applied by Atlas before scoring.
+        """
+        vector_search = {
+            "index": self.index,
+            "path": self.path,
+            # Plain floats, BSON cannot encode numpy scalars
+            "queryVector": [float(value) for value in embedding],
+            "numCandidates": max(self.num_candidates, k),
+            "limit": k
+        }
+        mongo_filter = filters_to_mongo(filters)
+        if mongo_filter:
+            vector_search["filter"] = mongo_filter
+        return [
+            {"$vectorSearch": vector_search},
+            {"$addFields": {"score": {"$meta": "vectorSearchScore"}}},
+            # The stored vectors and hashes are never needed by the caller, so they are not sent over the network.
+            {"$project": {field: 0 for field in EMBEDDING_FIELDS + HASH_FIELDS}}
+        ]
+
+    def search(self, embedding, k=5, filters=None):
+        """
+        Purpose: Return the k documents closest to the embedding.
+        Input: embedding - The query embedding as a list of floats.
+        Input: k - The number of documents to return.
+        Input: filters - Parsed metadata filters (see filter_index.parse_filters).
+        """
+        return list(self.collection.aggregate(self.pipeline(embedding, k, filters)))
+
+    def search_many(self, embeddings, k=5, filters=None):
+        """
+        Purpose: Run search for every row of embeddings. $vectorSearch takes a single query vector, so this is
+        one aggregate per query.
+        """
+        return [self.search(embedding, k, filters) for embedding in embeddings]
+
+
+class LocalVectorStore:
+    """
+    Base class for the in-process indexes. Holds the unit-normalized matrix and the per-row documents, and
+    turns row positions back into result documents shaped like the ones MongoDB returns. Metadata filters are
+    resolved to candidate rows by a FilterIndex built over the documents, before any vector is scored.
+    """
+    def __init__(self, matrix, documents):
+        if len(matrix) != len(documents):
+            raise ValueError("Each row of the embedding matrix needs exactly one document.")
+        self.vectors = normalize_rows(matrix)
+        self.documents = documents
+        self.filter_index = FilterIndex(documents)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def _query_vector(self, embedding):
+        return normalize_rows(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+
+    def _vector_rows(self, positions):
+        # Row of self.vectors that holds the document at each position. Indexes that reorder the matrix override it.
+        return positions
+
+    def _search_positions(self, query, positions, k):
+        # Exact scoring restricted to the documents at the given positions.
+        scores = self.vectors[self._vector_rows(positions)] @ query
+        best = top_k_indices(scores, k)
+        return self._to_documents(positions[best], scores[best])
+
+    def search_many(self, embeddings, k=5, filters=None):
+        """
+        Purpose: Return the k closest documents for every row of embeddings.
+        Input: embeddings - 2D array with one query embedding per row.
+        Input: k - The number of documents to return per query.
+        Input: filters - Parsed metadata filters applied to every query.
+        """
+        return [self.search(embedding, k, filters) for embedding in embeddings]
+
+    def _to_documents(self, positions, scores):
+        results = []
+        for position, score in zip(positions, scores):
+            doc = dict(self.documents[position])
+            doc['score'] = float(score)
+            results.append(doc)
+        return results
+
+
+class FlatVectorStore(LocalVectorStore):
+    """
+    Exact cosine search that scores every stored vector. Only sensible for small catalogs.
+    """
+    tuning_knob = None
+
+    def search(self, embedding, k=5, filters=None):
+        return self.search_many([embedding], k, filters)[0]
+
+    def search_many(self, embeddings, k=5, filters=None, block_size=256):
+        candidates = self.filter_index.candidates(filters)
+        vectors = self.vectors if candidates is None else self.vectors[candidates]
+        indices, scores = exact_top_k(vectors, embeddings, k, block_size)
+        if candidates is not None:
+            indices = candidates[indices]
+        return [self._to_documents(row_indices, row_scores) for row_indices, row_scores in zip(indices, scores)]
+
+
+class IVFVectorStore(LocalVectorStore):
+    """
+    Inverted-file index: the vectors are clustered with spherical k-means and a query only scores the members
+    of the n_probe clusters whose centroids are closest to it. More lists makes each list smaller (faster),
+    more probes visits more lists (better recall).
+    """
+    tuning_knob = 'n_probe'
+
+    def __init__(self, matrix, documents, n_lists=None, n_probe=8, n_iter=10, seed=0):
+        super().__init__(matrix, documents)
+        n = len(self.vectors)
+        if n_lists is None:
+            # The usual rule of thumb: about sqrt(n) lists.
+            n_lists = int(np.sqrt(n))
+        self.n_lists = max(1, min(n_lists, n))
+        self.n_probe = n_probe
+        self._build(n_iter, seed)
+
+    def _assign(self, vectors, block_size=65536):
+        labels = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            labels[start:start + block_size] = np.argmax(block @ self.centroids.T, axis=1)
+        return labels
+
+    def _build(self, n_iter, seed):
+        rng = np.random.default_rng(seed)
+        n = len(self.vectors)
+        if n == 0:
+            # Nothing to cluster: a single empty list, and search returns no documents.
+            self.centroids = np.empty((0, self.vectors.shape[1]), dtype=np.float32)
+            self.order = self.rows = np.empty(0, dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            return
+        # Training on a sample is enough to place the centroids and keeps the build time flat.
+        sample_size = min(n, self.n_lists * 256)
+        sample = self.vectors[rng.choice(n, sample_size, replace=False)]
+        self.centroids = sample[rng.choice(sample_size, self.n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            labels = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=self.n_lists) == 0
+            sums[empty] = self.centroids[empty]
+            self.centroids = normalize_rows(sums)
+
+        # Reorder the vectors so every list is one contiguous slice of the matrix.
+        labels = self._assign(self.vectors)
+        self.order = np.argsort(labels, kind='stable')
+        self.rows = np.empty_like(self.order)
+        self.rows[self.order] = np.arange(n)
+        self.vectors = self.vectors[self.order]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=self.n_lists))))
+
+    def _vector_rows(self, positions):
+        return self.rows[positions]
+
+    def search(self, embedding, k=5, filters=None):
+        if len(self) == 0:
+            return []
+        query = self._query_vector(embedding)
+        candidates = self.filter_index.candidates(filters)
+        allowed = None
+        if candidates is not None:
+            # A selective filter leaves fewer rows than the probed lists would hold, so score them all exactly.
+            if len(candidates) <= len(self) * self.n_probe / self.n_lists:
+                return self._search_positions(query, candidates, k)
+            allowed = np.zeros(len(self), dtype=bool)
+            allowed[candidates] = True
+
+        lists = top_k_indices(self.centroids @ query, self.n_probe)
+        rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+        if allowed is not None:
+            rows = rows[allowed[self.order[rows]]]
+            # Too few filtered rows in the probed lists: fall back to exact scoring of the candidates.
+            if len(rows) < k:
+                return self._search_positions(query, candidates, k)
+        scores = self.vectors[rows] @ query
+        best = top_k_indices(scores, k)
+        return self._to_documents(self.order[rows[best]], scores[best])
+
+
+class HNSWVectorStore(LocalVectorStore):
+    """
+    Hierarchical navigable small world graph index backed by hnswlib (optional dependency).
+    ef_search trades latency for recall at query time, M and ef_construction at build time.
+    Filtered queries score their candidate rows exactly instead of walking the graph.
+    """
+    tuning_knob = 'ef_search'
+
+    def __init__(self, matrix, documents, M=16, ef_construction=200, ef_search=64):
+        import hnswlib
+
+        super().__init__(matrix, documents)
+        self.ef_search = ef_search
+        self.index = None
+        if len(self) == 0:
+            # hnswlib cannot build a graph without vectors (an empty collection does not even know the dimension).
+            return
+        self.index = hnswlib.Index(space='ip', dim=self.vectors.shape[1])
+        self.index.init_index(max_elements=len(self.vectors), ef_construction=ef_construction, M=M)
+        self.index.add_items(self.vectors, np.arange(len(self.vectors)))
+
+    def search(self, embedding, k=5, filters=None):
+        return self.search_many([embedding], k, filters)[0]
+
+    def search_many(self, embeddings, k=5, filters=None):
+        if self.index is None:
+            return [[] for _ in embeddings]
+        candidates = self.filter_index.candidates(filters)
+        if candidates is not None:
+            return [self._search_positions(query, candidates, k) for query in normalize_rows(embeddings)]
+        # hnswlib answers a whole batch of queries in one call, spread over its own threads.
+        k = min(k, len(self))
+        self.index.set_ef(max(self.ef_search, k))
+        labels, distances = self.index.knn_query(normalize_rows(embeddings), k=k)
+        # hnswlib reports 1 - inner product for the 'ip' space.
+        return [self._to_documents(row_labels, 1.0 - row_distances)
+                for row_labels, row_distances in zip(labels, distances)]
+
+
+LOCAL_BACKENDS = {
+    'flat': FlatVectorStore,
+    'ivf': IVFVectorStore,
+    'hnsw': HNSWVectorStore,
+}
+
+
+def get_vector_store(backend='mongo', collection=None, path='gist_embeddings', file_path=None, refresh=False,
+                     **params):
+    """
+    Purpose: Build the vector store selected by name.
+    Input: backend - 'mongo' for Atlas $vectorSearch, 'mmap' for a memory-mapped embedding store directory
+                     (file_path, see embedding_store.py), or one of 'flat', 'ivf', 'hnsw' for an in-process index.
+    Input: collection - The MongoDB collection (required for 'mongo', or to build a local index without a file).
+    Input: path - The document field that holds the embedding.
+    Input: file_path - Optional .npz file to load the local index from. If it does not exist yet it is written
+                       after the embeddings are loaded from MongoDB, so the next start skips the database.
+    Input: refresh - Load a local index from MongoDB even when file_path exists, and rewrite the file (used after
+                     the collection was re-ingested).
+    Input: params - Backend specific knobs, e.g. num_candidates, n_lists, n_probe, M, ef_search.
+    """
+    if backend == 'mongo':
+        return MongoVectorStore(collection, path=path, **params)
+    if backend == 'mmap':
+        # Imported here because embedding_store itself builds on this module
+        from embedding_store import MmapVectorStore
+        return MmapVectorStore(file_path, **params)
+    if backend not in LOCAL_BACKENDS:
+        raise ValueError(f"Unknown vector store backend '{backend}'. "
+                         f"Choose from mongo, mmap, {', '.join(LOCAL_BACKENDS)}.")
+
+    if file_path and os.path.exists(file_path) and not (refresh and collection is not None):
+        matrix, documents = load_embeddings_from_file(file_path)
+    elif collection is not None:
+        matrix, documents = load_embeddings_from_mongo(collection, path)
+        if file_path:
+            save_embeddings_to_file(file_path, matrix, documents)
+    else:
+        raise ValueError("A local vector store needs either an existing embeddings file or a MongoDB collection.")
+    return LOCAL_BACKENDS[backend](matrix, documents, **params)
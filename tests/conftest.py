@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The scripts and the backend import their modules as siblings, so both directories go on the path.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+sys.path.insert(0, os.path.join(ROOT, 'demo', 'bb-backend'))
@@ -0,0 +1,226 @@
+import contextlib
+import os
+import threading
+import pytest
+from lexical_index import LexicalIndex
+from offline_stubs import HashEmbedder, InMemoryClient
+
+ADMIN_TOKEN = 'secret-token'
+
+
+@pytest.fixture(scope='module')
+def backend(tmp_path_factory):
+    # The backend reads its configuration when it is imported: in-memory MongoDB and the hash embedder.
+    lexical_index_path = str(tmp_path_factory.mktemp('lexical') / 'lexical_index.npz')
+    with pytest.MonkeyPatch.context() as patch:
+        for name, value in {'MONGODB_URI': 'memory://',
+                            'EMBEDDING_BACKEND': 'hash',
+                            'VECTOR_BACKEND': 'mongo',
+                            'HASH_EMBEDDING_DIM': '64',
+                            'CACHE_ADMIN_TOKEN': ADMIN_TOKEN,
+                            'LEXICAL_INDEX': lexical_index_path,
+                            'EMBEDDING_CACHE_PATH': str(tmp_path_factory.mktemp('cache') / 'embeddings.sqlite'),
+                            }.items():
+            patch.setenv(name, value)
+        import model_registry
+        patch.setattr(model_registry, 'HASH_EMBEDDING_DIM', 64)
+        client = InMemoryClient()
+        client.drop_database('BottleBuddy')
+        titles = [f"Wine {i} {tag}" for i, tag in enumerate(['dry red', 'sweet white', 'oaky red', 'crisp white'])]
+        vectors = HashEmbedder(dim=64).encode(titles)
+        LexicalIndex.build(range(len(titles)), titles).save(lexical_index_path)
+        # The hashes the ingestion script stores for its syncs are never returned.
+        client['BottleBuddy']['Wine'].insert_many([{'_id': i, 'title': title, 'gist_embeddings': vector.tolist(),
+                                                    'content_hash': 'hash', 'gist_embeddings_hash': 'hash'}
+                                                   for i, (title, vector) in enumerate(zip(titles, vectors))])
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            import app
+        yield app
+
+
+@pytest.fixture
+def embedded_texts(backend, monkeypatch):
+    texts = []
+    encode_many = backend.encode_many
+
+    def recording_encode_many(batch, **kwargs):
+        texts.extend(batch)
+        return encode_many(batch, **kwargs)
+
+    monkeypatch.setattr(backend, 'encode_many', recording_encode_many)
+    backend.query_cache.invalidate()
+    return texts
+
+
+def test_criteria_are_embedded_as_given_and_cached_normalized(backend, embedded_texts):
+    client = backend.app.test_client()
+    first = client.post('/find', json={'criteria': ['Dry ', 'red']})
+    assert first.status_code == 200 and first.json
+    assert embedded_texts == [" Dry , red, "]
+    # The same tags in another order and case are served from the cache.
+    assert client.post('/find', json={'criteria': ['RED', 'dry']}).json == first.json
+    assert embedded_texts == [" Dry , red, "]
+
+
+def test_batch_criteria_are_embedded_as_given(backend, embedded_texts):
+    response = backend.app.test_client().post('/find/batch', json={'queries': [['Sweet', 'white'], ['red']]})
+    assert response.status_code == 200 and len(response.json['results']) == 2
+    assert embedded_texts == [" Sweet, white, ", " red, "]
+    wines = [wine for result in response.json['results'] for wine in result['wines']]
+    assert wines and all(set(wine) == {'id', 'title', 'score'} for wine in wines)
+
+
+def test_cache_invalidate_needs_the_admin_token(backend, monkeypatch):
+    client = backend.app.test_client()
+    invalidations = backend.query_cache.stats()['invalidations']
+    assert client.post('/cache/invalidate').status_code == 403
+    assert client.post('/cache/invalidate', headers={'X-Admin-Token': 'wrong'}).status_code == 403
+    assert backend.query_cache.stats()['invalidations'] == invalidations
+    response = client.post('/cache/invalidate', headers={'X-Admin-Token': ADMIN_TOKEN})
+    assert response.status_code == 200 and response.json['invalidations'] == invalidations + 1
+    # Without a configured token the endpoint is disabled.
+    monkeypatch.setattr(backend, 'CACHE_ADMIN_TOKEN', None)
+    assert client.post('/cache/invalidate', headers={'X-Admin-Token': ADMIN_TOKEN}).status_code == 403
+
+
+@pytest.mark.parametrize('body', [{'criteria': ['dry', 3]}, {'criteria': 'dry red'}, {'criteria': [None]}])
+def test_find_rejects_criteria_that_are_not_strings(backend, body):
+    assert backend.app.test_client().post('/find', json=body).status_code == 400
+
+
+@pytest.mark.parametrize('path', ['/find', '/find/batch'])
+@pytest.mark.parametrize('body', [[['dry', 'red']], 'dry red', 3])
+def test_json_bodies_that_are_not_objects_are_rejected(backend, path, body):
+    assert backend.app.test_client().post(path, json=body).status_code == 400
+
+
+@pytest.mark.parametrize('queries', [[['dry', 3]], [['red'], [{'tag': 'dry'}]], [[['nested']]]])
+def test_find_batch_rejects_criteria_that_are_not_strings(backend, queries):
+    assert backend.app.test_client().post('/find/batch', json={'queries': queries}).status_code == 400
+
+
+def test_async_batch_searches_off_the_inference_thread(backend, monkeypatch):
+    pytest.importorskip('starlette')
+    from starlette.testclient import TestClient
+    import asgi_app
+
+    threads = {}
+    embed_batch, search_batch = backend.embed_batch, backend.search_batch
+
+    def recording_embed_batch(*args):
+        threads['embed'] = threading.current_thread().name
+        return embed_batch(*args)
+
+    def recording_search_batch(*args):
+        threads['search'] = threading.current_thread().name
+        return search_batch(*args)
+
+    monkeypatch.setattr(backend, 'embed_batch', recording_embed_batch)
+    monkeypatch.setattr(backend, 'search_batch', recording_search_batch)
+    with TestClient(asgi_app.app) as client:
+        response = client.post('/find/batch', json={'queries': [['dry', 'red'], ['white']], 'k': 2})
+        assert response.status_code == 200 and [len(r['wines']) for r in response.json()['results']] == [2, 2]
+        assert client.post('/find/batch', json={'queries': [['dry', 3]]}).status_code == 400
+        assert client.post('/find', json={'criteria': ['dry', 3]}).status_code == 400
+        assert client.post('/find', json=[['dry']]).status_code == 400
+        assert client.post('/find/batch', json=[['dry']]).status_code == 400
+    assert threads['embed'].startswith('inference') and threads['search'].startswith('search')
+
+
+def test_lexical_index_is_reloaded_when_the_collection_changes(backend, monkeypatch):
+    from open_ai_embeddings import mark_collection_updated
+    monkeypatch.setattr(backend.query_cache, 'version_check_interval', 0)
+    client = backend.app.test_client()
+    assert client.post('/find', json={'criteria': ['dry'], 'mode': 'hybrid'}).status_code == 200
+    previous = backend.lexical_index
+    assert len(previous) == 4
+
+    # A re-ingestion rewrites the index, then updates the collection marker.
+    LexicalIndex.build([0, 1], ["Wine 0 dry red", "Wine 1 sweet white"]).save(backend.LEXICAL_INDEX)
+    mark_collection_updated(backend.collection)
+    assert client.post('/find', json={'criteria': ['red'], 'mode': 'hybrid'}).status_code == 200
+    assert backend.lexical_index is not previous and len(backend.lexical_index) == 2
+
+    # A broken index file keeps the loaded one.
+    with open(backend.LEXICAL_INDEX, 'wb') as f:
+        f.write(b'broken')
+    mark_collection_updated(backend.collection)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        assert client.post('/find', json={'criteria': ['red'], 'mode': 'prune'}).status_code == 200
+    assert len(backend.lexical_index) == 2
+
+
+def test_local_vector_store_is_rebuilt_when_the_collection_changes(backend, monkeypatch, tmp_path):
+    from open_ai_embeddings import mark_collection_updated
+    from vector_store import FlatVectorStore, get_vector_store
+    vector_file = str(tmp_path / 'embeddings.npz')
+    monkeypatch.setattr(backend, 'VECTOR_BACKEND', 'flat')
+    monkeypatch.setattr(backend, 'VECTOR_FILE', vector_file)
+    monkeypatch.setattr(backend, 'vector_store', get_vector_store('flat', backend.collection, file_path=vector_file))
+    monkeypatch.setattr(backend.query_cache, 'version_listeners', [backend.rebuild_vector_store])
+    monkeypatch.setattr(backend.query_cache, 'version_check_interval', 0)
+    client = backend.app.test_client()
+    assert len(client.post('/find', json={'criteria': ['sparkling']}).json) == 4
+
+    # A re-ingestion adds a wine and updates the collection marker.
+    title = "Wine 4 sparkling rose"
+    vector = HashEmbedder(dim=64).encode([title])[0]
+    backend.collection.insert_one({'_id': 4, 'title': title, 'gist_embeddings': vector.tolist()})
+    try:
+        mark_collection_updated(backend.collection)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            assert title in client.post('/find', json={'criteria': ['sparkling']}).json
+        assert isinstance(backend.vector_store, FlatVectorStore) and len(backend.vector_store.documents) == 5
+        # The next start loads the rebuilt file instead of the old one.
+        assert len(get_vector_store('flat', file_path=vector_file).documents) == 5
+    finally:
+        backend.collection.delete_one({'_id': 4})
+        mark_collection_updated(backend.collection)
+
+
+def metric_value(text, sample):
+    for line in text.splitlines():
+        if line.startswith(sample + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0.0
+
+
+def test_metrics_count_find_requests_and_cache_hits(backend):
+    client = backend.app.test_client()
+    client.post('/cache/invalidate', headers={'X-Admin-Token': ADMIN_TOKEN})
+    before = client.get('/metrics').get_data(as_text=True)
+    assert client.post('/find', json={'criteria': ['oaky']}).status_code == 200
+    assert client.post('/find', json={'criteria': ['oaky']}).status_code == 200
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    after = response.get_data(as_text=True)
+
+    def increase(sample):
+        return metric_value(after, sample) - metric_value(before, sample)
+
+    assert increase('bottlebuddy_request_seconds_count{endpoint="/find"}') == 2
+    assert increase('bottlebuddy_request_seconds_bucket{endpoint="/find",le="+Inf"}') == 2
+    # Only the first request embeds and searches, the second is a cache hit.
+    assert increase('bottlebuddy_stage_seconds_count{stage="embed"}') == 1
+    assert increase('bottlebuddy_stage_seconds_count{stage="vector_search"}') == 1
+    assert increase('bottlebuddy_stage_seconds_count{stage="lookup"}') == 2
+    assert increase('bottlebuddy_query_cache_hits_total') == 1
+    assert increase('bottlebuddy_query_cache_misses_total') == 1
+    assert '# TYPE bottlebuddy_startup_seconds gauge' in after
+    assert metric_value(after, 'bottlebuddy_startup_seconds{phase="total"}') > 0
+
+
+def test_async_app_profiles_the_pool_work(backend, monkeypatch, tmp_path):
+    pytest.importorskip('starlette')
+    from starlette.testclient import TestClient
+    from metrics import SamplingProfiler
+    import asgi_app
+
+    monkeypatch.setattr(backend, 'profiler', SamplingProfiler(sample_rate=1.0, output_path=str(tmp_path / 'find.prof')))
+    backend.query_cache.invalidate()
+    with TestClient(asgi_app.app) as client:
+        assert client.post('/find', json={'criteria': ['crisp']}).status_code == 200
+        metrics = client.get('/metrics').text
+    # The encode and the search call
+    assert backend.profiler.samples == 2
+    assert metric_value(metrics, 'bottlebuddy_request_seconds_count{endpoint="/find"}') > 0
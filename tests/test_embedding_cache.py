@@ -0,0 +1,39 @@
+import numpy as np
+from embedding_cache import EmbeddingCache, cache_key
+
+
+def age(cache):
+    # Entries that were last used long ago, so a later use is always newer.
+    cache._conn.execute("UPDATE embeddings SET last_used = 0")
+    cache._conn.commit()
+
+
+def last_used(cache, text):
+    return cache._conn.execute("SELECT last_used FROM embeddings WHERE key = ?",
+                               (cache_key('model', text),)).fetchone()[0]
+
+
+def test_lookups_do_not_write_until_a_flush(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'), touch_flush_interval=3600)
+    cache.put_many('model', ['a', 'b'], [np.ones(2), np.zeros(2)])
+    age(cache)
+    stored = last_used(cache, 'a')
+    changes = cache._conn.total_changes
+    vectors = cache.get_many('model', ['a', 'b', 'c'])
+    assert vectors[0].tolist() == [1.0, 1.0] and vectors[2] is None
+    assert cache._conn.total_changes == changes and last_used(cache, 'a') == stored
+
+    # The next write records the last use of the hits as well.
+    cache.put_many('model', ['c'], [np.ones(2)])
+    assert last_used(cache, 'a') > stored and not cache._touched
+
+
+def test_touches_are_flushed_once_enough_pile_up(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'), touch_flush_size=2, touch_flush_interval=3600)
+    cache.put_many('model', ['a', 'b'], [np.ones(2), np.zeros(2)])
+    age(cache)
+    stored = last_used(cache, 'b')
+    cache.get_many('model', ['a'])
+    assert last_used(cache, 'b') == stored and len(cache._touched) == 1
+    cache.get_many('model', ['b'])
+    assert last_used(cache, 'b') > stored and not cache._touched
@@ -0,0 +1,66 @@
+import numpy as np
+from bson import ObjectId
+from offline_stubs import InMemoryCollection, InMemoryDatabase
+from embedding_store import EmbeddingStore, MmapVectorStore, export_from_mongo, import_to_mongo
+from filter_index import parse_filters
+
+
+def make_collection(n, dim=8):
+    rng = np.random.default_rng(0)
+    collection = InMemoryCollection(InMemoryDatabase('test'), 'Wine')
+    collection.insert_many([{'_id': ObjectId(), 'title': f"Wine {i}", 'country': 'US' if i % 3 == 0 else 'France',
+                             'gist_embeddings': rng.normal(size=dim).tolist()} for i in range(n)])
+    return collection
+
+
+def test_object_ids_survive_the_round_trip(tmp_path):
+    collection = make_collection(10)
+    export_from_mongo(collection, str(tmp_path / 'store'))
+    store = EmbeddingStore(str(tmp_path / 'store'))
+    doc = collection.find_one({})
+    assert store.ids[0] == doc['_id'] and isinstance(store.ids[0], ObjectId)
+    assert store.documents[0]['_id'] == doc['_id']
+    assert np.allclose(store.get(doc['_id']), doc['gist_embeddings'], atol=1e-2)
+
+    collection.update_many({}, {'$unset': {'gist_embeddings': ''}})
+    assert import_to_mongo(str(tmp_path / 'store'), collection) == 0
+    assert collection.count_documents({'gist_embeddings': {'$exists': True}}) == 10
+
+
+def test_import_does_not_create_documents(tmp_path):
+    collection = make_collection(10)
+    export_from_mongo(collection, str(tmp_path / 'store'))
+    gone = collection.find_one({})['_id']
+    collection.delete_one({'_id': gone})
+    assert import_to_mongo(str(tmp_path / 'store'), collection) == 1
+    assert collection.count_documents({}) == 9 and collection.find_one({'_id': gone}) is None
+
+
+def test_empty_store(tmp_path):
+    for dtype in ('float16', 'int8'):
+        path = str(tmp_path / dtype)
+        export_from_mongo(make_collection(0), path, dtype=dtype)
+        store = MmapVectorStore(path)
+        assert len(store) == 0
+        assert store.search(np.ones(8), k=5) == []
+        assert store.search(np.ones(8), k=5, filters=parse_filters({'country': 'US'})) == []
+
+
+def test_filtered_search(tmp_path):
+    export_from_mongo(make_collection(30), str(tmp_path / 'store'), dtype='int8')
+    store = MmapVectorStore(str(tmp_path / 'store'))
+    results = store.search(np.ones(8), k=5, filters=parse_filters({'country': 'US'}))
+    assert len(results) == 5 and all(wine['country'] == 'US' for wine in results)
+    assert [wine['score'] for wine in results] == sorted((wine['score'] for wine in results), reverse=True)
+
+
+def test_export_replaces_the_store_in_one_step(tmp_path):
+    path = str(tmp_path / 'store')
+    export_from_mongo(make_collection(10), path)
+    opened = EmbeddingStore(path)
+    export_from_mongo(make_collection(20), path, dtype='int8')
+    assert len(EmbeddingStore(path)) == 20 and EmbeddingStore(path).dtype == 'int8'
+    # Only the store is left, no temporary or previous directory
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['store']
+    # A worker that opened the previous store can still read it.
+    assert len(opened) == 10 and opened.unit_vectors(0, 10).shape == (10, 8)
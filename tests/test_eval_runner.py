@@ -0,0 +1,57 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+import eval_runner
+from KNN import build_features, clean_data, fit_feature_encoder, load_raw_data, run_evaluation, \
+    score_recommendations, select_reference_wines
+from eval_runner import fit_neighbor_index, nearest_neighbors
+from vector_store import normalize_rows
+
+SAMPLE_CSV = os.path.join(os.path.dirname(__file__), '..', 'data', 'data_first10k.csv')
+
+
+def test_one_fitted_index_serves_every_k():
+    rng = np.random.default_rng(0)
+    matrix = sparse.csr_matrix(rng.integers(0, 3, size=(40, 6)).astype(np.float32))
+    positions = np.array([0, 5, 39])
+    index = fit_neighbor_index(matrix)
+    for k in (1, 5, 10):
+        assert np.array_equal(nearest_neighbors(matrix, positions, k, index), nearest_neighbors(matrix, positions, k))
+
+
+def test_missing_neighbors_are_padded():
+    dense = normalize_rows(np.random.default_rng(0).normal(size=(3, 4)))
+    for matrix in (dense, sparse.csr_matrix(dense)):
+        neighbors = nearest_neighbors(matrix, np.array([0, 2]), 5)
+        assert neighbors.shape == (2, 5)
+        assert sorted(neighbors[0, :2]) == [1, 2] and sorted(neighbors[1, :2]) == [0, 1]
+        assert (neighbors[:, 2:] == -1).all()
+
+
+def test_padded_neighbors_are_not_rated():
+    data = pd.DataFrame({'taster_name': ['a', 'a', 'a'], 'title': ['x', 'y', 'z'], 'points': [90, 88, 80]})
+    references, points_lookup = select_reference_wines(['a'], data, top_n=1)
+    titles = np.array([['y', None, None]], dtype=object)
+    assert score_recommendations(references, points_lookup, titles, threshold=5) == [1.0]
+
+
+def test_knn_run_matches_the_knn_script(tmp_path, monkeypatch):
+    # The configuration of KNN.main(): 5 recommendations (6 neighbors with the wine itself), threshold 5, top 10.
+    monkeypatch.setattr(eval_runner, '_shared_matrices', {})
+    monkeypatch.setattr(eval_runner, '_shared_neighbor_indexes', {})
+    monkeypatch.setattr(eval_runner, '_shared_dir', str(tmp_path))
+    data, descriptions = eval_runner.load_dataset(SAMPLE_CSV)
+    data.to_pickle(tmp_path / 'data.pkl')
+    sparse.save_npz(eval_runner._matrix_path('knn') + '.npz', eval_runner.embed_dataset('knn', data, descriptions))
+    eval_runner._init_worker(str(tmp_path))
+    result = eval_runner.run_one('knn', 5, 5, 10)
+
+    cleaned = clean_data(load_raw_data(SAMPLE_CSV))
+    features = build_features(cleaned, fit_feature_encoder(cleaned))
+    model = NearestNeighbors(n_neighbors=6, metric='euclidean', algorithm='brute').fit(features)
+    expected = run_evaluation(model, cleaned['taster_name'].unique().tolist(), cleaned, features)
+    assert result['taster_scores'] == json.dumps(expected)
+    assert result['score'] == sum(expected) / len(expected)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from filter_index import FilterIndex, filters_key, filters_to_mongo, parse_filters
+from offline_stubs import matches
+
+COUNTRIES = ['US', 'France', 'Italy']
+PROVINCES = ['Oregon', 'California', 'Burgundy', 'Tuscany']
+VARIETIES = ['Pinot Noir', 'Chardonnay', 'Sangiovese']
+# Values a range column can hold in the collection: numbers, and the missing, null or text values that never
+# satisfy a MongoDB comparison.
+RANGE_VALUES = [None, 'n/a', True, 12, 15.5, 20, 30.0, 45, 88, 90, 92.5, 95]
+
+
+def make_documents(n, seed=0):
+    rng = np.random.default_rng(seed)
+    documents = []
+    for i in range(n):
+        doc = {'_id': i}
+        for column, values in (('country', COUNTRIES), ('province', PROVINCES), ('variety', VARIETIES),
+                               ('price', RANGE_VALUES), ('points', RANGE_VALUES)):
+            # Every column is sometimes missing altogether
+            if rng.random() < 0.9:
+                doc[column] = values[rng.integers(len(values))]
+        documents.append(doc)
+    return documents
+
+
+def random_filters(rng):
+    filters = {}
+    for column, values in (('country', COUNTRIES), ('province', PROVINCES), ('variety', VARIETIES)):
+        if rng.random() < 0.4:
+            chosen = rng.choice(values, size=rng.integers(1, 3), replace=False).tolist()
+            filters[column] = chosen if len(chosen) > 1 else chosen[0]
+    for column in ('price', 'points'):
+        if rng.random() < 0.5:
+            bounds = {}
+            if rng.random() < 0.7:
+                bounds['min'] = float(rng.choice([10, 15.5, 20, 88, 90]))
+            if rng.random() < 0.7:
+                bounds['max'] = int(rng.choice([15, 30, 45, 92, 95]))
+            filters[column] = bounds
+    return filters
+
+
+def test_candidates_match_the_mongo_filter():
+    documents = make_documents(400)
+    index = FilterIndex(documents)
+    rng = np.random.default_rng(1)
+    for _ in range(300):
+        parsed = parse_filters(random_filters(rng))
+        candidates = index.candidates(parsed)
+        if parsed is None:
+            assert candidates is None
+            continue
+        expected = [row for row, doc in enumerate(documents) if matches(doc, filters_to_mongo(parsed))]
+        assert candidates.tolist() == expected, parsed
+
+
+def test_id_filter_matches_the_mongo_filter():
+    documents = make_documents(50)
+    index = FilterIndex(documents)
+    parsed = {'_id': (3, 7, 49, 1000), 'country': ('US',)}
+    expected = [row for row, doc in enumerate(documents) if matches(doc, filters_to_mongo(parsed))]
+    assert index.candidates(parsed).tolist() == expected
+
+
+def test_categorical_values_match_the_same_wines_on_every_backend():
+    documents = [{'province': 'Oregon'}, {'province': 'oregon'}, {'province': 'Burgundy'}]
+    index = FilterIndex(documents)
+    for filters, expected in (({'province': ' Oregon '}, [0]), ({'province': 'oregon'}, [1]),
+                              ({'province': 'OREGON'}, [])):
+        parsed = parse_filters(filters)
+        assert index.candidates(parsed).tolist() == expected
+        assert [row for row, doc in enumerate(documents) if matches(doc, filters_to_mongo(parsed))] == expected
+    # Filters that select the same wines share a cache key.
+    assert filters_key(parse_filters({'province': ['Oregon ', 'Burgundy']})) == \
+        filters_key(parse_filters({'province': ['Burgundy', 'Oregon']}))
+    assert filters_key(parse_filters({'province': 'Oregon'})) != filters_key(parse_filters({'province': 'oregon'}))
+    assert parse_filters({'price': {}, 'points': {'min': None}}) is None
+    with pytest.raises(ValueError):
+        parse_filters({'price': {'max': '30'}})
@@ -0,0 +1,123 @@
+import os
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.neighbors import NearestNeighbors
+from sklearn.preprocessing import StandardScaler
+from KNN import build_features, clean_data, fit_feature_encoder, load_raw_data, run_evaluation
+
+SAMPLE_CSV = os.path.join(os.path.dirname(__file__), '..', 'data', 'data_first10k.csv')
+
+
+def original_clean_data(df):
+    # clean_data of the baseline commit.
+    df.drop(columns=['description', 'region_1', 'region_2', 'taster_twitter_handle'], inplace=True)
+    df_drop_na = df.dropna(subset=['variety', 'province', 'country'])
+    df_drop_na['designation'] = df_drop_na['designation'].fillna('no designation')
+    df_drop_na['price'] = df_drop_na.groupby(['winery', 'variety'])['price'].transform(lambda x: x.fillna(x.mean()))
+    df_drop_na['price'] = df_drop_na.groupby(['variety'])['price'].transform(lambda x: x.fillna(x.mean()))
+    df_drop_na = df_drop_na.dropna(subset=['price'])
+    for column, min_count in [('winery', 2), ('designation', 2), ('variety', 100), ('province', 100)]:
+        value_counts = df_drop_na[column].value_counts()
+        df_drop_na = df_drop_na[~df_drop_na[column].isin(value_counts[value_counts < min_count].index)]
+    return df_drop_na.reset_index(drop=True)
+
+
+def original_run_evaluation(model, tasters, data, scaled_data):
+    # run_evaluation of the baseline commit: one kneighbors call and one title lookup per reference wine.
+    final_percentages = []
+    wine_names = data['title']
+    for name in tasters:
+        tasters_differences = []
+        voted_wines = data[data['taster_name'] == name]
+        voted_wines.sort_values(by='points', ascending=False, inplace=True)
+        voters_top_10 = voted_wines.head(10)
+        point_values = voters_top_10['points'].tolist()
+        indexes = voters_top_10.index.tolist()
+        for i in range(len(indexes)):
+            recommended_point_differences = []
+            _, indices = model.kneighbors(scaled_data[indexes[i]].reshape(1, -1))
+            nearest_neighbor_names = wine_names.iloc[indices[0]][1:]
+            for nearest_neighbor_name in nearest_neighbor_names:
+                if nearest_neighbor_name in voted_wines['title'].values:
+                    row = voted_wines[voted_wines['title'] == nearest_neighbor_name]
+                    recommended_point_differences.append(abs(point_values[i] - row['points'].values[0]))
+            meets_threshold_count = sum(1 for x in recommended_point_differences if x <= 5)
+            if len(recommended_point_differences) != 0:
+                tasters_differences.append(meets_threshold_count / len(recommended_point_differences))
+        if len(tasters_differences) != 0:
+            final_percentages.append(sum(tasters_differences) / len(tasters_differences))
+    return final_percentages
+
+
+class TieOrderedModel:
+    """
+    Answers the single-row kneighbors calls of the original loop with the tie order of ordered_neighbors. The
+    loop is handed the row positions as its 'scaled_data', so every query row is [[position]].
+    """
+    def __init__(self, model, scaled_data):
+        self.model = model
+        self.scaled_data = scaled_data
+
+    def kneighbors(self, position):
+        return None, ordered_neighbors(self.model, self.scaled_data, position[:, 0], self.model.n_neighbors)
+
+
+@pytest.fixture(scope='module')
+def original_pipeline():
+    # The dense, centered get_dummies + StandardScaler features of the baseline main().
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        data = pd.get_dummies(original_clean_data(pd.read_csv(SAMPLE_CSV)),
+                              columns=['country', 'designation', 'province', 'variety', 'winery'])
+        scaled_data = StandardScaler().fit_transform(data.drop(columns=['title', 'taster_name', 'points']))
+    model = NearestNeighbors(n_neighbors=6, metric='euclidean').fit(scaled_data)
+    return data, scaled_data, model
+
+
+def test_sparse_pipeline_matches_the_original_loop():
+    cleaned = clean_data(load_raw_data(SAMPLE_CSV))
+    features = build_features(cleaned, fit_feature_encoder(cleaned))
+    knn_model = NearestNeighbors(n_neighbors=6, metric='euclidean', algorithm='brute').fit(features)
+    tasters = cleaned['taster_name'].unique().tolist()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        # The loop sorted int64 points; its order among equal points depends on the dtype.
+        expected = original_run_evaluation(knn_model, tasters, cleaned.astype({'points': np.int64}), features)
+    percentages = run_evaluation(knn_model, tasters, cleaned, features)
+    assert percentages == expected
+    # Not the 74.17% of the dense features: identical wines are equally far away, and which of them kneighbors
+    # returns first differs between the dense and the sparse matrix.
+    assert sum(percentages) / len(percentages) == pytest.approx(0.7566666666666666)
+
+
+def test_vectorized_evaluation_matches_the_original_loop(original_pipeline):
+    data, scaled_data, model = original_pipeline
+    tasters = data['taster_name'].unique().tolist()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = original_run_evaluation(model, tasters, data, scaled_data)
+    # The score the baseline main() prints for data_first10k.csv.
+    assert sum(expected) / len(expected) == 0.7416666666666666
+    assert run_evaluation(model, tasters, data, scaled_data) == expected
+
+
+def test_vectorized_evaluation_matches_on_repeated_titles():
+    # Titles rated twice with different points, missing tasters and tasters with fewer than 10 wines: the cases
+    # where the points lookup of the vectorized scoring could differ from the loop. (The loop itself fails on
+    # missing titles, which clean_data never leaves.)
+    rng = np.random.default_rng(0)
+    n = 300
+    data = pd.DataFrame({
+        'taster_name': rng.choice(['a', 'b', 'c', None], size=n, p=[0.5, 0.3, 0.02, 0.18]),
+        'title': rng.choice([f"Wine {i}" for i in range(60)], size=n),
+        'points': rng.integers(84, 96, size=n),
+    })
+    scaled_data = rng.integers(0, 3, size=(n, 4)).astype(float)
+    model = NearestNeighbors(n_neighbors=6).fit(scaled_data)
+    tasters = data['taster_name'].unique().tolist()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = original_run_evaluation(model, tasters, data, scaled_data)
+    assert run_evaluation(model, tasters, data, scaled_data) == expected
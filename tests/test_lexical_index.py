@@ -0,0 +1,70 @@
+import math
+import numpy as np
+from filter_index import parse_filters
+from lexical_index import RRF_K, LexicalIndex, lexical_search, tokenize
+from vector_store import FlatVectorStore
+
+TEXTS = ["Dry red wine with cherry", "Sweet white wine", "Red red cherry jam", "Crisp citrus white", ""]
+
+
+def bm25(texts, query, k1=1.2, b=0.75):
+    # Textbook BM25 with the same smoothed idf as the index.
+    documents = [tokenize(text) for text in texts]
+    average_length = sum(map(len, documents)) / len(documents)
+    scores = []
+    for tokens in documents:
+        score = 0.0
+        for term in set(tokenize(query)):
+            document_freq = sum(term in other for other in documents)
+            freq = tokens.count(term)
+            if freq:
+                idf = math.log(1 + (len(documents) - document_freq + 0.5) / (document_freq + 0.5))
+                score += idf * freq * (k1 + 1) / (freq + k1 * (1 - b + b * len(tokens) / average_length))
+        scores.append(score)
+    return np.array(scores)
+
+
+def test_bm25_scores(tmp_path):
+    index = LexicalIndex.build(['a', 'b', 'c', 'd', 'e'], TEXTS)
+    for query in ("red cherry", "white wine", "Red, RED!", "unknown words"):
+        assert np.allclose(index.scores(query), bm25(TEXTS, query), rtol=1e-5)
+    ids, scores = index.top("red cherry", n=10)
+    # Documents without a query term are left out, the rest ordered by score.
+    assert ids == ['c', 'a'] and scores[0] > scores[1] > 0
+    index.save(str(tmp_path / 'index.npz'))
+    loaded = LexicalIndex.load(str(tmp_path / 'index.npz'))
+    assert loaded.ids == index.ids and np.allclose(loaded.scores("white wine"), index.scores("white wine"))
+
+
+def make_store():
+    vectors = np.eye(5, dtype=np.float32) + 0.1
+    documents = [{'_id': i, 'title': text, 'price': 10.0 * (i + 1)} for i, text in enumerate(TEXTS)]
+    return FlatVectorStore(vectors, documents), LexicalIndex.build(range(5), TEXTS)
+
+
+def test_hybrid_mode_fuses_the_ranks():
+    store, index = make_store()
+    query_vector = np.array([0.0, 1.0, 0.0, 0.5, 0.0])
+    results = lexical_search(store, index, query_vector, "red cherry", k=5, mode='hybrid', candidates=5)
+    dense_order = [doc['_id'] for doc in store.search(query_vector, 5)]
+    lexical_order, _ = index.top("red cherry", 5)
+    expected = {doc_id: 1 / (RRF_K + dense_order.index(doc_id)) +
+                (1 / (RRF_K + lexical_order.index(doc_id)) if doc_id in lexical_order else 0.0)
+                for doc_id in dense_order}
+    assert [doc['_id'] for doc in results] == sorted(expected, key=lambda doc_id: -expected[doc_id])
+    assert all(math.isclose(doc['score'], expected[doc['_id']], rel_tol=1e-9) for doc in results)
+    # The lexical matches move up against the dense order.
+    assert results[0]['_id'] == 2 and dense_order[0] == 1
+
+
+def test_prune_mode_scores_the_lexical_candidates_and_tops_up():
+    store, index = make_store()
+    query_vector = np.array([0.0, 1.0, 0.0, 0.5, 0.0])
+    results = lexical_search(store, index, query_vector, "red cherry", k=2, mode='prune')
+    assert sorted(doc['_id'] for doc in results) == [0, 2]
+    # Only one lexical candidate passes the filter, the second result comes from the dense search.
+    filters = parse_filters({'price': {'min': 25}})
+    results = lexical_search(store, index, query_vector, "red cherry", k=2, mode='prune', filters=filters)
+    assert [doc['_id'] for doc in results][0] == 2 and len(results) == 2 and all(doc['price'] >= 25 for doc in results)
+    # Without any indexed query term every mode is the dense search.
+    assert lexical_search(store, index, query_vector, "zzz", k=3, mode='hybrid') == store.search(query_vector, 3)
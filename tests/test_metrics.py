@@ -0,0 +1,69 @@
+from metrics import MetricsRegistry, SamplingProfiler
+
+
+def test_render_uses_the_prometheus_text_format():
+    registry = MetricsRegistry()
+    errors = registry.counter('errors_total', 'Errors.', ['stage'])
+    startup = registry.gauge('startup_seconds', 'Startup.', ['phase'])
+    latency = registry.histogram('latency_seconds', 'Latency.', ['endpoint'], buckets=(0.1, 1.0))
+    errors.inc(stage='embed')
+    errors.inc(2, stage='embed')
+    errors.inc(stage='say "hi"\n')
+    startup.set(1.5, phase='total')
+    for value in (0.05, 0.5, 0.7, 3.0):
+        latency.observe(value, endpoint='/find')
+    registry.collectors.append(lambda: [('cache_entries', 'Entries.', 'gauge', (), {(): 7})])
+
+    assert registry.render().splitlines() == [
+        '# HELP errors_total Errors.',
+        '# TYPE errors_total counter',
+        'errors_total{stage="embed"} 3',
+        'errors_total{stage="say \\"hi\\"\\n"} 1',
+        '# HELP startup_seconds Startup.',
+        '# TYPE startup_seconds gauge',
+        'startup_seconds{phase="total"} 1.5',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{endpoint="/find",le="0.1"} 1',
+        'latency_seconds_bucket{endpoint="/find",le="1.0"} 3',
+        'latency_seconds_bucket{endpoint="/find",le="+Inf"} 4',
+        'latency_seconds_sum{endpoint="/find"} 4.25',
+        'latency_seconds_count{endpoint="/find"} 4',
+        '# HELP cache_entries Entries.',
+        '# TYPE cache_entries gauge',
+        'cache_entries 7',
+    ]
+
+
+def test_histogram_times_blocks_that_raise():
+    registry = MetricsRegistry()
+    latency = registry.histogram('latency_seconds', 'Latency.')
+    try:
+        with latency.time():
+            raise ValueError
+    except ValueError:
+        pass
+    assert 'latency_seconds_count 1' in registry.render().splitlines()
+
+
+def test_a_failing_collector_does_not_break_the_scrape(capsys):
+    registry = MetricsRegistry()
+    registry.counter('errors_total', 'Errors.').inc()
+
+    def broken():
+        raise RuntimeError("gone")
+
+    registry.collectors.append(broken)
+    assert 'errors_total 1' in registry.render().splitlines()
+    assert 'gone' in capsys.readouterr().out
+
+
+def test_profiler_samples_and_dumps(tmp_path):
+    output = tmp_path / 'find.prof'
+    profiler = SamplingProfiler(sample_rate=1.0, output_path=str(output), dump_every=2)
+    for _ in range(2):
+        with profiler.profile():
+            sum(range(1000))
+    assert profiler.samples == 2 and output.exists()
+    with SamplingProfiler().profile():
+        pass
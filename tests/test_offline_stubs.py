@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from pymongo import DeleteOne, InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from offline_stubs import HashEmbedder, InMemoryClient, InMemoryCollection, InMemoryDatabase, matches
+
+
+@pytest.fixture
+def collection():
+    return InMemoryCollection(InMemoryDatabase('test'), 'Wine')
+
+
+def test_matches_operators():
+    doc = {'price': 20, 'country': 'US', 'points': None}
+    assert matches(doc, {'price': {'$gte': 10, '$lt': 30}, 'country': {'$in': ['US', 'France']}})
+    assert not matches(doc, {'price': {'$gt': 20}})
+    assert matches(doc, {'$or': [{'country': 'Italy'}, {'price': 20}]})
+    assert matches(doc, {'region': {'$exists': False}, 'country': {'$ne': 'Italy'}})
+    # Comparisons never match missing or null values, like MongoDB.
+    assert not matches(doc, {'points': {'$gte': 0}}) and not matches(doc, {'region': {'$lt': 5}})
+
+
+def test_bulk_write_counts(collection):
+    collection.insert_many([{'_id': i, 'n': i} for i in range(3)])
+    result = collection.bulk_write([
+        InsertOne({'_id': 3, 'n': 3}),
+        UpdateOne({'_id': 0}, {'$set': {'n': 10}}),
+        UpdateOne({'_id': 1}, {'$set': {'n': 1}}),
+        UpdateOne({'_id': 9}, {'$set': {'n': 9}}, upsert=True),
+        ReplaceOne({'_id': 2}, {'m': 2}),
+        DeleteOne({'_id': 3}),
+        UpdateOne({'_id': 42}, {'$set': {'n': 42}}),
+    ])
+    assert (result.inserted_count, result.matched_count, result.modified_count, result.upserted_count,
+            result.deleted_count) == (1, 3, 2, 1, 1)
+    assert result.upserted_ids == {3: 9}
+    assert collection.find_one({'_id': 2}) == {'_id': 2, 'm': 2}
+    assert collection.find_one({'_id': 42}) is None
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({'_id': 0})
+
+
+def test_vector_search_is_exact_and_filtered(collection):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(50, 8)).astype(np.float32)
+    collection.insert_many([{'_id': i, 'v': vectors[i].tolist(), 'even': i % 2 == 0} for i in range(50)])
+    query = rng.normal(size=8).astype(np.float32)
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = np.argsort(-(unit @ query))[:5].tolist()
+    pipeline = [{'$vectorSearch': {'index': 'i', 'path': 'v', 'queryVector': query.tolist(), 'numCandidates': 10,
+                                   'limit': 5}},
+                {'$addFields': {'score': {'$meta': 'vectorSearchScore'}}}, {'$project': {'v': 0}}]
+    results = list(collection.aggregate(pipeline))
+    assert [doc['_id'] for doc in results] == expected
+    assert all(0 <= doc['score'] <= 1 and 'v' not in doc for doc in results)
+
+    pipeline[0]['$vectorSearch']['filter'] = {'even': True}
+    assert all(doc['_id'] % 2 == 0 for doc in collection.aggregate(pipeline))
+    pipeline[0]['$vectorSearch']['numCandidates'] = 2
+    with pytest.raises(OperationFailure):
+        list(collection.aggregate(pipeline))
+
+
+def test_clients_share_databases_and_hash_embedder_is_deterministic():
+    InMemoryClient()['shared']['Wine'].insert_one({'_id': 1})
+    assert InMemoryClient()['shared']['Wine'].count_documents({}) == 1
+    InMemoryClient().drop_database('shared')
+    embedder = HashEmbedder(dim=32)
+    a, b = embedder.encode(["dry red wine", "red wine dry"])
+    assert np.allclose(a, b) and np.isclose(np.linalg.norm(a), 1)
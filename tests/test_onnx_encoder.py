@@ -0,0 +1,69 @@
+import threading
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('sentence_transformers')
+pytest.importorskip('onnxruntime')
+pytest.importorskip('tokenizers')
+
+import model_registry
+import onnx_encoder
+
+TEXTS = ["A crisp white wine with citrus notes.", "dry red", "Ripe black cherry, oak and a long finish."]
+
+
+@pytest.fixture
+def tiny_model(tmp_path):
+    # A randomly initialised two-layer BERT saved as a SentenceTransformer, so nothing is downloaded.
+    from sentence_transformers import SentenceTransformer, models
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    words = sorted({word for text in TEXTS for word in text.lower().replace('.', ' ').replace(',', ' ').split()})
+    vocab_file = tmp_path / 'vocab.txt'
+    vocab_file.write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '.', ','] + words))
+    transformer_dir = str(tmp_path / 'transformer')
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=7 + len(words), hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=64, max_position_embeddings=64)
+    BertModel(config).save_pretrained(transformer_dir)
+    BertTokenizerFast(vocab_file=str(vocab_file)).save_pretrained(transformer_dir)
+
+    transformer = models.Transformer(transformer_dir, max_seq_length=32)
+    pooling = models.Pooling(transformer.get_word_embedding_dimension(), pooling_mode='mean')
+    model_dir = str(tmp_path / 'model')
+    SentenceTransformer(modules=[transformer, pooling, models.Normalize()], device='cpu').save(model_dir)
+    return model_dir
+
+
+def test_get_model_exports_on_first_onnx_load(tiny_model, tmp_path, monkeypatch):
+    monkeypatch.setattr(onnx_encoder, 'ONNX_CACHE_DIR', str(tmp_path / 'onnx'))
+    monkeypatch.setattr(model_registry, '_models', {})
+    monkeypatch.delenv('EMBEDDING_DEVICE', raising=False)
+
+    # The export runs inside get_model and loads the torch model through get_model again; a deadlock would hang
+    # the thread instead of failing, so it is run with a timeout.
+    loaded = {}
+
+    def load():
+        try:
+            loaded['model'] = model_registry.get_model(tiny_model, backend='onnx')
+        except Exception as e:
+            loaded['error'] = e
+
+    thread = threading.Thread(target=load, daemon=True)
+    thread.start()
+    thread.join(timeout=300)
+    assert not thread.is_alive(), "get_model(backend='onnx') did not return"
+    if 'error' in loaded:
+        raise loaded['error']
+    assert isinstance(loaded['model'], onnx_encoder.OnnxEncoder)
+
+    reference = model_registry.get_model(tiny_model, device='cpu', backend='torch').encode(TEXTS)
+    exported = loaded['model'].encode(TEXTS)
+    assert exported.shape == reference.shape
+    cosines = (reference * exported).sum(axis=1)
+    assert cosines.min() > 0.95
+    # The second load comes from the cache instead of exporting again.
+    assert model_registry.get_model(tiny_model, backend='onnx') is loaded['model']
+    assert np.allclose(onnx_encoder.load_onnx_encoder(tiny_model).encode(TEXTS), exported, atol=1e-6)
@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import time
+import pytest
+from query_cache import QueryCache
+
+
+def test_hit_and_miss():
+    cache = QueryCache()
+    calls = []
+    compute = lambda: calls.append(1) or ['wine']
+    assert cache.get_or_compute('key', compute) == ['wine']
+    assert cache.get_or_compute('key', compute) == ['wine']
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+
+def test_expired_and_empty_results_are_recomputed():
+    cache = QueryCache(ttl=0)
+    calls = []
+    cache.get_or_compute('key', lambda: calls.append(1) or ['wine'])
+    cache.get_or_compute('key', lambda: calls.append(1) or ['wine'])
+    assert len(calls) == 2
+    cache = QueryCache()
+    cache.get_or_compute('empty', lambda: [])
+    assert cache.stats()['entries'] == 0
+
+
+def test_lru_eviction():
+    cache = QueryCache(max_entries=2)
+    for key in ('a', 'b', 'a', 'c'):
+        cache.get_or_compute(key, lambda key=key: [key])
+    assert cache.stats()['evictions'] == 1
+    assert cache.get_or_compute('a', lambda: ['recomputed']) == ['a']
+    assert cache.get_or_compute('b', lambda: ['recomputed']) == ['recomputed']
+
+
+def test_concurrent_requests_are_coalesced():
+    cache = QueryCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ['wine']
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('key', compute)))
+               for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while cache.stats()['coalesced'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [['wine']] * 4
+    assert len(calls) == 1
+
+
+def test_errors_reach_the_waiters_and_are_not_cached():
+    cache = QueryCache()
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute('key', lambda: (_ for _ in ()).throw(RuntimeError('search failed')))
+    assert cache.get_or_compute('key', lambda: ['wine']) == ['wine']
+
+
+def test_version_change_invalidates():
+    version = [1]
+    cache = QueryCache(version_fn=lambda: version[0], version_check_interval=0)
+    cache.get_or_compute('key', lambda: ['old'])
+    assert cache.get_or_compute('key', lambda: ['new']) == ['old']
+    version[0] = 2
+    assert cache.get_or_compute('key', lambda: ['new']) == ['new']
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_async_version_check_runs_off_the_event_loop():
+    loop_threads = []
+    cache = QueryCache(version_fn=lambda: loop_threads.append(threading.current_thread()) or 1,
+                       version_check_interval=0)
+
+    async def main():
+        async def compute():
+            return ['wine']
+        await cache.get_or_compute_async('key', compute)
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(main())
+    assert loop_threads and loop_thread not in loop_threads
+
+
+def test_async_cancelled_waiter_does_not_cancel_the_others():
+    cache = QueryCache()
+
+    async def main():
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return ['wine']
+
+        owner = asyncio.create_task(cache.get_or_compute_async('key', compute))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(cache.get_or_compute_async('key', compute)) for _ in range(3)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(owner, *waiters[1:])
+        assert waiters[0].cancelled()
+        return results
+
+    assert asyncio.run(main()) == [['wine']] * 3
+    assert cache.stats()['entries'] == 1
+
+
+def test_async_cancelled_owner_hands_over_to_a_waiter():
+    cache = QueryCache()
+    calls = []
+
+    async def main():
+        release = asyncio.Event()
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return ['wine']
+
+        owner = asyncio.create_task(cache.get_or_compute_async('key', compute))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(cache.get_or_compute_async('key', compute)) for _ in range(2)]
+        await asyncio.sleep(0)
+        owner.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.wait_for(asyncio.gather(*waiters), 5)
+        assert owner.cancelled()
+        # A later request is served from the cache instead of waiting on the abandoned computation.
+        later = await asyncio.wait_for(cache.get_or_compute_async('key', compute), 5)
+        return results, later
+
+    results, later = asyncio.run(main())
+    assert results == [['wine']] * 2 and later == ['wine']
+    assert len(calls) == 2
+
+
+def test_version_listeners_run_before_the_invalidation():
+    version = [1]
+    cache = QueryCache(version_fn=lambda: version[0], version_check_interval=0)
+    seen = []
+    cache.version_listeners.append(lambda new_version: seen.append((new_version, cache.stats()['invalidations'])))
+    cache.version_listeners.append(lambda new_version: 1 / 0)  # a failing listener does not stop the others
+    cache.get_or_compute('key', lambda: ['old'])
+    assert seen == []
+    version[0] = 2
+    assert cache.get_or_compute('key', lambda: ['new']) == ['new']
+    assert seen == [(2, 0)] and cache.stats()['invalidations'] == 1
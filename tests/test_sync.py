@@ -0,0 +1,143 @@
+import pandas as pd
+import pytest
+from bson import ObjectId
+from offline_stubs import InMemoryCollection, InMemoryDatabase
+from open_ai_embeddings import content_hash, get_resume_cursor, process_csv_file, save_resume_cursor, sync_csv_file
+
+
+class CountingEmbedder:
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts):
+        self.texts.extend(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def make_rows(n):
+    return pd.DataFrame({
+        'title': [f"Winery {i} 2015 Red" for i in range(n)],
+        'description': [f"Notes of cherry number {i}." for i in range(n)],
+        'country': 'US', 'province': 'Oregon', 'variety': 'Pinot Noir', 'winery': [f"Winery {i}" for i in range(n)],
+        'price': [10.0 + i for i in range(n)], 'points': 90,
+    })
+
+
+@pytest.fixture
+def ingested(tmp_path):
+    rows = make_rows(20)
+    csv_path = tmp_path / 'wines.csv'
+    rows.to_csv(csv_path, index=False)
+    collection = InMemoryCollection(InMemoryDatabase('test'), 'Wine')
+    process_csv_file(str(csv_path), collection, embed_fn=CountingEmbedder(), batch_size=4, max_workers=2,
+                     resume=False)
+    # Embeddings of another model, which a sync of openai_embedding must not drop.
+    for doc_id in range(20):
+        collection.update_one({'_id': doc_id}, {'$set': {'gist_embeddings': [0.5, 0.5],
+                                                         'gist_embeddings_hash': content_hash(
+                                                             rows['title'][doc_id], rows['description'][doc_id])}})
+    return rows, csv_path, collection
+
+
+def sync(csv_path, collection, **kwargs):
+    embedder = CountingEmbedder()
+    summary = sync_csv_file(str(csv_path), collection, embed_fn=embedder, batch_size=4, max_workers=2, **kwargs)
+    return summary, embedder
+
+
+def test_unchanged_file_embeds_nothing(ingested):
+    _, csv_path, collection = ingested
+    summary, embedder = sync(csv_path, collection)
+    assert summary['unchanged'] == 20 and summary['embedded'] == 0 and not embedder.texts
+
+
+def test_row_inserted_in_the_middle_only_embeds_that_row(ingested):
+    rows, csv_path, collection = ingested
+    new_row = make_rows(21).iloc[[20]]
+    pd.concat([rows.iloc[:5], new_row, rows.iloc[5:]]).to_csv(csv_path, index=False)
+    summary, embedder = sync(csv_path, collection)
+    assert (summary['new'], summary['unchanged'], summary['deleted'], summary['embedded']) == (1, 20, 0, 1)
+    assert embedder.texts == ["Winery 20 2015 Red Notes of cherry number 20."]
+    assert collection.find_one({'_id': 20})['title'] == "Winery 20 2015 Red"
+    assert collection.count_documents({}) == 21
+    assert collection.count_documents({'gist_embeddings': {'$exists': True}}) == 20
+
+
+def test_row_deleted_in_the_middle_embeds_nothing(ingested):
+    rows, csv_path, collection = ingested
+    rows.drop(index=3).to_csv(csv_path, index=False)
+    summary, embedder = sync(csv_path, collection)
+    assert (summary['deleted'], summary['unchanged'], summary['embedded']) == (1, 19, 0)
+    assert not embedder.texts
+    assert collection.find_one({'_id': 3}) is None and collection.count_documents({}) == 19
+
+
+def test_edited_row_keeps_its_id_and_other_fields(ingested):
+    rows, csv_path, collection = ingested
+    rows.loc[7, 'description'] = "Now with notes of plum."
+    rows.to_csv(csv_path, index=False)
+    summary, embedder = sync(csv_path, collection)
+    assert (summary['changed'], summary['embedded'], summary['deleted']) == (1, 1, 0)
+    doc = collection.find_one({'_id': 7})
+    assert doc['description'] == "Now with notes of plum."
+    assert doc['openai_embedding'] == [float(len("Winery 7 2015 Red Now with notes of plum.")), 1.0]
+    assert doc['gist_embeddings'] == [0.5, 0.5] and doc['winery'] == "Winery 7"
+    # The gist embedding of the edited row is now stale, and a sync of that field re-embeds only it.
+    summary, embedder = sync(csv_path, collection, embedding_field='gist_embeddings')
+    assert summary['embedded'] == 1 and len(embedder.texts) == 1
+
+
+def test_metadata_change_is_set_without_embedding(ingested):
+    rows, csv_path, collection = ingested
+    rows.loc[2, 'price'] = 99.0
+    rows.to_csv(csv_path, index=False)
+    summary, embedder = sync(csv_path, collection)
+    assert (summary['updated'], summary['embedded']) == (1, 0)
+    assert collection.find_one({'_id': 2})['price'] == 99.0
+
+
+def test_legacy_documents_get_their_hashes_backfilled(ingested):
+    _, csv_path, collection = ingested
+    for doc_id in range(20):
+        collection.update_one({'_id': doc_id}, {'$unset': {'content_hash': '', 'openai_embedding_hash': ''}})
+    summary, embedder = sync(csv_path, collection)
+    assert (summary['unchanged'], summary['embedded']) == (20, 0)
+    assert collection.count_documents({'content_hash': {'$exists': True},
+                                       'openai_embedding_hash': {'$exists': True}}) == 20
+
+
+def test_dry_run_writes_nothing(ingested):
+    rows, csv_path, collection = ingested
+    rows.drop(index=0).to_csv(csv_path, index=False)
+    before = list(collection.find())
+    summary, embedder = sync(csv_path, collection, dry_run=True)
+    assert summary['deleted'] == 1 and not embedder.texts
+    assert list(collection.find()) == before
+
+
+def test_resume_after_a_sync_only_ingests_appended_rows(ingested):
+    rows, csv_path, collection = ingested
+    # After the sync the file has 19 rows under the IDs 0-2 and 4-19.
+    rows = rows.drop(index=3)
+    rows.to_csv(csv_path, index=False)
+    sync(csv_path, collection)
+    pd.concat([rows, make_rows(22).iloc[20:]]).to_csv(csv_path, index=False)
+    embedder = CountingEmbedder()
+    stored = process_csv_file(str(csv_path), collection, embed_fn=embedder, batch_size=4, max_workers=2)
+    assert stored == 2
+    assert embedder.texts == [f"Winery {i} 2015 Red Notes of cherry number {i}." for i in (20, 21)]
+    assert [collection.find_one({'_id': doc_id})['title'] for doc_id in (20, 21)] == \
+        ["Winery 20 2015 Red", "Winery 21 2015 Red"]
+    assert collection.count_documents({}) == 21
+
+
+def test_resume_cursor_skips_other_ids_and_unrecorded_batches(ingested):
+    _, _, collection = ingested
+    collection.insert_one({'_id': ObjectId(), 'title': "Added by hand"})
+    assert get_resume_cursor(collection) == (20, 20)
+    # Collections ingested before the cursor was recorded continue after the highest numeric _id.
+    collection.database['Meta'].delete_one({'_id': collection.name})
+    assert get_resume_cursor(collection) == (20, 20)
+    # A batch stored right before a crash, without its cursor update, is not ingested again.
+    save_resume_cursor(collection, 16, 16)
+    assert get_resume_cursor(collection) == (20, 20)
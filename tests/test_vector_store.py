@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from filter_index import parse_filters
+from vector_store import LOCAL_BACKENDS, exact_top_k, normalize_rows
+
+
+@pytest.mark.parametrize('backend', sorted(LOCAL_BACKENDS))
+def test_empty_index_returns_no_documents(backend):
+    if backend == 'hnsw':
+        pytest.importorskip('hnswlib')
+    store = LOCAL_BACKENDS[backend](np.empty((0, 0), dtype=np.float32), [])
+    assert len(store) == 0
+    assert store.search(np.ones(8), k=5) == []
+    assert store.search(np.ones(8), k=5, filters=parse_filters({'country': 'US'})) == []
+    assert store.search_many(np.ones((2, 8)), k=5) == [[], []]
+
+
+def test_exact_top_k_blocks_over_the_corpus():
+    rng = np.random.default_rng(0)
+    vectors = normalize_rows(rng.normal(size=(1000, 16)))
+    queries = rng.normal(size=(37, 16))
+    expected_scores = normalize_rows(queries) @ vectors.T
+    expected = np.argsort(-expected_scores, axis=1, kind='stable')[:, :10]
+    for block_size, corpus_block_size in ((256, 65536), (8, 7), (5, 100)):
+        indices, scores = exact_top_k(vectors, queries, 10, block_size, corpus_block_size)
+        assert np.array_equal(indices, expected)
+        assert np.allclose(scores, np.take_along_axis(expected_scores, expected, axis=1))
+    indices, scores = exact_top_k(vectors[:3], queries, 10, corpus_block_size=2)
+    assert indices.shape == (37, 3) and set(indices[0]) == {0, 1, 2}